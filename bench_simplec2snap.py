@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# Benchmark of simplec2snap against a simulated EC2 backend
+#
+# The fake backend implements the EC2Backend calls made by ManageSnapshot, so
+# discovery, snapshot and retention can be measured at several fleet sizes
+# without an AWS account. It reports wall time, API calls by operation and
+# peak memory for each scenario.
+#
+#  Example: ./bench_simplec2snap.py --sizes 10 100 1000 --latency 0.01
+
+import argparse
+import collections
+import fnmatch
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import simplec2snap
+
+
+class Record(object):
+    """
+    Object with attributes
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeEC2(simplec2snap.EC2Backend):
+    """
+    In-process EC2 backend seeded with instances, volumes and snapshots
+    """
+
+    def __init__(self, instances, volumes, snapshots, latency=0,
+                 throttle=0, rate_limit=0, transition=0, seed=0):
+        """
+        :param instances: number of instances
+        :type instances: int
+
+        :param volumes: number of volumes per instance
+        :type volumes: int
+
+        :param snapshots: number of historical snapshots per volume
+        :type snapshots: int
+
+        :param latency: seconds spent in each call
+        :type latency: float
+
+        :param throttle: probability for a call to be throttled
+        :type throttle: float
+
+        :param rate_limit: calls per second above which calls are
+                           throttled, 0 for no limit
+        :type rate_limit: float
+
+        :param transition: seconds for an instance to stop or start
+        :type transition: float
+
+        :param seed: random seed
+        :type seed: int
+        """
+        self.latency = latency
+        self.throttle = throttle
+        self.rate_limit = rate_limit
+        self._budget = rate_limit
+        self._refill = time.time()
+        self.transition = transition
+        self.calls = collections.Counter()
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counter = 0
+        self.instances = collections.OrderedDict()
+        self.volumes = collections.OrderedDict()
+        self.snapshots = {}
+        self.snapshot_tags = {}
+        # Listing order, deleted IDs are skipped so that page tokens stay
+        # valid while snapshots are deleted
+        self._order = []
+        self._by_volume = collections.defaultdict(list)
+
+        start = time.time() - snapshots * 3600
+        for number in range(instances):
+            iid = "i-%08x" % number
+            self.instances[iid] = Record(
+                id=iid, state='running', target=None, ready=0,
+                root_device_name='/dev/sda',
+                tags={'Name': "instance-%s" % number, 'env': 'bench'})
+            for disk in range(volumes):
+                vol = "vol-%08x" % (number * volumes + disk)
+                self.volumes[vol] = simplec2snap.VolumeRecord(
+                    vol, iid, "/dev/sd%s" % chr(97 + disk), 8)
+                for hour in range(snapshots):
+                    self._add_snapshot(vol, start + hour * 3600, {})
+
+    def _add_snapshot(self, vol, timestamp, tags):
+        """
+        Create a snapshot record
+        """
+        with self._lock:
+            self._counter += 1
+            sid = "snap-%08x" % self._counter
+            snapshot = simplec2snap.SnapshotRecord(
+                sid, vol, time.strftime(simplec2snap.SNAP_TIME_FORMAT,
+                                        time.gmtime(timestamp)),
+                'completed', '100%', 8)
+            self.snapshots[sid] = snapshot
+            self.snapshot_tags[sid] = dict(tags)
+            self._order.append(sid)
+            self._by_volume[vol].append(sid)
+        return snapshot
+
+    def call(self, operation):
+        """
+        Account a call, simulate its latency and throttling
+        """
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = self._random.random() < self.throttle
+            if self.rate_limit > 0:
+                now = time.time()
+                self._budget = min(self.rate_limit, self._budget +
+                                   (now - self._refill) * self.rate_limit)
+                self._refill = now
+                if self._budget < 1:
+                    throttled = True
+                else:
+                    self._budget -= 1
+            if throttled:
+                self.throttled += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if throttled:
+            raise simplec2snap.EC2Error(503, 'RequestLimitExceeded',
+                                        'Request limit exceeded.')
+
+    def _state(self, instance):
+        """
+        Move an instance to its target state once its transition is done
+        """
+        if instance.target is not None and time.time() >= instance.ready:
+            instance.state = instance.target
+            instance.target = None
+        return instance.state
+
+    @staticmethod
+    def _page(items, next_token, page_size):
+        """
+        Cut a page out of a result list
+        """
+        start = int(next_token or 0)
+        end = len(items) if page_size is None else start + page_size
+        return simplec2snap.Page(items[start:end],
+                                 str(end) if end < len(items) else None)
+
+    def describe_instances(self, instance_ids=None, filters=None,
+                           next_token=None):
+        self.call('describe_instances')
+        page_size = None
+        if instance_ids is None:
+            instances = list(self.instances.values())
+            page_size = simplec2snap.PAGE_SIZE
+        else:
+            missing = [i for i in instance_ids if i not in self.instances]
+            if len(missing) > 0:
+                raise simplec2snap.EC2Error(
+                    400, 'InvalidInstanceID.NotFound',
+                    "The instance IDs '%s' do not exist" % ', '.join(missing))
+            instances = [self.instances[i] for i in instance_ids]
+        for key, value in (filters or {}).items():
+            values = value if isinstance(value, list) else [value]
+            if key == 'instance-state-name':
+                instances = [i for i in instances if self._state(i) in values]
+            elif key.startswith('tag:'):
+                tag = key[4:]
+                instances = [i for i in instances if
+                             any(fnmatch.fnmatchcase(i.tags.get(tag, ''), v)
+                                 for v in values)]
+        records = [simplec2snap.InstanceRecord(i.id, self._state(i),
+                                               i.root_device_name,
+                                               dict(i.tags))
+                   for i in instances]
+        return self._page(records, next_token, page_size)
+
+    def describe_instance_states(self, instance_ids, next_token=None):
+        self.call('describe_instance_status')
+        return self._page([(i, self._state(self.instances[i]))
+                           for i in instance_ids if i in self.instances],
+                          next_token, None)
+
+    def describe_volumes(self, filters, next_token=None):
+        self.call('describe_volumes')
+        ids = set(filters.get('attachment.instance-id', []))
+        return self._page([v for v in self.volumes.values()
+                           if v.instance_id in ids],
+                          next_token, simplec2snap.PAGE_SIZE)
+
+    def describe_snapshots(self, snapshot_ids=None, filters=None,
+                           next_token=None):
+        self.call('describe_snapshots')
+        with self._lock:
+            if snapshot_ids is not None:
+                return self._page([self.snapshots[i] for i in snapshot_ids
+                                   if i in self.snapshots], next_token, None)
+            order = self._order
+            if filters is not None and 'volume-id' in filters:
+                order = [sid for vol in filters['volume-id']
+                         for sid in self._by_volume.get(vol, [])]
+            start = int(next_token or 0)
+            end = min(len(order), start + simplec2snap.PAGE_SIZE)
+            # Fresh records as a real client decodes each response
+            return simplec2snap.Page(
+                [simplec2snap.SnapshotRecord(*self.snapshots[sid])
+                 for sid in order[start:end] if sid in self.snapshots],
+                str(end) if end < len(order) else None)
+
+    def create_snapshot(self, volume_id, description, tags):
+        self.call('create_snapshot')
+        return self._add_snapshot(volume_id, time.time(), tags)
+
+    def create_snapshots(self, instance_id, exclude_boot, description,
+                         tags):
+        self.call('create_snapshots')
+        instance = self.instances[instance_id]
+        now = time.time()
+        return [self._add_snapshot(vol.id, now, tags)
+                for vol in list(self.volumes.values())
+                if vol.instance_id == instance_id and
+                not (exclude_boot and
+                     vol.device == instance.root_device_name)]
+
+    def copy_snapshot(self, source_region, snapshot_id, description, tags):
+        self.call('copy_snapshot')
+        # Copies have no volume in the destination region
+        return self._add_snapshot('vol-ffffffff', time.time(), tags).id
+
+    def describe_snapshot_copies(self, source_region, volume_ids,
+                                 next_token=None):
+        self.call('describe_snapshots')
+        volume_ids = set(volume_ids)
+        with self._lock:
+            copies = [self.snapshots[sid]._replace(
+                volume_id=self.snapshot_tags[sid]['volume'])
+                for sid in self._order if sid in self.snapshots and
+                self.snapshot_tags[sid].get('source region') ==
+                source_region and
+                self.snapshot_tags[sid].get('volume') in volume_ids]
+        return self._page(copies, next_token, simplec2snap.PAGE_SIZE)
+
+    def delete_snapshot(self, snapshot_id):
+        self.call('delete_snapshot')
+        with self._lock:
+            if self.snapshots.pop(snapshot_id, None) is None:
+                raise simplec2snap.EC2Error(
+                    400, 'InvalidSnapshot.NotFound',
+                    "Snapshot %s not found" % snapshot_id)
+            del self.snapshot_tags[snapshot_id]
+
+    def _transition(self, operation, instance_ids, state, target):
+        self.call(operation)
+        for iid in instance_ids:
+            instance = self.instances[iid]
+            instance.state = state
+            instance.target = target
+            instance.ready = time.time() + self.transition
+
+    def stop_instances(self, instance_ids):
+        self._transition('stop_instances', instance_ids, 'stopping', 'stopped')
+
+    def start_instances(self, instance_ids):
+        self._transition('start_instances', instance_ids, 'pending', 'running')
+
+
+def fake_manager(ec2, regions=None, **kwargs):
+    """
+    Build a ManageSnapshot connected to a fake backend
+
+    :param ec2: fake backend of the region of the run
+    :type ec2: FakeEC2
+
+    :param regions: fake backends of other regions, an empty one is added
+                    for each other region connected to
+    :type regions: dict
+
+    :returns: the manager, constructed with discovery done
+    :rtype return: ManageSnapshot
+    """
+    regions = regions if regions is not None else {}
+    lock = threading.Lock()
+
+    class BenchManageSnapshot(simplec2snap.ManageSnapshot):
+        def _connect(self, region=None):
+            if region is None or region == self._region:
+                return ec2
+            with lock:
+                if region not in regions:
+                    regions[region] = FakeEC2(0, 0, 0, latency=ec2.latency)
+                return regions[region]
+
+    options = dict(region='bench', key_id=None, access_key=None,
+                   instance_list=[], tags=[['env', 'bench']], dry_run=False,
+                   timeout=600, cold_snap=False, limit=-1,
+                   no_root_device=False, max_age=[], no_snap=False,
+                   keep_last_snapshots=0)
+    options.update(kwargs)
+    return BenchManageSnapshot(**options)
+
+
+def measure(name, size, ec2, function):
+    """
+    Run a scenario and collect its metrics
+
+    :param name: scenario name
+    :type name: str
+
+    :param size: number of instances
+    :type size: int
+
+    :param ec2: fake backend
+    :type ec2: FakeEC2
+
+    :param function: scenario to run
+    :type function: function
+
+    :returns: metrics of the scenario
+    :rtype return: dict
+    """
+    ec2.calls.clear()
+    ec2.throttled = 0
+    tracemalloc.start()
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'scenario': name,
+            'instances': size,
+            'seconds': round(elapsed, 3),
+            'calls': sum(ec2.calls.values()),
+            'calls_by_operation': dict(ec2.calls),
+            'throttled': ec2.throttled,
+            'peak_memory_kb': peak // 1024}
+
+
+def run_size(size, arg):
+    """
+    Run every scenario for a fleet size
+
+    :param size: number of instances
+    :type size: int
+
+    :param arg: command line arguments
+    :type arg: Namespace
+
+    :returns: metrics of each scenario
+    :rtype return: list
+    """
+    def new_backend():
+        return FakeEC2(size, arg.volumes, arg.snapshots, arg.latency,
+                       arg.throttle, arg.rate_limit, seed=arg.seed)
+
+    options = dict(workers=arg.workers, delete_workers=arg.workers,
+                   delete_rate=0, api_rate=arg.api_rate,
+                   multi_volume=arg.multi_volume)
+    results = []
+
+    if arg.retention_snapshots > 0:
+        # A single large account: the listing dominates memory
+        ec2 = FakeEC2(size, arg.volumes,
+                      arg.retention_snapshots // (size * arg.volumes),
+                      arg.latency, arg.throttle, arg.rate_limit,
+                      seed=arg.seed)
+        manager = fake_manager(ec2, keep_last_snapshots=arg.keep,
+                               no_snap=True, **options)
+        results.append(measure('retention', size, ec2,
+                               manager.mk_rm_snapshot))
+        return results
+
+    ec2 = new_backend()
+    results.append(measure('discovery', size, ec2,
+                           lambda: fake_manager(ec2, **options)))
+
+    ec2 = new_backend()
+    manager = fake_manager(ec2, keep_last_snapshots=arg.keep, **options)
+    results.append(measure('mk_rm_snapshot', size, ec2,
+                           manager.mk_rm_snapshot))
+
+    ec2 = new_backend()
+    manager = fake_manager(ec2, keep_last_snapshots=arg.keep, no_snap=True,
+                           dry_run=True, **options)
+    results.append(measure('_remove_old_snap', size, ec2,
+                           lambda: [manager._remove_old_snap(iid)
+                                    for iid in manager._instances]))
+    return results
+
+
+def main():
+    """
+    Main - manage args
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark simplec2snap against a simulated EC2 backend',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='Fleet sizes (number of instances)')
+    parser.add_argument('--volumes', type=int, default=2,
+                        help='Volumes per instance')
+    parser.add_argument('--snapshots', type=int, default=10,
+                        help='Historical snapshots per volume')
+    parser.add_argument('--keep', type=int, default=7,
+                        help='Snapshots kept per volume by retention')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds spent in each API call')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='Probability for an API call to be throttled')
+    parser.add_argument('--rate_limit', type=float, default=0,
+                        help='API calls per second above which calls are \
+                              throttled (0 for no limit)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Workers used by ManageSnapshot')
+    parser.add_argument('--api_rate', type=float, default=0,
+                        help='Client side API rate of ManageSnapshot \
+                              (0 for no limit)')
+    parser.add_argument('--multi_volume', action='store_true', default=False,
+                        help='Snapshot instances with one multi-volume call')
+    parser.add_argument('--retention_snapshots', type=int, default=0,
+                        help='Only run retention over this many snapshots \
+                              spread on the fleet, to measure its memory')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write results as JSON to this file')
+    arg = parser.parse_args()
+
+    # Keep benchmark output readable
+    logging.getLogger(simplec2snap.__name__).setLevel(logging.CRITICAL)
+
+    results = []
+    print("%-18s %9s %9s %7s %10s %12s" % ('scenario', 'instances',
+                                           'seconds', 'calls', 'throttled',
+                                           'peak mem KB'))
+    for size in arg.sizes:
+        for result in run_size(size, arg):
+            results.append(result)
+            print("%-18s %9s %9s %7s %10s %12s" %
+                  (result['scenario'], result['instances'], result['seconds'],
+                   result['calls'], result['throttled'],
+                   result['peak_memory_kb']))
+
+    if arg.output is not None:
+        with open(arg.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
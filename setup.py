@@ -14,6 +14,7 @@ setup(
     long_description=open('README.md').read(),
     install_requires=open('requirements.txt').read().splitlines(),
     include_package_data=True,
+    python_requires='>=3.6',
     url='https://github.com/enovance/simple_ec2_snapshot',
     classifiers=[
         "Programming Language :: Python",
@@ -22,7 +23,7 @@ setup(
         "Environment :: Console",
         "Natural Language :: English",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
         "Topic :: Communications",
     ],
 )
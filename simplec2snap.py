@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # encoding: utf-8
 #
 # Authors:
@@ -8,23 +8,72 @@
 #   Hugo Rosnet <hugo.rosnet@enovance.com>
 #
 # Dependencies:
-# - python boto
+# - python boto3
 #
-#  On Debian: aptitude install python-boto
-#  With pip: pip install boto
+#  On Debian: apt install python3-boto3
+#  With pip: pip install boto3
 
 import argparse
 import sys
-import boto.ec2
-import ConfigParser
+import boto3
+import botocore.config
+import botocore.exceptions
+import configparser
 import os
 import time
+import socket
+import random
 import datetime
 import logging
 from collections import OrderedDict
+import itertools
+import heapq
+import hashlib
+import collections
+import json
+import sqlite3
+import threading
+import queue
+import calendar
+import http.server
+import signal
+import contextlib
+import cProfile
+import pstats
+import re
 
 __version__ = 'v0.4'
 
+# Maximum number of values sent in a single describe filter
+FILTER_CHUNK = 200
+# Number of results requested per page on paginated describe calls
+PAGE_SIZE = 1000
+# Format of snapshot start_time
+SNAP_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+# Upper bounds, in seconds, of the API latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+# EC2 error codes returned when the account is throttled
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+# EC2 error codes of transient server side failures
+TRANSIENT_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable',
+                   'Unavailable')
+# EC2 error codes of instance IDs which do not exist
+INVALID_INSTANCE_CODES = ('InvalidInstanceID.NotFound',
+                          'InvalidInstanceID.Malformed')
+# EC2 error codes of snapshots which no longer exist
+MISSING_SNAPSHOT_CODES = ('InvalidSnapshot.NotFound',)
+# EC2 error codes of a region or account without CreateSnapshots
+UNSUPPORTED_CODES = ('InvalidAction', 'UnsupportedOperation')
+# Seconds by duration unit
+DURATION_UNITS = OrderedDict([('s', 1), ('m', 60), ('h', 60 * 60),
+                              ('d', 60 * 60 * 24), ('w', 60 * 60 * 24 * 7),
+                              ('M', 60 * 60 * 24 * 30),
+                              ('y', 60 * 60 * 24 * 30 * 365)])
+# Instance tag giving the interval between jobs in daemon mode
+INTERVAL_TAG = 'snap:interval'
+# Instance states kept when selecting instances (all but terminated)
+ALIVE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
 LVL = {'INFO': logging.INFO,
        'DEBUG': logging.DEBUG,
        'ERROR': logging.ERROR,
@@ -78,7 +127,7 @@ class Instance:
     Contruct instances and set/get attached disks
     """
 
-    def __init__(self, iid, name, state, root_dev):
+    def __init__(self, iid, name, state, root_dev, tags=None):
         """
         Set instance id
         :param iid: Instance ID
@@ -92,11 +141,15 @@ class Instance:
 
         :param root_dev: Name of the root device
         :type root_dev: str
+
+        :param tags: Tags of the instance
+        :type tags: dict
         """
         self.instance_id = iid
         self.name = name
         self.initial_state = state
         self.root_dev = root_dev
+        self.tags = tags or {}
         self.disks = {}
 
     def add_disk(self, vol, device):
@@ -121,433 +174,5121 @@ class Instance:
         return(self.disks)
 
 
-class ManageSnapshot:
+def parse_start_time(value):
     """
-    Manage AWS Snapshot
+    Parse a snapshot start_time without going through strptime
+
+    :param value: start_time as returned by EC2, or a datetime
+    :type value: str
+
+    :returns: naive UTC datetime
+    :rtype return: datetime
     """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return value
+    try:
+        return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                                 int(value[8:10]), int(value[11:13]),
+                                 int(value[14:16]), int(value[17:19]))
+    except (TypeError, IndexError):
+        raise ValueError("Invalid snapshot date %r" % (value,))
 
-    def __init__(self, region, key_id, access_key, instance_list, tags,
-                 dry_run, timeout, cold_snap, limit, no_root_device,
-                 max_age, no_snap, keep_last_snapshots, logger=__name__):
-        """
-        :param region: EC2 region
-        :type region: str
 
-        :param key_id: EC2 key identifier
-        :type key_id: str
+def parse_duration(value):
+    """
+    Parse a duration made of a number and a unit, ex: 30m, 1h, 2d
 
-        :param access_key: EC2 access key
-        :type access_key: str
+    :param value: duration, units are s/m/h/d/w/M/y
+    :type value: str
 
-        :param instance_list: filter on this list of instances
-        :type instance_list: list
+    :returns: number of seconds
+    :rtype return: int
+    """
+    try:
+        seconds = int(value[:-1]) * DURATION_UNITS[value[-1]]
+    except (ValueError, KeyError, IndexError):
+        raise ValueError("Invalid duration %r, expected a number followed "
+                         "by one of %s" % (value, '/'.join(DURATION_UNITS)))
+    if seconds <= 0:
+        raise ValueError("Invalid duration %r, must be positive" % (value,))
+    return seconds
 
-        :param tags: filter on this tags
-        :type tags: dict
 
-        :param dry_run: run without applying, just for test
-        :type dry_run: bool
+def parse_shard(value):
+    """
+    Parse a shard of the fleet, ex: 1/4 for the first of four shards
 
-        :param timeout: maximum time to wait when instances are switching state
-        :type timeout: int
+    :param value: shard number and number of shards, as i/N
+    :type value: str
 
-        :param cold_snap: choose if you want to stop
-                            or not instance before snapshoting
-        :type cold_snap: bool
+    :returns: shard number from 1 to N, number of shards
+    :rtype return: int, int
+    """
+    try:
+        number, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected i/N" % (value,))
+    if count <= 0 or number < 1 or number > count:
+        raise ValueError("Invalid shard %r, expected 1 <= i <= N" % (value,))
+    return number, count
 
-        :param limit: limit the number of snapshots
-        :type limit: int
 
-        :param no_root_device: do not snapshot root devices
-        :type no_root_device: bool
+def shard_of(instance_id, count):
+    """
+    Shard of an instance, the same on every host and Python version
 
-        :param max_age: maximum age of snapshot to keep
-        :type max_age: list
+    :param instance_id: EC2 instance ID
+    :type instance_id: str
 
-        :param no_snap: specify if snapshot needs to be done or not
-        :type no_snap: bool
+    :param count: number of shards
+    :type count: int
 
-        :param keep_last_snapshots: keep at least x snapshots
-        :type keep_last_snapshots: int
+    :returns: shard number from 1 to count
+    :rtype return: int
+    """
+    digest = hashlib.sha1(instance_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count + 1
 
-        :param logger: logger name
-        :type logger: str
 
-        """
-        self._region = region
-        self._key_id = key_id
-        self._access_key = access_key
-        self._instance_list = instance_list
-        self._tags = tags
-        self._dry_run = dry_run
-        self._timeout = timeout
-        self._cold_snap = cold_snap
-        self._limit = limit
-        self._no_root_device = no_root_device
-        self._max_age = max_age
-        self._max_age_sec = 0
-        self._no_snap = no_snap
-        self._keep_last_snapshots = keep_last_snapshots
-        self.logger = logging.getLogger(logger)
+def read_jobs(path):
+    """
+    Read a job file, an INI file with a section per job holding its
+    selection and retention options, ex:
 
-        self._instances = []
-        self._conn = self._validate_aws_connection()
-        self._filter_instances()
-        self._set_instance_info()
+        [web]
+        tags = Name=web-*
+               env=prod
+        max_age = 7 d
+        no_root_device = true
+
+    Options of the DEFAULT section apply to every job.
+
+    :param path: job file
+    :type path: str
+
+    :returns: job names and their options, in the order of the file
+    :rtype return: list of (str, dict)
+    """
+    config = configparser.ConfigParser()
+    if len(config.read([path])) == 0:
+        raise ValueError("Can't read job file %s" % path)
+    jobs = []
+    for name in config.sections():
+        section = config[name]
+        job = {}
+        for key in section:
+            value = section[key]
+            try:
+                if key == 'tags':
+                    job[key] = [line.strip().split('=', 1)
+                                for line in value.splitlines()
+                                if line.strip()]
+                    if any(len(tag) != 2 for tag in job[key]):
+                        raise ValueError('expected one name=value by line')
+                elif key == 'instance':
+                    job[key] = value.split()
+                elif key == 'max_age':
+                    job[key] = value.split()
+                    if len(job[key]) != 2:
+                        raise ValueError('expected <int> <s/m/h/d/w/M/y>')
+                elif key in ('keep_last_snapshots', 'limit'):
+                    job[key] = section.getint(key)
+                elif key in ('no_root_device', 'cold_snap', 'no_snap',
+                             'multi_volume'):
+                    job[key] = section.getboolean(key)
+                elif key == 'gfs':
+                    job[key] = RetentionPolicy.parse_periods(value)
+                else:
+                    raise ValueError('unknown option')
+            except ValueError as e:
+                raise ValueError("Invalid %s of job %s: %s" % (key, name, e))
+        if len(job.get('tags', [])) == 0 and len(job.get('instance', [])) == 0:
+            raise ValueError("Job %s selects no instance, set its tags or "
+                             "instance" % name)
+        jobs.append((name, job))
+    if len(jobs) == 0:
+        raise ValueError("No job in %s" % path)
+    return jobs
 
-    def _validate_aws_connection(self):
-        """
-        Validate if AWS connection is OK or not
 
-        :returns: connection access
-        :rtype return: object
+class RetentionPolicy:
+    """
+    Select snapshots to delete by age, by number, or with
+    grandfather-father-son rules keeping the newest snapshot of each of the
+    last N hours, days, weeks, months or years
+    """
+
+    PERIODS = OrderedDict([
+        ('hourly', lambda t: (t.year, t.month, t.day, t.hour)),
+        ('daily', lambda t: (t.year, t.month, t.day)),
+        ('weekly', lambda t: t.isocalendar()[:2]),
+        ('monthly', lambda t: (t.year, t.month)),
+        ('yearly', lambda t: t.year),
+    ])
+
+    def __init__(self, max_age=0, keep_last=0, periods=None):
         """
-        # Print running mode
-        mode = 'run'
-        if self._dry_run is True:
-            mode = ' '.join(['dry', mode])
-        self.logger.info("== Launching %s mode ==" % mode)
+        :param max_age: maximum age of snapshots in seconds, 0 to disable
+        :type max_age: int
 
-        c = False
-        self.logger.info('Connecting to AWS')
-        self.logger.debug("Using Access key: %s" % self._access_key)
-        try:
-            c = boto.ec2.connect_to_region(self._region,
-                                           aws_access_key_id=self._key_id,
-                                           aws_secret_access_key=self._access_key)
-        except IndexError, e:
-            self.logger.critical("Can't connect with the credentials: %s" % e)
-            sys.exit(1)
-        return c
+        :param keep_last: number of newest snapshots to keep
+        :type keep_last: int
 
-    def _set_instance_info(self):
+        :param periods: number of snapshots to keep by period name
+                        (hourly, daily, weekly, monthly, yearly)
+        :type periods: dict
         """
-        Set instances info from an ID
-        This will construct an object containing disks attributes
+        self.max_age = max_age
+        self.keep_last = keep_last
+        self.periods = dict((period, count) for period, count in
+                            (periods or {}).items() if count > 0)
+        for period in self.periods:
+            if period not in self.PERIODS:
+                raise ValueError("Unknown retention period %s" % period)
+
+    @classmethod
+    def parse_periods(cls, spec):
         """
-        # Remove doubles
-        self._instance_list = list(set(self._instance_list))
-        # Create Instance object
-        for iid in self._instance_list:
-            # Get instance elements
-            try:
-                instance = self._conn.get_all_instances(instance_ids=iid)[0].instances[0]
-            except Exception as e:
-                self.logger.critical("Could not get instance information: %s"
-                                     % e)
-                continue
+        Parse grandfather-father-son rules
 
-            name = instance.tags['Name']
-            state = instance.state
-            root_dev = instance.root_device_name
-            instance_id = Instance(iid, name, state, root_dev)
-            self._instances.append(instance_id)
+        :param spec: rules like 'hourly=24,daily=14,weekly=8,monthly=12'
+        :type spec: str
 
-            # Set disks
-            filter = {'attachment.instance-id': iid}
+        :returns: number of snapshots to keep by period name
+        :rtype return: dict
+        """
+        periods = {}
+        for rule in spec.split(','):
             try:
-                vol = self._conn.get_all_volumes(filters=filter)
-            except Exception as e:
-                self.logger.critical("Could not get volumes: %s" % e)
-                continue
+                period, count = rule.split('=')
+                periods[period.strip()] = int(count)
+            except ValueError:
+                raise ValueError("Invalid retention rule %s, expected "
+                                 "PERIOD=N" % rule)
+            if period.strip() not in cls.PERIODS:
+                raise ValueError("Unknown retention period %s, choose "
+                                 "between %s" % (period,
+                                                 '/'.join(cls.PERIODS)))
+        return periods
 
-            for device in vol:
-                filter = {'block-device-mapping.volume-id': device.id}
-                try:
-                    volumesinstance = self._conn.get_all_instances(filters=filter)
-                except Exception as e:
-                    self.logger.critical("Could not get block device mapping information: %s" % e)
-                    continue
-                ids = [z for k in volumesinstance for z in k.instances]
-                for s in ids:
-                    instance_id.add_disk(device.id, device.attach_data.device)
-        # Stop if no instances matched
-        if (len(self._instances) == 0):
-            self.logger.error('No instances found with those parameters !')
-            return
+    def enabled(self):
+        """
+        :returns: True if the policy may delete snapshots
+        :rtype return: bool
+        """
+        return self.max_age > 0 or self.keep_last > 0 or len(self.periods) > 0
 
-    def _filter_instances(self):
+    def selector(self, now):
         """
-        Filter instances by tag
+        :param now: reference time, naive UTC
+        :type now: datetime
+
+        :returns: streaming selector for the snapshots of one volume
+        :rtype return: RetentionSelector
         """
-        self.logger.info('Getting instances information')
-        if len(self._tags) > 0:
+        return RetentionSelector(self, now)
 
-            # Create a dictionary with tags to create filters
-            filter_tags = {}
-            for tag in self._tags:
-                key = ''.join(['tag:', tag[0]])
-                value = tag[1]
-                filter_tags[key] = value
-            try:
-                reservations = self._conn.get_all_instances(filters=filter_tags)
-            except Exception as e:
-                self.logger.critical("Can't filter instance reservation: %s"
-                                     % e)
-                sys.exit(1)
-            instances = [i for r in reservations for i in r.instances]
-            for instance in instances:
-                # Do not keep terminated instances
-                if self._conn.get_all_instances(instance_ids=instance.id)[0].instances[0].state == 'terminated':
-                    return
-                else:
-                    self._instance_list.append(instance.id)
+    def select(self, snapshots, now):
+        """
+        Select the snapshots of a volume to delete
 
-    def _check_inst_state(self, iid, expected_state):
+        :param snapshots: snapshots of a volume, with id and start_time
+        :type snapshots: list
+
+        :param now: reference time, naive UTC
+        :type now: datetime
+
+        :returns: snapshots to delete, newest first
+        :rtype return: list
         """
-        Will wait until the expected state or until timeout will be reached
+        selector = self.selector(now)
+        order = {}
+        deleted = []
+        for position, snapshot in enumerate(snapshots):
+            order[snapshot.id] = position
+            deleted.extend(selector.offer(snapshot))
+        return sorted(deleted, key=lambda snapshot: (
+            parse_start_time(snapshot.start_time), -order[snapshot.id]),
+            reverse=True)
 
-        :param iid: EC2 instance ID
-        :type iid: object
 
-        :param expected_state: instance expected state state
-        :type expected_state: str
+class RetentionSelector:
+    """
+    Streaming evaluation of a RetentionPolicy on the snapshots of a volume
 
-        :returns: Boolean
+    Snapshots can be offered in any order. Only the ones a rule may still
+    keep are held: the newest keep_last ones in a heap and, for each
+    period, the newest snapshot of each of the newest buckets. Memory is
+    bounded by the policy whatever the number of snapshots, and a snapshot
+    is returned for deletion as soon as no rule can keep it anymore.
+    """
+
+    def __init__(self, policy, now):
         """
-        retry = 5
-        counter = 0
-        while self._conn.get_all_instances(instance_ids=iid.instance_id)[0].instances[0].state != expected_state:
-            self.logger.debug("Waiting for %s state... %s / %s" %
-                              (expected_state, counter, self._timeout))
-            counter += retry
-            if counter <= self._timeout:
-                time.sleep(retry)
-            else:
-                self.logger.error('Timeout exceded')
-                return False
-        self.logger.info("Instance %s now %s !" %
-                         (iid.instance_id, expected_state))
-        return True
+        :param policy: retention policy
+        :type policy: RetentionPolicy
 
-    def _create_inst_snap(self, iid):
+        :param now: reference time, naive UTC
+        :type now: datetime
         """
-        Create instance snapshot
+        self._policy = policy
+        self._now = now
+        self._max_age = datetime.timedelta(seconds=policy.max_age)
+        self._offered = 0
+        # Min-heap of (rank, snapshot) for keep_last
+        self._last = []
+        # Newest (rank, snapshot) by bucket, and min-heap of buckets
+        self._buckets = dict((period, {}) for period in policy.periods)
+        self._oldest = dict((period, []) for period in policy.periods)
+        # Number of rules holding a snapshot, by snapshot ID
+        self._refs = {}
 
-        :param iid: EC2 instance ID
-        :type iid: str
+    def _expired(self, timestamp):
+        """
+        :returns: True if a snapshot of this date is older than max age
+        :rtype return: bool
+        """
+        return self._policy.max_age > 0 and \
+            self._now - timestamp > self._max_age
 
-        :return rcode: 0 ok / 1 failed
-        :rtype: bool
+    def offer(self, snapshot):
         """
-        rcode = 0
+        Account a snapshot of the volume, a snapshot already held is
+        ignored
 
-        # Name cold and hot snapshots
-        if self._cold_snap is False:
-            stype = 'Hot'
-        else:
-            stype = 'Cold'
+        :param snapshot: snapshot with id and start_time
+        :type snapshot: object
 
-        disks = iid.get_disks()
-        for vol, device in disks.iteritems():
-            # Removing root device if required
-            if self._no_root_device is True and device == iid.root_dev:
-                self.logger.debug('Not snapshoting root device %s(%s)' %
-                                  (vol, device))
-                continue
-            # Make snapshot
-            snap_name = ''.join([iid.instance_id,
-                                 ' (', iid.name, ') - ', stype, ' ', device,
-                                 ' (', vol, ')'])
-            if self._dry_run is False:
-                try:
-                    snap_id = self._conn.create_snapshot(vol, snap_name)
-                    snap_id.add_tags({'type': stype,
-                                      'volume': vol,
-                                      'device': device,
-                                      'instance name': iid.name})
-                except Exception as e:
-                    self.logger.critical("%s snapshot failed for %s(%s) [%s]" %
-                                         (stype, vol, device, e))
-                    rcode = 1
-                self.logger.info("%s snapshot made for %s(%s) - %s" %
-                                 (stype, vol, device, snap_id.id))
+        :returns: snapshots no rule keeps anymore
+        :rtype return: list
+        """
+        if snapshot.id in self._refs:
+            return []
+        timestamp = parse_start_time(snapshot.start_time)
+        policy = self._policy
+
+        # Historical behaviour: max age takes precedence on keep last
+        if len(policy.periods) == 0:
+            if policy.max_age > 0:
+                return [snapshot] if self._expired(timestamp) else []
+            if policy.keep_last == 0:
+                return []
+
+        # Between equal dates, the first offered is the newest
+        self._offered += 1
+        entry = ((timestamp, -self._offered), snapshot)
+        released = [entry]
+        self._refs[snapshot.id] = 0
+
+        def hold(entry):
+            self._refs[entry[1].id] += 1
+
+        if policy.keep_last > 0:
+            heapq.heappush(self._last, entry)
+            hold(entry)
+            if len(self._last) > policy.keep_last:
+                released.append(heapq.heappop(self._last))
+
+        for period, count in policy.periods.items():
+            bucket = RetentionPolicy.PERIODS[period](timestamp)
+            buckets = self._buckets[period]
+            oldest = self._oldest[period]
+            if bucket in buckets:
+                if entry[0] < buckets[bucket][0]:
+                    continue
+                released.append(buckets[bucket])
+            elif len(buckets) == count:
+                if count == 0 or bucket < oldest[0]:
+                    continue
+                released.append(buckets.pop(heapq.heappop(oldest)))
+                heapq.heappush(oldest, bucket)
             else:
-                self.logger.info("%s snapshot made for %s(%s)" %
-                                 (stype, vol, device))
-        return rcode
+                heapq.heappush(oldest, bucket)
+            buckets[bucket] = entry
+            hold(entry)
 
-    def calulate_max_snap_age(self):
+        deleted = []
+        for _, released_snapshot in released[1:]:
+            self._refs[released_snapshot.id] -= 1
+        for (timestamp, _), released_snapshot in released:
+            if self._refs.get(released_snapshot.id) != 0:
+                continue
+            del self._refs[released_snapshot.id]
+            # Without rules by period, keep last alone decides
+            if len(policy.periods) == 0 or policy.max_age == 0 or \
+                    self._expired(timestamp):
+                deleted.append(released_snapshot)
+        return deleted
+
+
+class StateFuture:
+    """
+    Result of an instance waiting for a state
+    """
+
+    def __init__(self, iid, expected_state, deadline):
         """
-        Calculate Snapshot age
+        :param iid: EC2 instance
+        :type iid: object
+
+        :param expected_state: instance expected state
+        :type expected_state: str
+
+        :param deadline: time after which waiting is abandoned
+        :type deadline: float
         """
-        self.logger.debug('Calculating max age')
+        self.iid = iid
+        self.expected_state = expected_state
+        self.deadline = deadline
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._result = None
 
-        # Check params
-        self._max_age[0] = int(self._max_age[0])
-        try:
-            self._max_age[0] == 0
-        except ValueError:
-            self.logger.error('Max age value cannot be 0')
-            sys.exit(1)
-        if self._max_age[0] == 0:
-            self.logger.error('Max age value cannot be 0')
-            sys.exit(1)
+    def set_result(self, result):
+        """
+        Complete the future and run its callbacks
 
-        # Calculate the maximum allowed snapshot age
-        if self._max_age[1] == 's':
-            self._max_age_sec = self._max_age[0]
-        elif self._max_age[1] == 'm':
-            self._max_age_sec = self._max_age[0] * 60
-        elif self._max_age[1] == 'h':
-            self._max_age_sec = self._max_age[0] * 60 * 60
-        elif self._max_age[1] == 'd':
-            self._max_age_sec = self._max_age[0] * 60 * 60 * 24
-        elif self._max_age[1] == 'w':
-            self._max_age_sec = self._max_age[0] * 60 * 60 * 24 * 7
-        elif self._max_age[1] == 'M':
-            self._max_age_sec = self._max_age[0] * 60 * 60 * 24 * 30
-        elif self._max_age[1] == 'y':
-            self._max_age_sec = self._max_age[0] * 60 * 60 * 24 * 30 * 365
-        else:
-            self.logger.error("Can't find the correct value (here %s),\
-                              please choose between s/m/h/d/w/M/y" %
-                              self._max_age[1])
-            sys.exit(1)
+        :param result: True if the state was reached, False on timeout
+        :type result: bool
+        """
+        with self._lock:
+            self._result = result
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
 
-    def mk_rm_snapshot(self):
+    def add_done_callback(self, callback):
         """
-        Create and remove snapshot on selected Instances ids
+        Call a function with the future once it is completed
 
-        :rtype: int, int
+        :param callback: function taking the future as argument
+        :type callback: function
         """
-        error_number = 0
-        old_snap_number = 0
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
 
-        counter = 0
-        for iid in self._instances:
+    def done(self):
+        """
+        :returns: True if the future is completed
+        :rtype return: bool
+        """
+        return self._event.is_set()
 
-            self.logger.info("Working on instance %s (%s)" %
-                             (iid.instance_id, iid.name))
+    def result(self):
+        """
+        Block until the future is completed
 
-            # Limit the number of backups if requested
-            self.logger.debug("Limit: %s" % self._limit)
-            if self._limit != -1 and counter >= self._limit:
-                self.logger.info("The requested limit of snapshots has been reached: %s" % self._limit)
-                break
-            counter += 1
-
-            if self._no_snap is False:
-                # Pausing VM and skip if failed
-                self.logger.debug("Initial_state: %s, No hot snap: %s, Dry run: %s" %
-                                  (iid.initial_state, self._cold_snap, self._dry_run))
-                if iid.initial_state == 'running':
-                    if self._cold_snap is True:
-                        self.logger.info('Instance is going to be shutdown')
-                    if self._cold_snap is True and self._dry_run is False:
-                        try:
-                            self._conn.stop_instances(instance_ids=[iid.instance_id])
-                        except Exception as e:
-                            self.logger.critical("Instance failed to stop: %s"
-                                                 % e)
-                            error_number += 1
-                            continue
-                        if self._check_inst_state(iid, 'stopped') is False:
-                            continue
+        :returns: True if the state was reached, False on timeout
+        :rtype return: bool
+        """
+        self._event.wait()
+        return self._result
 
-                # Creating Snapshots
-                rcode = self._create_inst_snap(iid)
-                if rcode != 0:
-                    error_number += 1
-
-                # Starting VM if was running
-                if iid.initial_state == 'running':
-                    if self._cold_snap is True:
-                        self.logger.info('Instance is going to be started')
-                    if self._cold_snap is True and self._dry_run is False:
-                        try:
-                            self._conn.start_instances(instance_ids=[iid.instance_id])
-                        except Exception as e:
-                            self.logger.critical("Instance failed to start: %s"
-                                                 % e)
-                            # Only increment errors if snapshot succeed
-                            if rcode == 0:
-                                error_number += 1
-                        self._check_inst_state(iid, 'running')
-
-            # Delete old Snapshots
-            if len(self._max_age) > 0 or self._keep_last_snapshots > 0:
-                old_snap_ret = self._remove_old_snap(iid)
-                if old_snap_ret != 0:
-                    old_snap_number += 1
 
-        return error_number, old_snap_number
+class StateWaiter:
+    """
+    Wait for instance states with one background poller shared by all
+    callers, checking every pending instance with a single call per tick
+    """
 
-    def _remove_old_snap(self, iid):
+    def __init__(self, poll, logger=__name__, min_interval=1,
+                 max_interval=15):
         """
-        Remove old snapshots
+        :param poll: function returning the state of a list of instance IDs
+        :type poll: function
 
-        :param iid: EC2 instance ID
-        :type iid: object
+        :param logger: logger name
+        :type logger: str
 
-        :rtype: bool
+        :param min_interval: initial time between polls, in seconds
+        :type min_interval: float
+
+        :param max_interval: maximum time between polls, in seconds
+        :type max_interval: float
         """
-        return_code = 0
+        self._poll = poll
+        self.logger = logging.getLogger(logger)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
 
-        disks = iid.get_disks()
-        for vol, device in disks.iteritems():
-            snapshots = self._conn.get_all_snapshots(filters={'volume-id': vol})
-            snapshots_tstamp = {}
+    def register(self, iid, expected_state, deadline):
+        """
+        Start waiting for an instance state
 
-            for snapshot in snapshots:
-                try:
-                    snap_date = snapshot.start_time
-                except:
-                    return_code = 1
-                timestamp = datetime.datetime.strptime(snap_date,
-                                                       '%Y-%m-%dT%H:%M:%S.000Z')
-                self.logger.debug("Volume %s(%s) has snapshot %s on %s" %
-                                  (vol, device, snapshot.id, timestamp))
-                delta_seconds = int((datetime.datetime.utcnow() - timestamp).total_seconds())
-
-                # When max_age arg is set
-                if len(self._max_age) > 0:
-                    if delta_seconds > self._max_age_sec:
-                        self.logger.info("Deleting snapshot %s (%s|%s)" %
-                                         (snapshot.id, vol, device))
-                        if self._dry_run is False:
-                            try:
-                                snapshot.delete()
-                            except Exception as e:
-                                self.logger.error("Error deleting snapshot %s with error %s" % (snapshot.id, e))
-                                return_code = 1
-                    else:
-                        self.logger.debug("Do not delete snapshot %s" %
-                                          snapshot.id)
-
-                # When keep_last_snapshots arg is set store them in a dict
-                elif self._keep_last_snapshots > 0:
-                    snapshots_tstamp[snapshot.id] = delta_seconds
-
-            # Kepp at least the desired number of snapshots
-            if self._keep_last_snapshots > 0:
-                counter = 1
-                # Sort snapshots by timestamp and delete oldest
-                snapshots_tstamp = OrderedDict(sorted(snapshots_tstamp.items(), key=lambda v: v[1]))
-                for snapshotid, delta_tstamp in snapshots_tstamp.iteritems():
-                    if counter > self._keep_last_snapshots:
-                        self.logger.info("Deleting snapshot %s (%s|%s)" %
-                                         (snapshotid, vol, device))
-                        if self._dry_run is False:
-                            try:
-                                snapshot = self._conn.get_all_snapshots(snapshot_ids=snapshotid)
-                                snapshot[0].delete()
-                            except Exception as e:
-                                self.logger.critical("Could not delete snapshot %s(%s|%s) [%s]" % (snapshotid, vol, device, e))
-                    else:
-                        self.logger.debug("Do not delete snapshot %s (%s|%s)" %
-                                          (snapshotid, vol, device))
-                    counter += 1
-        return return_code
+        :param iid: EC2 instance
+        :type iid: object
 
+        :param expected_state: instance expected state
+        :type expected_state: str
 
-def main():
-    """
-    Main - manage args
-    """
-    # Main informations
-    parser = argparse.ArgumentParser(
-        description='Simple EC2 Snapshot utility',
+        :param deadline: time after which waiting is abandoned
+        :type deadline: float
+
+        :returns: future completed when the state is reached or on timeout
+        :rtype return: StateFuture
+        """
+        future = StateFuture(iid, expected_state, deadline)
+        with self._cond:
+            self._pending.append(future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='state-waiter')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        """
+        Poll pending instances until none is left
+
+        The interval grows exponentially while nothing changes and is reset
+        when an instance reaches its state or a new one is registered.
+        Sleeps are jittered to avoid polling in lockstep with other runs.
+        """
+        interval = self._min_interval
+        while True:
+            with self._cond:
+                if len(self._pending) == 0:
+                    self._thread = None
+                    return
+                pending = list(self._pending)
+
+            try:
+                states = self._poll(list(set(f.iid.instance_id
+                                             for f in pending)))
+            except Exception as e:
+                self.logger.error("Could not get instances state: %s" % e)
+                states = {}
+
+            now = time.time()
+            completed = []
+            for future in pending:
+                state = states.get(future.iid.instance_id)
+                if state == future.expected_state:
+                    completed.append((future, True))
+                elif now >= future.deadline:
+                    completed.append((future, False))
+                else:
+                    self.logger.debug("Waiting for %s state of %s (now %s)" %
+                                      (future.expected_state,
+                                       future.iid.instance_id, state))
+
+            with self._cond:
+                for future, _ in completed:
+                    self._pending.remove(future)
+            for future, result in completed:
+                future.set_result(result)
+
+            with self._cond:
+                registered = len(self._pending) > len(pending) - len(completed)
+                if len(completed) > 0 or registered:
+                    interval = self._min_interval
+                else:
+                    interval = min(interval * 2, self._max_interval)
+                if len(self._pending) > 0 and not registered:
+                    wait = interval * random.uniform(0.5, 1)
+                    next_deadline = min(f.deadline for f in self._pending)
+                    self._cond.wait(max(0, min(wait, next_deadline - now)))
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared between threads
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second, 0 for no limit
+        :type rate: float
+
+        :param burst: maximum number of tokens stored
+        :type burst: float
+        """
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def classify_error(error):
+    """
+    Tell how an EC2 error should be retried
+
+    :param error: exception raised by an EC2 backend
+    :type error: Exception
+
+    :returns: 'throttle' when the account is throttled, 'transient' for
+              server side and network errors, None otherwise
+    :rtype return: str
+    """
+    code = getattr(error, 'error_code', None)
+    if code in THROTTLING_CODES:
+        return 'throttle'
+    if code in TRANSIENT_CODES:
+        return 'transient'
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and status >= 500:
+        return 'transient'
+    if isinstance(error, (IOError, socket.error)):
+        return 'transient'
+    return None
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate is halved on throttling responses and
+    increased back by a small fraction on each successful call
+    """
+
+    def __init__(self, rate, min_rate=0.5, increase=0.05, cooldown=1):
+        """
+        :param rate: maximum calls per second, 0 for no limit
+        :type rate: float
+
+        :param min_rate: lowest calls per second after throttling
+        :type min_rate: float
+
+        :param increase: fraction of the rate added after each success
+        :type increase: float
+
+        :param cooldown: minimum seconds between two slow downs, so calls
+                         throttled together only halve the rate once
+        :type cooldown: float
+        """
+        TokenBucket.__init__(self, rate)
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self._increase = increase
+        self._cooldown = cooldown
+        self._slowed = 0
+
+    def throttled(self):
+        """
+        Slow down after a throttling response
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._slowed < self._cooldown:
+                return
+            self._slowed = now
+            if self.rate <= 0:
+                self.rate = self.max_rate = self.min_rate * 2 ** 6
+                self._last = now
+            self.rate = max(self.min_rate, self.rate / 2.0)
+
+    def success(self):
+        """
+        Speed up after a successful call
+        """
+        with self._lock:
+            if 0 < self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate * (1 + self._increase))
+
+
+def bucket_label(bound):
+    """
+    :param bound: upper bound of a latency bucket
+    :type bound: float
+
+    :returns: bound formatted like a Prometheus le label
+    :rtype return: str
+    """
+    if bound == float('inf'):
+        return '+Inf'
+    return str(bound)
+
+
+class ApiMetrics:
+    """
+    Count calls, retries and errors and keep a latency histogram for each
+    EC2 operation
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+
+    def _operation(self, operation):
+        """
+        :returns: metrics of an operation, created if needed
+        :rtype return: dict
+        """
+        if operation not in self.operations:
+            self.operations[operation] = {
+                'calls': 0, 'retries': 0, 'throttled': 0, 'errors': 0,
+                'seconds': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+        return self.operations[operation]
+
+    def record(self, operation, seconds, error=None):
+        """
+        Account one attempt of a call
+
+        :param operation: operation name
+        :type operation: str
+
+        :param seconds: duration of the attempt
+        :type seconds: float
+
+        :param error: classification of the error if the attempt failed
+        :type error: str
+        """
+        with self._lock:
+            metrics = self._operation(operation)
+            metrics['calls'] += 1
+            metrics['seconds'] += seconds
+            for number, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics['buckets'][number] += 1
+            if error == 'throttle':
+                metrics['throttled'] += 1
+
+    def retried(self, operation):
+        """
+        Account a retry of a call
+
+        :param operation: operation name
+        :type operation: str
+        """
+        with self._lock:
+            self._operation(operation)['retries'] += 1
+
+    def failed(self, operation):
+        """
+        Account a call which failed after its retries
+
+        :param operation: operation name
+        :type operation: str
+        """
+        with self._lock:
+            self._operation(operation)['errors'] += 1
+
+    def report(self):
+        """
+        :returns: metrics by operation, with cumulative latency buckets
+        :rtype return: dict
+        """
+        with self._lock:
+            report = {}
+            for operation, metrics in self.operations.items():
+                report[operation] = dict(metrics)
+                report[operation]['latency_buckets'] = dict(
+                    (bucket_label(bound), count) for bound, count in
+                    zip(LATENCY_BUCKETS, metrics['buckets']))
+                del report[operation]['buckets']
+            return report
+
+
+class EC2Api:
+    """
+    Single entry point for EC2 calls, with an adaptive rate limiter, retries
+    with backoff depending on the error and per operation concurrency caps
+    """
+
+    def __init__(self, rate=20, retries=5, concurrency=None,
+                 logger=__name__):
+        """
+        :param rate: maximum calls per second, 0 for no limit
+        :type rate: float
+
+        :param retries: number of retries of a failing call
+        :type retries: int
+
+        :param concurrency: maximum concurrent calls by operation name
+        :type concurrency: dict
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self.limiter = AdaptiveRateLimiter(rate)
+        self.metrics = ApiMetrics()
+        self._retries = retries
+        self._caps = dict((op, threading.Semaphore(cap))
+                          for op, cap in (concurrency or {}).items())
+
+    def call(self, operation, function, *args, **kwargs):
+        """
+        Call an EC2 operation, retrying throttling and transient errors
+
+        :param operation: operation name
+        :type operation: str
+
+        :param function: EC2 backend method to call
+        :type function: function
+
+        :returns: result of the call
+        """
+        cap = self._caps.get(operation)
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            if cap is not None:
+                cap.acquire()
+            start = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                self.metrics.record(operation, time.time() - start, kind)
+                if kind is None or attempt >= self._retries:
+                    self.metrics.failed(operation)
+                    raise
+                attempt += 1
+                self.metrics.retried(operation)
+                if kind == 'throttle':
+                    self.limiter.throttled()
+                    base = 1
+                else:
+                    base = 0.2
+                delay = min(30, base * 2 ** attempt) * random.uniform(0.5, 1)
+                self.logger.debug("%s failed (%s), retrying in %.1fs: %s" %
+                                  (operation, kind, delay, e))
+            else:
+                self.metrics.record(operation, time.time() - start)
+                self.limiter.success()
+                return result
+            finally:
+                if cap is not None:
+                    cap.release()
+            time.sleep(delay)
+
+
+class SnapshotDeleter:
+    """
+    Delete snapshots from a queue with a pool of worker threads behind a
+    token bucket
+    """
+
+    def __init__(self, delete, workers=4, rate=10, on_deleted=None,
+                 backlog=1000, logger=__name__):
+        """
+        :param delete: function deleting a snapshot from its ID
+        :type delete: function
+
+        :param workers: number of deletion threads
+        :type workers: int
+
+        :param rate: maximum deletions per second, 0 for no limit
+        :type rate: float
+
+        :param on_deleted: called with each deleted snapshot
+        :type on_deleted: function
+
+        :param backlog: maximum number of queued deletions, submit blocks
+                        beyond it
+        :type backlog: int
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self._delete = delete
+        self._on_deleted = on_deleted
+        self._workers = max(1, workers)
+        self._bucket = TokenBucket(rate)
+        self._jobs = queue.Queue(backlog)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = None
+        self.deleted = 0
+        self.failed = 0
+        self.failed_owners = set()
+
+    def start(self):
+        """
+        Start the deletion threads
+        """
+        self._started = time.time()
+        for number in range(self._workers):
+            thread = threading.Thread(target=self._run,
+                                      name="deleter-%s" % number)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, snapshot, owner, label):
+        """
+        Queue a snapshot for deletion, waiting for room in the backlog
+
+        :param snapshot: EC2 snapshot
+        :type snapshot: object
+
+        :param owner: instance ID the snapshot is deleted for
+        :type owner: str
+
+        :param label: volume and device, for logging
+        :type label: str
+        """
+        self._jobs.put((snapshot, owner, label))
+
+    def close(self):
+        """
+        Wait for every queued deletion to be done and stop the threads
+
+        :returns: number of seconds spent deleting
+        :rtype return: float
+        """
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return time.time() - (self._started or time.time())
+
+    def _run(self):
+        """
+        Delete queued snapshots until a stop job is received
+        """
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            snapshot, owner, label = job
+            self._bucket.acquire()
+            try:
+                self._delete(snapshot.id)
+            except Exception as e:
+                self.logger.error("Error deleting snapshot %s (%s) with error %s"
+                                  % (snapshot.id, label, e))
+                with self._lock:
+                    self.failed += 1
+                    self.failed_owners.add(owner)
+            else:
+                with self._lock:
+                    self.deleted += 1
+                if self._on_deleted is not None:
+                    self._on_deleted(snapshot)
+
+
+CachedSnapshot = collections.namedtuple('CachedSnapshot',
+                                        ['id', 'volume_id', 'start_time'])
+
+
+class Inventory:
+    """
+    Instances of a region described once and shared by several jobs, each
+    selecting its instances locally by ID and tags
+
+    Tags are indexed by key and value. A tag selector value without
+    wildcard is a dictionary lookup, one with EC2 wildcards ('*' and '?')
+    is compiled once and matched against the distinct values of its key,
+    not against every instance.
+    """
+
+    def __init__(self):
+        self.instances = None
+        self._index = {}
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    def load(self, instances):
+        """
+        Index described instances
+
+        :param instances: instances with their disks
+        :type instances: list of Instance
+        """
+        self.instances = OrderedDict((iid.instance_id, iid)
+                                     for iid in instances)
+        self._index = {}
+        self._matches = {}
+        for iid in self.instances.values():
+            for key, value in iid.tags.items():
+                self._index.setdefault(key, {}).setdefault(
+                    value, []).append(iid.instance_id)
+
+    @staticmethod
+    def compile(pattern):
+        """
+        Compile a tag value with EC2 filter wildcards, '*' matching any
+        characters and '?' a single one
+
+        :param pattern: tag value
+        :type pattern: str
+
+        :rtype return: re.Pattern
+        """
+        return re.compile(''.join('.*' if char == '*' else
+                                  '.' if char == '?' else re.escape(char)
+                                  for char in pattern) + r'\Z', re.DOTALL)
+
+    def _match(self, key, pattern):
+        """
+        :returns: IDs of the instances with a tag value matching a pattern
+        :rtype return: set
+        """
+        with self._lock:
+            if (key, pattern) in self._matches:
+                return self._matches[(key, pattern)]
+        values = self._index.get(key, {})
+        if '*' not in pattern and '?' not in pattern:
+            matched = set(values.get(pattern, ()))
+        else:
+            regex = self.compile(pattern)
+            matched = set(instance_id for value, ids in values.items()
+                          if regex.match(value) for instance_id in ids)
+        with self._lock:
+            self._matches[(key, pattern)] = matched
+        return matched
+
+    def select(self, instance_ids, tags):
+        """
+        Select instances as the EC2 filters of a run would: instances
+        given by ID, and instances matching every tag key, several values
+        of a key matching any of them
+
+        :param instance_ids: instance IDs
+        :type instance_ids: list
+
+        :param tags: tag keys and values
+        :type tags: list of (str, str)
+
+        :returns: selected instances, in the inventory order
+        :rtype return: list of Instance
+        """
+        patterns = OrderedDict()
+        for key, value in tags:
+            patterns.setdefault(key, []).append(value)
+        selected = None
+        if len(patterns) > 0:
+            for key, values in patterns.items():
+                matched = set().union(*(self._match(key, value)
+                                        for value in values))
+                selected = matched if selected is None else \
+                    selected & matched
+        selected = set(instance_ids) | (selected or set())
+        return [iid for instance_id, iid in self.instances.items()
+                if instance_id in selected]
+
+
+class InventoryCache:
+    """
+    Local SQLite copy of instances, volume attachments and snapshots,
+    refreshed incrementally between runs
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS instances (id TEXT PRIMARY KEY, '
+        'name TEXT, state TEXT, root_dev TEXT, tags TEXT, updated REAL)',
+        'CREATE TABLE IF NOT EXISTS volumes (id TEXT PRIMARY KEY, '
+        'instance_id TEXT, device TEXT, updated REAL)',
+        'CREATE TABLE IF NOT EXISTS snapshots (id TEXT PRIMARY KEY, '
+        'volume_id TEXT, start_time TEXT, updated REAL)',
+        'CREATE INDEX IF NOT EXISTS snapshots_volume ON snapshots (volume_id)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, '
+        'value TEXT, updated REAL)',
+    ]
+
+    def __init__(self, path, ttl, logger=__name__):
+        """
+        :param path: SQLite database file
+        :type path: str
+
+        :param ttl: seconds after which cached entries are evicted
+        :type ttl: int
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove entries older than the TTL
+        """
+        limit = time.time() - self.ttl
+        with self._lock, self._db:
+            for table in ('instances', 'volumes', 'snapshots', 'meta'):
+                self._db.execute('DELETE FROM %s WHERE updated < ?' % table,
+                                 (limit,))
+
+    def is_fresh(self, key):
+        """
+        Tell if a sync marker was set within the TTL
+
+        :param key: sync marker name
+        :type key: str
+
+        :rtype return: bool
+        """
+        return self.get_meta(key) is not None
+
+    def get_meta(self, key):
+        """
+        :param key: entry name
+        :type key: str
+
+        :returns: JSON decoded value, None if missing or expired
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value, updated FROM meta '
+                                   'WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+        """
+        :param key: entry name
+        :type key: str
+
+        :param value: JSON serializable value
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)',
+                             (key, json.dumps(value), time.time()))
+
+    def get_instances(self, instance_ids):
+        """
+        :param instance_ids: EC2 instance IDs
+        :type instance_ids: list
+
+        :returns: Instance objects with their disks by instance ID
+        :rtype return: dict
+        """
+        instances = {}
+        with self._lock:
+            for offset in range(0, len(instance_ids), FILTER_CHUNK):
+                chunk = instance_ids[offset:offset + FILTER_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                for row in self._db.execute(
+                        'SELECT id, name, state, root_dev, tags FROM instances '
+                        'WHERE id IN (%s)' % marks, chunk):
+                    instances[row[0]] = Instance(*row[:4],
+                                                 tags=json.loads(row[4]))
+                for row in self._db.execute(
+                        'SELECT id, instance_id, device FROM volumes '
+                        'WHERE instance_id IN (%s)' % marks, chunk):
+                    if row[1] in instances:
+                        instances[row[1]].add_disk(row[0], row[2])
+        return instances
+
+    def store_instance(self, iid, tags):
+        """
+        Store an instance and replace its volume attachments
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :param tags: instance tags
+        :type tags: dict
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO instances '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (iid.instance_id, iid.name, iid.initial_state,
+                              iid.root_dev, json.dumps(tags), now))
+            self._db.execute('DELETE FROM volumes WHERE instance_id = ?',
+                             (iid.instance_id,))
+            self._db.executemany('INSERT OR REPLACE INTO volumes '
+                                 'VALUES (?, ?, ?, ?)',
+                                 [(vol, iid.instance_id, device, now)
+                                  for vol, device in iid.get_disks().items()])
+
+    def iter_snapshots(self, volume_ids=None):
+        """
+        Read cached snapshots by pages of PAGE_SIZE rows, the database is
+        only locked while a page is read
+
+        :param volume_ids: EC2 volume IDs, None for every cached snapshot
+        :type volume_ids: list
+
+        :returns: generator of CachedSnapshot
+        :rtype return: generator
+        """
+        if volume_ids is None:
+            chunks = [None]
+        else:
+            volume_ids = list(volume_ids)
+            chunks = [volume_ids[offset:offset + FILTER_CHUNK]
+                      for offset in range(0, len(volume_ids), FILTER_CHUNK)]
+        for chunk in chunks:
+            where = ''
+            if chunk is not None:
+                where = 'AND volume_id IN (%s) ' % ','.join('?' * len(chunk))
+            last = ''
+            while True:
+                with self._lock:
+                    rows = self._db.execute(
+                        'SELECT id, volume_id, start_time FROM snapshots '
+                        'WHERE id > ? %sORDER BY id LIMIT ?' % where,
+                        [last] + (chunk or []) + [PAGE_SIZE]).fetchall()
+                for row in rows:
+                    yield CachedSnapshot(*row)
+                if len(rows) < PAGE_SIZE:
+                    break
+                last = rows[-1][0]
+
+    def store_snapshots(self, snapshots, replace=False):
+        """
+        :param snapshots: EC2 snapshots
+        :type snapshots: iterable
+
+        :param replace: drop every other cached snapshot
+        :type replace: bool
+        """
+        now = time.time()
+        with self._lock, self._db:
+            if replace is True:
+                self._db.execute('DELETE FROM snapshots')
+            self._db.executemany('INSERT OR REPLACE INTO snapshots '
+                                 'VALUES (?, ?, ?, ?)',
+                                 [(snapshot.id, snapshot.volume_id,
+                                   snapshot.start_time, now)
+                                  for snapshot in snapshots])
+
+    def remove_snapshot(self, snapshot_id):
+        """
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots WHERE id = ?',
+                             (snapshot_id,))
+
+
+class RunJournal:
+    """
+    Append-only JSON lines journal of the steps of a run, to resume a run
+    which died halfway
+
+    A run starts with a plan of its instances and their volumes, then
+    records each instance stopped, snapshot created, instance started,
+    instance done and snapshot deleted, and ends with an end record. Lines
+    are flushed as they are written, so the journal survives the process.
+    """
+
+    def __init__(self, path, append=False, logger=__name__):
+        """
+        :param path: journal file
+        :type path: str
+
+        :param append: continue an existing journal instead of starting a
+                       new one
+        :type append: bool
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(path, 'a' if append is True else 'w')
+        # A line cut by a crash must not swallow the next record
+        if append is True and self._file.tell() > 0:
+            with open(path, 'rb') as journal:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    self._file.write('\n')
+                    self._file.flush()
+        self._lock = threading.Lock()
+
+    def record(self, event, **fields):
+        """
+        Append a step to the journal
+
+        :param event: step name
+        :type event: str
+
+        :param fields: JSON serializable step details
+        :type fields: dict
+        """
+        fields['event'] = event
+        fields['time'] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        """
+        Close the journal file
+        """
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def replay(path, logger=__name__):
+        """
+        Read back the journal of a run
+
+        A line cut by a crash is ignored.
+
+        :param path: journal file
+        :type path: str
+
+        :returns: None if there is no unfinished run, otherwise a dict with
+                  the planned instances ('plan') and snapshot mode
+                  ('cold_snap', 'no_snap'), the instances left stopped
+                  ('stopped'), the snapshots created by instance and volume
+                  ('snapshots'), the instances done ('done') and the IDs
+                  of the deleted snapshots ('deleted')
+        :rtype return: dict
+        """
+        if not os.path.isfile(path):
+            return None
+        state = None
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    step = json.loads(line)
+                except ValueError:
+                    logging.getLogger(logger).warning(
+                        "Ignoring truncated journal line in %s" % path)
+                    continue
+                event = step.get('event')
+                if event == 'plan':
+                    state = {'plan': step['instances'],
+                             'cold_snap': step.get('cold_snap', False),
+                             'no_snap': step.get('no_snap', False),
+                             'stopped': set(), 'snapshots': {},
+                             'done': set(), 'deleted': set()}
+                elif state is None:
+                    continue
+                elif event == 'stopped':
+                    state['stopped'].add(step['instance'])
+                elif event == 'started':
+                    state['stopped'].discard(step['instance'])
+                elif event == 'snapshot':
+                    state['snapshots'].setdefault(
+                        step['instance'], {})[step['volume']] = \
+                        step['snapshot']
+                elif event == 'done':
+                    state['done'].add(step['instance'])
+                elif event == 'deleted':
+                    state['deleted'].add(step['snapshot'])
+                elif event == 'end':
+                    state = None
+        return state
+
+
+class RunHistory:
+    """
+    Seconds spent on each instance by previous runs, by snapshot mode, to
+    estimate which instances fit in the time budget of a run
+
+    Durations are smoothed with an exponential moving average and kept in
+    a JSON file, written back at the end of each run. Instances never seen
+    are estimated with the mean of the others.
+    """
+
+    # Weight of the last duration in the moving average
+    SMOOTHING = 0.5
+
+    def __init__(self, path=None, logger=__name__):
+        """
+        :param path: history file, None to only keep the durations of
+                     this run
+        :type path: str
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self.path = path
+        self._durations = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path) as history:
+                    self._durations = json.load(history)
+            except ValueError:
+                self.logger.warning("Ignoring unreadable history %s" % path)
+        for modes in self._durations.values():
+            for mode, seconds in modes.items():
+                total = self._totals.setdefault(mode, [0, 0])
+                total[0] += seconds
+                total[1] += 1
+
+    def record(self, instance_id, mode, seconds):
+        """
+        Account the time spent on an instance
+
+        :param instance_id: EC2 instance ID
+        :type instance_id: str
+
+        :param mode: snapshot mode, 'hot' or 'cold'
+        :type mode: str
+
+        :param seconds: time spent on the instance
+        :type seconds: float
+        """
+        with self._lock:
+            modes = self._durations.setdefault(instance_id, {})
+            total = self._totals.setdefault(mode, [0, 0])
+            previous = modes.get(mode)
+            if previous is None:
+                average = seconds
+                total[1] += 1
+            else:
+                average = previous + self.SMOOTHING * (seconds - previous)
+                total[0] -= previous
+            modes[mode] = round(average, 3)
+            total[0] += modes[mode]
+
+    def estimate(self, instance_id, mode):
+        """
+        :param instance_id: EC2 instance ID
+        :type instance_id: str
+
+        :param mode: snapshot mode, 'hot' or 'cold'
+        :type mode: str
+
+        :returns: estimated seconds to spend on the instance, None if
+                  nothing is known about this mode yet
+        :rtype return: float
+        """
+        with self._lock:
+            seconds = self._durations.get(instance_id, {}).get(mode)
+            if seconds is not None:
+                return seconds
+            total = self._totals.get(mode)
+            if total is None or total[1] == 0:
+                return None
+            return total[0] / total[1]
+
+    def save(self):
+        """
+        Write the history file, if any
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Replaced at once, so a crash leaves the previous history
+            with open(self.path + '.tmp', 'w') as history:
+                json.dump(self._durations, history, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class SpanTracer:
+    """
+    Record the timed phases of a run, to be written as a Chrome trace file
+    (chrome://tracing, Perfetto)
+
+    Spans are complete events keyed by the thread running them, with the
+    instance and volume they apply to as arguments. The tracer is shared by
+    the threads of the run.
+    """
+
+    def __init__(self, logger=__name__):
+        """
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self._origin = time.time()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Time a block of code as a span
+
+        :param name: phase name
+        :type name: str
+
+        :param args: span arguments, None values are left out
+        :type args: dict
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), **args)
+
+    def add(self, name, start, end, **args):
+        """
+        Record a span of the current thread
+
+        :param name: phase name
+        :type name: str
+
+        :param start: start timestamp
+        :type start: float
+
+        :param end: end timestamp
+        :type end: float
+
+        :param args: span arguments, None values are left out
+        :type args: dict
+        """
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': 'simplec2snap', 'ph': 'X',
+                 'ts': int((start - self._origin) * 1000000),
+                 'dur': int((end - start) * 1000000),
+                 'pid': os.getpid(), 'tid': thread.ident,
+                 'args': dict((key, value) for key, value in args.items()
+                              if value is not None)}
+        with self._lock:
+            self._events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def summary(self):
+        """
+        :returns: number of spans and seconds spent by phase
+        :rtype return: dict
+        """
+        phases = {}
+        with self._lock:
+            for event in self._events:
+                phase = phases.setdefault(event['name'],
+                                          {'spans': 0, 'seconds': 0})
+                phase['spans'] += 1
+                phase['seconds'] += event['dur'] / 1000000.0
+        for phase in phases.values():
+            phase['seconds'] = round(phase['seconds'], 3)
+        return phases
+
+    def write(self, path):
+        """
+        Write the spans as a Chrome trace file and log the time spent by
+        phase
+
+        :param path: trace file
+        :type path: str
+        """
+        with self._lock:
+            events = list(self._events)
+            events.extend({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': ident,
+                           'args': {'name': name}}
+                          for ident, name in self._threads.items())
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'version': __version__,
+                                     'start': round(self._origin, 3)}},
+                      trace)
+        for name, phase in sorted(self.summary().items(),
+                                  key=lambda item: -item[1]['seconds']):
+            self.logger.info("Phase %s: %s spans, %ss" %
+                             (name, phase['spans'], phase['seconds']))
+        self.logger.info("Trace of %s spans written to %s" %
+                         (len(self._events), path))
+
+
+class RunProfiler:
+    """
+    cProfile of every thread of a run, merged into a single dump
+
+    cProfile only follows the thread enabling it, so each thread started
+    while profiling enables its own profiler on its first call.
+    """
+
+    def __init__(self, logger=__name__):
+        """
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _enable(self, frame, event, arg):
+        # Called once per new thread, the profiler replaces this hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        """
+        Profile the current thread and the threads started from now on
+        """
+        threading.setprofile(self._enable)
+        self._enable(None, None, None)
+
+    def stop(self, path):
+        """
+        Stop profiling and write the merged statistics, to be read with
+        pstats or snakeviz
+
+        :param path: profile dump file
+        :type path: str
+        """
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        self.logger.info("Profile of %s threads written to %s" %
+                         (len(profiles), path))
+
+
+class SnapshotTracker:
+    """
+    Follow the progress of snapshots created during a run, polling all
+    pending snapshots with a single call per tick
+    """
+
+    def __init__(self, poll, interval=10, on_done=None, logger=__name__):
+        """
+        :param poll: function returning (status, progress) of a list of
+                     snapshot IDs by snapshot ID
+        :type poll: function
+
+        :param interval: seconds between two polls
+        :type interval: float
+
+        :param on_done: called with the snapshot ID, the volume ID, the
+                        volume size and the final status of each snapshot
+                        once completed or in error
+        :type on_done: function
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self._poll = poll
+        self._interval = interval
+        self._on_done = on_done
+        self.logger = logging.getLogger(logger)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self.snapshots = {}
+
+    def add(self, snapshot_id, volume_id, size):
+        """
+        Start following a snapshot
+
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+
+        :param volume_id: EC2 volume ID
+        :type volume_id: str
+
+        :param size: volume size in GiB
+        :type size: int
+        """
+        with self._cond:
+            self.snapshots[snapshot_id] = {'volume': volume_id,
+                                           'size': size or 0,
+                                           'created': time.time(),
+                                           'completed': None,
+                                           'status': 'pending',
+                                           'progress': '0%'}
+
+    def pending(self):
+        """
+        :returns: IDs of snapshots not completed yet
+        :rtype return: list
+        """
+        with self._cond:
+            return [sid for sid, snap in self.snapshots.items()
+                    if snap['status'] == 'pending']
+
+    def start(self):
+        """
+        Start polling in the background
+        """
+        self._thread = threading.Thread(target=self._run,
+                                        name='snapshot-tracker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """
+        Poll pending snapshots until stopped
+        """
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                self._cond.wait(self._interval)
+                if self._stopping:
+                    return
+            self.poll()
+
+    def poll(self):
+        """
+        Update every pending snapshot with a single call
+        """
+        pending = self.pending()
+        if len(pending) == 0:
+            return
+        try:
+            states = self._poll(pending)
+        except Exception as e:
+            self.logger.error("Could not get snapshots progress: %s" % e)
+            return
+        now = time.time()
+        done = []
+        with self._cond:
+            for sid, (status, progress) in states.items():
+                snap = self.snapshots.get(sid)
+                if snap is None or snap['status'] != 'pending':
+                    continue
+                snap['progress'] = progress
+                if status in ('completed', 'error'):
+                    snap['status'] = status
+                    snap['completed'] = now
+                    done.append((sid, snap['volume'], snap['size'], status))
+                    self.logger.info("Snapshot %s of %s %s in %.0fs" %
+                                     (sid, snap['volume'], status,
+                                      now - snap['created']))
+        if self._on_done is not None:
+            for args in done:
+                self._on_done(*args)
+
+    def finish(self, wait=0):
+        """
+        Stop polling, waiting until every snapshot is done or for at most
+        wait seconds
+
+        :param wait: maximum seconds to wait, 0 to stop right away
+        :type wait: float
+
+        :returns: summary of the tracked snapshots
+        :rtype return: dict
+        """
+        deadline = time.time() + wait
+        while len(self.pending()) > 0 and time.time() < deadline:
+            self.logger.debug("Waiting for %s snapshots to complete" %
+                              len(self.pending()))
+            time.sleep(max(0, min(self._interval, deadline - time.time())))
+            self.poll()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        return self.summary()
+
+    def summary(self):
+        """
+        :returns: per snapshot and aggregate completion times and rates
+        :rtype return: dict
+        """
+        with self._cond:
+            snapshots = {}
+            for sid, snap in self.snapshots.items():
+                summary = {'volume': snap['volume'], 'size_gib': snap['size'],
+                           'status': snap['status'],
+                           'progress': snap['progress']}
+                if snap['completed'] is not None:
+                    seconds = max(snap['completed'] - snap['created'], 0.001)
+                    summary['seconds'] = round(seconds, 1)
+                    summary['gib_per_second'] = round(snap['size'] / seconds, 3)
+                snapshots[sid] = summary
+            done = [snap for snap in self.snapshots.values()
+                    if snap['status'] == 'completed']
+        aggregate = {'snapshots': len(snapshots),
+                     'completed': len(done),
+                     'errors': len([s for s in snapshots.values()
+                                    if s['status'] == 'error']),
+                     'pending': len([s for s in snapshots.values()
+                                     if s['status'] == 'pending'])}
+        if len(done) > 0:
+            seconds = max(max(s['completed'] for s in done) -
+                          min(s['created'] for s in done), 0.001)
+            size = sum(s['size'] for s in done)
+            aggregate['seconds'] = round(seconds, 1)
+            aggregate['size_gib'] = size
+            aggregate['gib_per_second'] = round(size / seconds, 3)
+        return {'aggregate': aggregate, 'snapshots': snapshots}
+
+
+class SnapshotCopier:
+    """
+    Copy snapshots to another region as soon as they are completed, with at
+    most a given number of copies in progress in the destination
+
+    Completed snapshots wait in a queue for a free slot, a slot is freed
+    when the destination tracker sees the copy completed or in error.
+    """
+
+    def __init__(self, region, copy, poll, concurrency=5, interval=10,
+                 logger=__name__):
+        """
+        :param region: destination region
+        :type region: str
+
+        :param copy: function starting the copy of a snapshot from its ID
+                     and volume ID, returning the ID of the copy
+        :type copy: function
+
+        :param poll: function returning (status, progress) of a list of
+                     copy IDs by copy ID, in the destination
+        :type poll: function
+
+        :param concurrency: maximum copies in progress
+        :type concurrency: int
+
+        :param interval: seconds between two polls of the copies
+        :type interval: float
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self.logger = logging.getLogger(logger)
+        self.region = region
+        self._copy = copy
+        self._concurrency = max(1, concurrency)
+        self._interval = interval
+        self._tracker = SnapshotTracker(poll, interval, on_done=self._copied,
+                                        logger=logger)
+        self._queue = collections.deque()
+        self._in_progress = 0
+        self._lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.failed = 0
+
+    def start(self):
+        """
+        Start following copies in the background
+        """
+        self._tracker.start()
+
+    def submit(self, snapshot_id, volume_id, size, status='completed'):
+        """
+        Queue a source snapshot, to be used as the on_done callback of the
+        source tracker
+
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+
+        :param volume_id: EC2 volume ID
+        :type volume_id: str
+
+        :param size: volume size in GiB
+        :type size: int
+
+        :param status: final status of the source snapshot
+        :type status: str
+        """
+        if status != 'completed':
+            return
+        with self._lock:
+            self._queue.append((snapshot_id, volume_id, size))
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       len(self._queue))
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Start queued copies while slots are free
+        """
+        while True:
+            with self._lock:
+                if self._in_progress >= self._concurrency or \
+                        len(self._queue) == 0:
+                    return
+                snapshot_id, volume_id, size = self._queue.popleft()
+                self._in_progress += 1
+                depth = len(self._queue)
+            try:
+                copy_id = self._copy(snapshot_id, volume_id)
+            except Exception as e:
+                self.logger.error("Copy of snapshot %s to %s failed: %s" %
+                                  (snapshot_id, self.region, e))
+                with self._lock:
+                    self._in_progress -= 1
+                    self.failed += 1
+                continue
+            self.logger.info("Copying snapshot %s of %s to %s - %s (%s "
+                             "queued)" % (snapshot_id, volume_id, self.region,
+                                          copy_id, depth))
+            self._tracker.add(copy_id, volume_id, size)
+
+    def _copied(self, copy_id, volume_id, size, status):
+        """
+        Free the slot of a copy completed or in error
+        """
+        with self._lock:
+            self._in_progress -= 1
+        self._dispatch()
+
+    def busy(self):
+        """
+        :returns: True while copies are queued or in progress
+        :rtype return: bool
+        """
+        with self._lock:
+            return self._in_progress > 0 or len(self._queue) > 0
+
+    def finish(self, wait=0):
+        """
+        Stop following copies, waiting until every queued copy is done or
+        for at most wait seconds
+
+        :param wait: maximum seconds to wait, 0 to stop right away
+        :type wait: float
+
+        :returns: summary of the copies, with throughput and queue depth
+        :rtype return: dict
+        """
+        deadline = time.time() + wait
+        while self.busy() and time.time() < deadline:
+            time.sleep(max(0, min(self._interval, deadline - time.time())))
+            self._tracker.poll()
+        tracking = self._tracker.finish()
+        aggregate = tracking['aggregate']
+        with self._lock:
+            aggregate.update({'region': self.region,
+                              'failed_requests': self.failed,
+                              'queue_depth': len(self._queue),
+                              'max_queue_depth': self.max_queue_depth,
+                              'concurrency': self._concurrency})
+        self.logger.info("Copies to %s completed: %s/%s, %s failed, %s "
+                         "still queued, queue depth up to %s%s" %
+                         (self.region, aggregate['completed'],
+                          aggregate['snapshots'],
+                          aggregate['errors'] + self.failed,
+                          aggregate['queue_depth'],
+                          aggregate['max_queue_depth'],
+                          " (%s GiB in %ss, %s GiB/s)" %
+                          (aggregate['size_gib'], aggregate['seconds'],
+                           aggregate['gib_per_second'])
+                          if 'seconds' in aggregate else ''))
+        return tracking
+
+
+# Records returned by EC2 backends
+InstanceRecord = collections.namedtuple('InstanceRecord',
+                                        'id state root_device_name tags')
+VolumeRecord = collections.namedtuple('VolumeRecord',
+                                      'id instance_id device size')
+SnapshotRecord = collections.namedtuple(
+    'SnapshotRecord', 'id volume_id start_time status progress volume_size')
+
+
+class Page(list):
+    """
+    Page of records with the token of the next page, None on the last one
+    """
+
+    def __init__(self, records=(), next_token=None):
+        list.__init__(self, records)
+        self.next_token = next_token
+
+
+class EC2Error(Exception):
+    """
+    Error returned by EC2
+    """
+
+    def __init__(self, status, error_code, message):
+        """
+        :param status: HTTP status
+        :type status: int
+
+        :param error_code: EC2 error code
+        :type error_code: str
+
+        :param message: error message
+        :type message: str
+        """
+        Exception.__init__(self, "%s %s: %s" % (status, error_code, message))
+        self.status = status
+        self.error_code = error_code
+
+
+class EC2Backend:
+    """
+    EC2 calls made by ManageSnapshot
+
+    Each method sends a single request, so that ManageSnapshot can rate
+    limit, retry and measure it. Describe methods return a Page and take
+    the token of the page to fetch. Errors are raised as EC2Error, or
+    IOError for network failures.
+    """
+
+    def describe_instances(self, instance_ids=None, filters=None,
+                           next_token=None):
+        """
+        :param instance_ids: EC2 instance IDs, None for all
+        :type instance_ids: list
+
+        :param filters: values by filter name
+        :type filters: dict
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :returns: page of InstanceRecord
+        :rtype return: Page
+        """
+        raise NotImplementedError
+
+    def describe_instance_states(self, instance_ids, next_token=None):
+        """
+        :param instance_ids: EC2 instance IDs
+        :type instance_ids: list
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :returns: page of (instance ID, state)
+        :rtype return: Page
+        """
+        raise NotImplementedError
+
+    def describe_volumes(self, filters, next_token=None):
+        """
+        :param filters: values by filter name
+        :type filters: dict
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :returns: page of VolumeRecord
+        :rtype return: Page
+        """
+        raise NotImplementedError
+
+    def describe_snapshots(self, snapshot_ids=None, filters=None,
+                           next_token=None):
+        """
+        :param snapshot_ids: EC2 snapshot IDs, None for all the snapshots
+                             owned by the account
+        :type snapshot_ids: list
+
+        :param filters: values by filter name, only volume-id is used
+        :type filters: dict
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :returns: page of SnapshotRecord
+        :rtype return: Page
+        """
+        raise NotImplementedError
+
+    def create_snapshot(self, volume_id, description, tags):
+        """
+        :param volume_id: EC2 volume ID
+        :type volume_id: str
+
+        :param description: snapshot description
+        :type description: str
+
+        :param tags: tags applied at creation
+        :type tags: dict
+
+        :rtype return: SnapshotRecord
+        """
+        raise NotImplementedError
+
+    def create_snapshots(self, instance_id, exclude_boot, description,
+                         tags):
+        """
+        Snapshot all the volumes of an instance at the same point in time
+
+        :param instance_id: EC2 instance ID
+        :type instance_id: str
+
+        :param exclude_boot: do not snapshot the root device
+        :type exclude_boot: bool
+
+        :param description: description of the snapshots
+        :type description: str
+
+        :param tags: tags applied at creation
+        :type tags: dict
+
+        :rtype return: list of SnapshotRecord
+        """
+        raise NotImplementedError
+
+    def copy_snapshot(self, source_region, snapshot_id, description, tags):
+        """
+        Copy a snapshot of another region to the region of the backend
+
+        :param source_region: region of the snapshot
+        :type source_region: str
+
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+
+        :param description: description of the copy
+        :type description: str
+
+        :param tags: tags of the copy
+        :type tags: dict
+
+        :returns: ID of the copy
+        :rtype return: str
+        """
+        raise NotImplementedError
+
+    def describe_snapshot_copies(self, source_region, volume_ids,
+                                 next_token=None):
+        """
+        List the copies of the snapshots of volumes from another region
+
+        :param source_region: region of the copied snapshots
+        :type source_region: str
+
+        :param volume_ids: EC2 volume IDs of the copied snapshots
+        :type volume_ids: list
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :returns: page of SnapshotRecord of the copies, with the volume ID
+                  of the copied snapshot
+        :rtype return: Page
+        """
+        raise NotImplementedError
+
+    def delete_snapshot(self, snapshot_id):
+        """
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+        """
+        raise NotImplementedError
+
+    def stop_instances(self, instance_ids):
+        """
+        :param instance_ids: EC2 instance IDs
+        :type instance_ids: list
+        """
+        raise NotImplementedError
+
+    def start_instances(self, instance_ids):
+        """
+        :param instance_ids: EC2 instance IDs
+        :type instance_ids: list
+        """
+        raise NotImplementedError
+
+
+class Boto3Backend(EC2Backend):
+    """
+    EC2 backend on boto3
+
+    The client is thread safe and shared by all the threads of a run, its
+    HTTP connection pool is sized with max_pool_connections. Describe calls
+    go through botocore paginators, resumed from the token of each page.
+    Retries are left to EC2Api, botocore does not retry on its own.
+    """
+
+    def __init__(self, region, key_id, access_key, max_pool_connections=10):
+        """
+        :param region: EC2 region
+        :type region: str
+
+        :param key_id: EC2 key identifier
+        :type key_id: str
+
+        :param access_key: EC2 access key
+        :type access_key: str
+
+        :param max_pool_connections: maximum HTTP connections kept open
+        :type max_pool_connections: int
+        """
+        session = boto3.session.Session(aws_access_key_id=key_id,
+                                        aws_secret_access_key=access_key,
+                                        region_name=region)
+        config = botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': 0})
+        self._client = session.client('ec2', config=config)
+
+    @staticmethod
+    def _filters(filters):
+        """
+        :param filters: values by filter name
+        :type filters: dict
+
+        :returns: filters in EC2 format
+        :rtype return: list
+        """
+        return [{'Name': name,
+                 'Values': list(values) if isinstance(values, (list, tuple))
+                 else [values]}
+                for name, values in sorted(filters.items())]
+
+    @staticmethod
+    def _tags(tags):
+        """
+        :param tags: tags in EC2 format
+        :type tags: list
+
+        :rtype return: dict
+        """
+        return dict((tag['Key'], tag['Value']) for tag in tags or [])
+
+    @staticmethod
+    def _snapshot(snapshot):
+        """
+        :param snapshot: snapshot in EC2 format
+        :type snapshot: dict
+
+        :rtype return: SnapshotRecord
+        """
+        start_time = snapshot['StartTime']
+        if isinstance(start_time, datetime.datetime):
+            start_time = parse_start_time(start_time).strftime(
+                SNAP_TIME_FORMAT)
+        return SnapshotRecord(snapshot['SnapshotId'], snapshot['VolumeId'],
+                              start_time, snapshot.get('State'),
+                              snapshot.get('Progress'),
+                              snapshot.get('VolumeSize', 0))
+
+    @staticmethod
+    def _send(function, *args, **kwargs):
+        """
+        Call a client function, translating botocore errors
+
+        :param function: function sending the request
+        :type function: function
+
+        :returns: response
+        :rtype return: dict
+        """
+        try:
+            return function(*args, **kwargs)
+        except botocore.exceptions.ClientError as e:
+            error = e.response.get('Error', {})
+            raise EC2Error(
+                e.response.get('ResponseMetadata', {}).get('HTTPStatusCode'),
+                error.get('Code'), error.get('Message'))
+        except (botocore.exceptions.ConnectionError,
+                botocore.exceptions.HTTPClientError) as e:
+            raise IOError(str(e))
+
+    def _page(self, operation, next_token, page_size=None, **kwargs):
+        """
+        Fetch a single page from a paginator
+
+        :param operation: client method name
+        :type operation: str
+
+        :param next_token: token of the page to fetch
+        :type next_token: str
+
+        :param page_size: number of results per page, None for the API
+                          default
+        :type page_size: int
+
+        :returns: response of the page and the token of the next one
+        :rtype return: dict, str
+        """
+        config = {}
+        if next_token is not None:
+            config['StartingToken'] = next_token
+        if page_size is not None:
+            config['PageSize'] = page_size
+        pages = self._client.get_paginator(operation).paginate(
+            PaginationConfig=config, **kwargs)
+        page = self._send(next, iter(pages))
+        return page, page.get('NextToken')
+
+    def describe_instances(self, instance_ids=None, filters=None,
+                           next_token=None):
+        kwargs = {}
+        page_size = None
+        if instance_ids is not None:
+            kwargs['InstanceIds'] = list(instance_ids)
+        else:
+            # Page size can not be set with instance IDs
+            page_size = PAGE_SIZE
+        if filters is not None:
+            kwargs['Filters'] = self._filters(filters)
+        page, next_token = self._page('describe_instances', next_token,
+                                      page_size, **kwargs)
+        return Page([InstanceRecord(instance['InstanceId'],
+                                    instance['State']['Name'],
+                                    instance.get('RootDeviceName'),
+                                    self._tags(instance.get('Tags')))
+                     for reservation in page['Reservations']
+                     for instance in reservation['Instances']], next_token)
+
+    def describe_instance_states(self, instance_ids, next_token=None):
+        page, next_token = self._page('describe_instance_status', next_token,
+                                      InstanceIds=list(instance_ids),
+                                      IncludeAllInstances=True)
+        return Page([(status['InstanceId'], status['InstanceState']['Name'])
+                     for status in page['InstanceStatuses']], next_token)
+
+    def describe_volumes(self, filters, next_token=None):
+        page, next_token = self._page('describe_volumes', next_token,
+                                      PAGE_SIZE,
+                                      Filters=self._filters(filters))
+        return Page([VolumeRecord(volume['VolumeId'],
+                                  attachment['InstanceId'],
+                                  attachment['Device'], volume['Size'])
+                     for volume in page['Volumes']
+                     for attachment in volume.get('Attachments', [])],
+                    next_token)
+
+    def describe_snapshots(self, snapshot_ids=None, filters=None,
+                           next_token=None):
+        kwargs = {}
+        if filters is not None:
+            kwargs['Filters'] = self._filters(filters)
+        if snapshot_ids is not None:
+            page, next_token = self._page('describe_snapshots', next_token,
+                                          SnapshotIds=list(snapshot_ids),
+                                          **kwargs)
+        else:
+            page, next_token = self._page('describe_snapshots', next_token,
+                                          PAGE_SIZE, OwnerIds=['self'],
+                                          **kwargs)
+        return Page([self._snapshot(snapshot)
+                     for snapshot in page['Snapshots']], next_token)
+
+    def create_snapshot(self, volume_id, description, tags):
+        return self._snapshot(self._send(
+            self._client.create_snapshot, VolumeId=volume_id,
+            Description=description,
+            TagSpecifications=[{'ResourceType': 'snapshot',
+                                'Tags': [{'Key': key, 'Value': value}
+                                         for key, value in
+                                         sorted(tags.items())]}]))
+
+    def create_snapshots(self, instance_id, exclude_boot, description,
+                         tags):
+        response = self._send(
+            self._client.create_snapshots,
+            InstanceSpecification={'InstanceId': instance_id,
+                                   'ExcludeBootVolume': exclude_boot},
+            Description=description,
+            TagSpecifications=[{'ResourceType': 'snapshot',
+                                'Tags': [{'Key': key, 'Value': value}
+                                         for key, value in
+                                         sorted(tags.items())]}])
+        return [self._snapshot(snapshot)
+                for snapshot in response['Snapshots']]
+
+    def copy_snapshot(self, source_region, snapshot_id, description, tags):
+        return self._send(
+            self._client.copy_snapshot, SourceRegion=source_region,
+            SourceSnapshotId=snapshot_id, Description=description,
+            TagSpecifications=[{'ResourceType': 'snapshot',
+                                'Tags': [{'Key': key, 'Value': value}
+                                         for key, value in
+                                         sorted(tags.items())]}]
+        )['SnapshotId']
+
+    def describe_snapshot_copies(self, source_region, volume_ids,
+                                 next_token=None):
+        # Copies have no volume, the copied one is in their tags
+        page, next_token = self._page(
+            'describe_snapshots', next_token, PAGE_SIZE, OwnerIds=['self'],
+            Filters=self._filters({'tag:source region': source_region,
+                                   'tag:volume': list(volume_ids)}))
+        return Page([self._snapshot(snapshot)._replace(
+            volume_id=self._tags(snapshot.get('Tags')).get('volume'))
+            for snapshot in page['Snapshots']], next_token)
+
+    def delete_snapshot(self, snapshot_id):
+        self._send(self._client.delete_snapshot, SnapshotId=snapshot_id)
+
+    def stop_instances(self, instance_ids):
+        self._send(self._client.stop_instances,
+                   InstanceIds=list(instance_ids))
+
+    def start_instances(self, instance_ids):
+        self._send(self._client.start_instances,
+                   InstanceIds=list(instance_ids))
+
+
+class BackendPool:
+    """
+    EC2 backends kept by region and credentials, so that several runs in
+    the same process share their clients and HTTP connections
+    """
+
+    def __init__(self, max_pool_connections=10):
+        """
+        :param max_pool_connections: maximum HTTP connections of each
+                                     backend
+        :type max_pool_connections: int
+        """
+        self._max_pool_connections = max_pool_connections
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get(self, region, key_id, access_key):
+        """
+        Get the backend of a region and credentials, created on first use
+
+        :param region: EC2 region
+        :type region: str
+
+        :param key_id: EC2 key identifier
+        :type key_id: str
+
+        :param access_key: EC2 access key
+        :type access_key: str
+
+        :rtype return: EC2Backend
+        """
+        with self._lock:
+            if (region, key_id) not in self._backends:
+                self._backends[(region, key_id)] = Boto3Backend(
+                    region, key_id, access_key, self._max_pool_connections)
+            return self._backends[(region, key_id)]
+
+
+class ManageSnapshot:
+    """
+    Manage AWS Snapshot
+    """
+
+    def __init__(self, region, key_id, access_key, instance_list, tags,
+                 dry_run, timeout, cold_snap, limit, no_root_device,
+                 max_age, no_snap, keep_last_snapshots, workers=1,
+                 cold_batch=0, delete_workers=4, delete_rate=10,
+                 cache=None, api_rate=20, api_concurrency=None,
+                 pool=None, budget=None, name=None, track=False,
+                 wait_snapshots=0, gfs=None, multi_volume=False,
+                 max_pool_connections=None, shard=None, journal=None,
+                 resume=False, apply_plan=None, plan_max_age=None,
+                 copy_regions=None, copy_concurrency=5, tracer=None,
+                 inventory=None, deadline=None, history=None,
+                 logger=__name__):
+        """
+        :param region: EC2 region
+        :type region: str
+
+        :param key_id: EC2 key identifier
+        :type key_id: str
+
+        :param access_key: EC2 access key
+        :type access_key: str
+
+        :param instance_list: filter on this list of instances
+        :type instance_list: list
+
+        :param tags: filter on this tags
+        :type tags: dict
+
+        :param dry_run: run without applying, just for test
+        :type dry_run: bool
+
+        :param timeout: maximum time to wait when instances are switching state
+        :type timeout: int
+
+        :param cold_snap: choose if you want to stop
+                            or not instance before snapshoting
+        :type cold_snap: bool
+
+        :param limit: limit the number of snapshots
+        :type limit: int
+
+        :param no_root_device: do not snapshot root devices
+        :type no_root_device: bool
+
+        :param max_age: maximum age of snapshot to keep
+        :type max_age: list
+
+        :param no_snap: specify if snapshot needs to be done or not
+        :type no_snap: bool
+
+        :param keep_last_snapshots: keep at least x snapshots
+        :type keep_last_snapshots: int
+
+        :param workers: number of instances processed concurrently
+        :type workers: int
+
+        :param cold_batch: number of instances stopped and started together
+                           during a cold snapshot, 0 to disable
+        :type cold_batch: int
+
+        :param delete_workers: number of snapshot deletion threads
+        :type delete_workers: int
+
+        :param delete_rate: maximum snapshot deletions per second, 0 for
+                            no limit
+        :type delete_rate: float
+
+        :param cache: local inventory cache
+        :type cache: InventoryCache
+
+        :param api_rate: maximum EC2 calls per second, 0 for no limit
+        :type api_rate: float
+
+        :param api_concurrency: maximum concurrent calls by operation name
+        :type api_concurrency: dict
+
+        :param pool: backends shared with other runs of the process
+        :type pool: BackendPool
+
+        :param budget: slots shared with other runs of the process, one is
+                       taken while an instance or a cold batch is processed
+        :type budget: threading.Semaphore
+
+        :param name: name of the run, prefixed to worker thread names and
+                     labelling its report metrics
+        :type name: str
+
+        :param track: follow the progress of created snapshots
+        :type track: bool
+
+        :param wait_snapshots: maximum seconds to wait for created snapshots
+                               to complete at the end of the run
+        :type wait_snapshots: float
+
+        :param gfs: number of snapshots to keep by period, see
+                    RetentionPolicy
+        :type gfs: dict
+
+        :param multi_volume: snapshot all the volumes of an instance in a
+                             single crash-consistent call
+        :type multi_volume: bool
+
+        :param max_pool_connections: maximum HTTP connections to EC2, by
+                                     default one per thread of the run
+        :type max_pool_connections: int
+
+        :param shard: only manage the instances of this shard, as returned
+                      by parse_shard
+        :type shard: tuple
+
+        :param journal: journal file of mk_rm_snapshot, see RunJournal
+        :type journal: str
+
+        :param resume: continue the unfinished run of the journal instead
+                       of selecting instances
+        :type resume: bool
+
+        :param apply_plan: make the actions of this plan file, written by
+                           write_plan, instead of selecting instances
+        :type apply_plan: str
+
+        :param plan_max_age: refuse to apply a plan written more than this
+                             number of seconds ago, None for any age
+        :type plan_max_age: float
+
+        :param copy_regions: copy created snapshots to these regions once
+                             completed, and apply retention to the copies
+        :type copy_regions: list
+
+        :param copy_concurrency: maximum copies in progress by destination
+        :type copy_concurrency: int
+
+        :param tracer: record the phases of the run as spans
+        :type tracer: SpanTracer
+
+        :param inventory: select instances from this inventory, shared by
+                          the jobs of a run and described by the first one
+        :type inventory: Inventory
+
+        :param deadline: seconds the run has to start the work on instances,
+                         the stalest ones first, the others being deferred
+        :type deadline: float
+
+        :param history: time spent on each instance by previous runs
+        :type history: RunHistory
+
+        :param logger: logger name
+        :type logger: str
+
+        """
+        self._region = region
+        self._key_id = key_id
+        self._access_key = access_key
+        self._instance_list = instance_list
+        self._tags = tags
+        self._dry_run = dry_run
+        self._timeout = timeout
+        self._cold_snap = cold_snap
+        self._limit = limit
+        self._shard = shard
+        self._no_root_device = no_root_device
+        self._max_age = max_age
+        self._max_age_sec = 0
+        self._no_snap = no_snap
+        self._keep_last_snapshots = keep_last_snapshots
+        self._gfs = gfs or {}
+        # Retention policy and reference time of the current run
+        self._run_policy = None
+        self._workers = workers
+        self._cold_batch = cold_batch
+        self._delete_workers = delete_workers
+        self._delete_rate = delete_rate
+        self._deleter = None
+        self._retention_failed = set()
+        self._run_seconds = 0
+        self._cache = cache
+        self._api_rate = api_rate
+        self._api_concurrency = api_concurrency
+        self._api = EC2Api(api_rate, concurrency=api_concurrency,
+                           logger=logger)
+        self._pool = pool
+        self._budget = budget
+        self._name = name
+        self._tracker = None
+        self._copy_regions = list(copy_regions or [])
+        self._copy_concurrency = copy_concurrency
+        self._tracer = tracer
+        self._deadline = deadline
+        self._deadline_at = None
+        self._deferred = []
+        self._history = history
+        if history is None and deadline is not None:
+            self._history = RunHistory(logger=logger)
+        self._copiers = []
+        self._copy_tracking = None
+        if track is True or wait_snapshots > 0 or \
+                len(self._copy_regions) > 0:
+            self._tracker = SnapshotTracker(self._poll_snapshots,
+                                            on_done=self._copy_completed,
+                                            logger=logger)
+        self._wait_snapshots = wait_snapshots
+        self._tracking = None
+        self._multi_volume = multi_volume
+        # Workers, deleters, the state waiter and the snapshot tracker
+        self._max_pool_connections = max_pool_connections or \
+            max(10, workers + delete_workers + 2)
+        self.logger = logging.getLogger(logger)
+
+        self._instances = []
+        self._backend = self._validate_aws_connection()
+        self._waiter = StateWaiter(self._poll_states, logger)
+        self._apply_plan = apply_plan
+        self._plan_max_age = plan_max_age
+        self._journal_path = journal
+        self._journal = None
+        self._resumed = None
+        if journal is not None and resume is True:
+            self._resumed = RunJournal.replay(journal, logger)
+            if self._resumed is None:
+                self.logger.info("No unfinished run in %s, starting a new "
+                                 "one" % journal)
+        # A new journal would lose the instances a dead run left stopped
+        elif journal is not None and \
+                RunJournal.replay(journal, logger) is not None:
+            self.logger.critical("Journal %s holds an unfinished run, resume "
+                                 "it with -E or remove the journal" % journal)
+            sys.exit(1)
+        # Newest snapshot time by volume, for the scheduler
+        self._newest = None
+        # Last snapshot created by volume, the listing may lag behind
+        self._created = {}
+        # Instances waiting for the retention pass of mk_rm_snapshot
+        self._pending_retention = None
+        self._index_lock = threading.Lock()
+        self._inventory = inventory
+        if self._resumed is not None:
+            self._load_resumed(self._resumed)
+        elif apply_plan is not None:
+            self._load_plan_file(apply_plan)
+        elif inventory is not None:
+            with self._span('discovery'):
+                self._select_inventory(inventory)
+        else:
+            with self._span('discovery'):
+                self._set_instance_info(self._filter_instances())
+
+    def _validate_aws_connection(self):
+        """
+        Validate if AWS connection is OK or not
+
+        :returns: EC2 backend
+        :rtype return: EC2Backend
+        """
+        # Print running mode
+        mode = 'run'
+        if self._dry_run is True:
+            mode = ' '.join(['dry', mode])
+        self.logger.info("== Launching %s mode ==" % mode)
+
+        c = False
+        self.logger.info('Connecting to AWS')
+        self.logger.debug("Using Access key: %s" % self._access_key)
+        try:
+            c = self._connect()
+        except botocore.exceptions.BotoCoreError as e:
+            self.logger.critical("Can't connect with the credentials: %s" % e)
+            sys.exit(1)
+        return c
+
+    def _connect(self, region=None):
+        """
+        Create the EC2 backend of the region, or take it from the pool
+
+        :param region: EC2 region, the region of the run by default
+        :type region: str
+
+        :returns: EC2 backend, shared by all the threads of the run
+        :rtype return: EC2Backend
+        """
+        region = region or self._region
+        if self._pool is not None:
+            return self._pool.get(region, self._key_id, self._access_key)
+        return Boto3Backend(region, self._key_id, self._access_key,
+                            self._max_pool_connections)
+
+    def _paginate(self, method, api=None, **kwargs):
+        """
+        Iterate over every page of a describe call
+
+        :param method: EC2 backend describe method
+        :type method: function
+
+        :param api: EC2Api of the backend, the one of the run by default
+        :type api: EC2Api
+
+        :returns: generator of result pages
+        :rtype return: generator
+        """
+        api = api or self._api
+        next_token = None
+        while True:
+            page = api.call(method.__name__, method,
+                            next_token=next_token, **kwargs)
+            yield page
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+
+    def _set_instance_info(self, tagged_ids=()):
+        """
+        Set instances info from an ID
+        This will construct an object containing disks attributes
+
+        Instances are described page by page, and the volumes of each page
+        are fetched with one call per chunk of instance IDs, then joined
+        locally on their attachment.
+
+        :param tagged_ids: instance IDs selected by tags
+        :type tagged_ids: iterable
+        """
+        for chunk in self._chunk_instance_ids(tagged_ids):
+            self._describe_instances(chunk)
+        if self._shard is not None:
+            self.logger.info("Shard %s/%s: %s instances" %
+                             (self._shard[0], self._shard[1],
+                              len(self._instances)))
+        # Stop if no instances matched
+        if (len(self._instances) == 0):
+            self.logger.error('No instances found with those parameters !')
+            return
+
+    def _chunk_instance_ids(self, tagged_ids):
+        """
+        Group requested and tagged instance IDs into chunks, removing doubles
+        and instances of other shards
+
+        :param tagged_ids: instance IDs selected by tags
+        :type tagged_ids: iterable
+
+        :returns: generator of instance ID lists
+        :rtype return: generator
+        """
+        seen = set()
+        chunk = []
+        for iid in itertools.chain(self._instance_list, tagged_ids):
+            # Remove doubles
+            if iid in seen:
+                continue
+            seen.add(iid)
+            if self._shard is not None and \
+                    shard_of(iid, self._shard[1]) != self._shard[0]:
+                continue
+            chunk.append(iid)
+            if len(chunk) == FILTER_CHUNK:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _describe_instances(self, chunk):
+        """
+        Create Instance objects with their disks for a chunk of IDs
+
+        :param chunk: instance IDs
+        :type chunk: list
+        """
+        if self._cache is not None:
+            chunk = self._describe_cached(chunk)
+            if len(chunk) == 0:
+                return
+
+        # Get instance elements, a wrong ID only costs its own instance
+        by_id = {}
+        remaining = list(chunk)
+        while len(remaining) > 0:
+            try:
+                for page in self._paginate(self._backend.describe_instances,
+                                           instance_ids=remaining):
+                    for instance in page:
+                        by_id[instance.id] = instance
+                break
+            except Exception as e:
+                invalid = []
+                if getattr(e, 'error_code', None) in INVALID_INSTANCE_CODES:
+                    invalid = [iid for iid in remaining if re.search(
+                        r'(?<![\w-])%s(?![\w-])' % re.escape(iid), str(e))]
+                if len(invalid) == 0:
+                    self.logger.critical("Could not get instance "
+                                         "information: %s" % e)
+                    return
+                self.logger.debug("Describing again without %s" %
+                                  ', '.join(invalid))
+                remaining = [iid for iid in remaining if iid not in invalid]
+
+        # Create Instance object
+        instances = {}
+        for iid in chunk:
+            if iid not in by_id:
+                self.logger.critical("Could not get instance information: %s"
+                                     % iid)
+                continue
+            instance = by_id[iid]
+            name = instance.tags.get('Name', '')
+            state = instance.state
+            root_dev = instance.root_device_name
+            instance_id = Instance(iid, name, state, root_dev,
+                                   dict(instance.tags))
+            self._instances.append(instance_id)
+            instances[iid] = instance_id
+
+        if len(instances) == 0:
+            return
+
+        # Set disks
+        filter = {'attachment.instance-id': list(instances)}
+        try:
+            vol = [volume for page in
+                   self._paginate(self._backend.describe_volumes,
+                                  filters=filter)
+                   for volume in page]
+        except Exception as e:
+            self.logger.critical("Could not get volumes: %s" % e)
+            return
+
+        for device in vol:
+            if device.instance_id in instances:
+                instances[device.instance_id].add_disk(device.id,
+                                                       device.device)
+
+        if self._cache is not None:
+            for instance_id, iid in instances.items():
+                self._cache.store_instance(iid, by_id[instance_id].tags)
+
+    def _offline(self):
+        """
+        Tell if the run can be planned from the cache only, which is the
+        case for dry runs with a cache synced within its TTL
+
+        :rtype return: bool
+        """
+        return self._cache is not None and self._dry_run is True and \
+            self._cache.is_fresh('snapshots')
+
+    def _describe_cached(self, chunk):
+        """
+        Create Instance objects from the cache for instances whose state
+        did not change since they were cached
+
+        :param chunk: instance IDs
+        :type chunk: list
+
+        :returns: instance IDs which have to be described
+        :rtype return: list
+        """
+        cached = self._cache.get_instances(chunk)
+        if len(cached) == 0:
+            return chunk
+        if self._offline():
+            states = dict((i, c.initial_state) for i, c in cached.items())
+        else:
+            try:
+                states = {}
+                for page in self._paginate(
+                        self._backend.describe_instance_states,
+                        instance_ids=list(cached)):
+                    states.update(page)
+            except Exception as e:
+                self.logger.error("Could not get instances state: %s" % e)
+                return chunk
+
+        remaining = []
+        for iid in chunk:
+            if iid in cached and states.get(iid) == cached[iid].initial_state:
+                self._instances.append(cached[iid])
+            else:
+                remaining.append(iid)
+        self.logger.debug("%s instances taken from the cache" %
+                          (len(chunk) - len(remaining)))
+        return remaining
+
+    def _filter_instances(self):
+        """
+        Filter instances by tag
+
+        Terminated instances are excluded by the API and results are
+        yielded page by page as they arrive.
+
+        :returns: generator of instance IDs
+        :rtype return: generator
+        """
+        self.logger.info('Getting instances information')
+        if len(self._tags) > 0:
+
+            # Create a dictionary with tags to create filters, several
+            # values of a key matching any of them
+            filter_tags = {'instance-state-name': ALIVE_STATES}
+            for tag in self._tags:
+                key = ''.join(['tag:', tag[0]])
+                value = tag[1]
+                filter_tags.setdefault(key, []).append(value)
+            cache_key = 'tags:' + json.dumps(sorted(self._tags))
+            if self._offline():
+                cached = self._cache.get_meta(cache_key)
+                if cached is not None:
+                    self.logger.debug('Using cached tag selection')
+                    for instance_id in cached:
+                        yield instance_id
+                    return
+
+            selected = []
+            try:
+                for page in self._paginate(self._backend.describe_instances,
+                                           filters=filter_tags):
+                    for instance in page:
+                        selected.append(instance.id)
+                        yield instance.id
+            except Exception as e:
+                self.logger.critical("Can't filter instance reservation: %s"
+                                     % e)
+                sys.exit(1)
+            if self._cache is not None:
+                self._cache.set_meta(cache_key, selected)
+
+    def _alive_instance_ids(self):
+        """
+        List every instance of the region which is not terminated
+
+        :returns: generator of instance IDs
+        :rtype return: generator
+        """
+        self.logger.info('Getting inventory of the region')
+        try:
+            for page in self._paginate(
+                    self._backend.describe_instances,
+                    filters={'instance-state-name': ALIVE_STATES}):
+                for instance in page:
+                    yield instance.id
+        except Exception as e:
+            self.logger.critical("Can't list instances: %s" % e)
+            sys.exit(1)
+
+    def _select_inventory(self, inventory):
+        """
+        Select instances from a shared inventory, describing every instance
+        of the region first if it is not loaded yet
+
+        :param inventory: inventory of the region
+        :type inventory: Inventory
+        """
+        if inventory.instances is None:
+            self._set_instance_info(self._alive_instance_ids())
+            inventory.load(self._instances)
+        self._instances = inventory.select(self._instance_list, self._tags)
+        selected = set(iid.instance_id for iid in self._instances)
+        for instance_id in self._instance_list:
+            if instance_id not in selected:
+                self.logger.critical("Could not get instance information: %s"
+                                     % instance_id)
+        self.logger.info("%s instances selected from the inventory" %
+                         len(self._instances))
+        if len(self._instances) == 0:
+            self.logger.error('No instances found with those parameters !')
+
+    def _poll_states(self, instance_ids):
+        """
+        Get the state of several instances with a single describe call
+
+        :param instance_ids: EC2 instance IDs
+        :type instance_ids: list
+
+        :returns: state by instance ID
+        :rtype return: dict
+        """
+        states = {}
+        for page in self._paginate(self._backend.describe_instances,
+                                   instance_ids=instance_ids):
+            for instance in page:
+                states[instance.id] = instance.state
+        return states
+
+    def _poll_snapshots(self, snapshot_ids):
+        """
+        Get the progress of several snapshots with a single call
+
+        :param snapshot_ids: EC2 snapshot IDs
+        :type snapshot_ids: list
+
+        :returns: (status, progress) by snapshot ID
+        :rtype return: dict
+        """
+        return dict((snapshot.id, (snapshot.status, snapshot.progress))
+                    for page in self._paginate(
+                        self._backend.describe_snapshots,
+                        snapshot_ids=snapshot_ids)
+                    for snapshot in page)
+
+    def _span(self, name, iid=None, **args):
+        """
+        Time a phase of the run if tracing is requested
+
+        :param name: phase name
+        :type name: str
+
+        :param iid: EC2 instance the phase applies to
+        :type iid: Instance
+
+        :param args: other span arguments
+        :type args: dict
+
+        :returns: context manager
+        """
+        if self._tracer is None:
+            return contextlib.nullcontext()
+        return self._tracer.span(name, region=self._region,
+                                 instance=getattr(iid, 'instance_id', None),
+                                 **args)
+
+    def _check_inst_state(self, iid, expected_state):
+        """
+        Will wait until the expected state or until timeout will be reached
+
+        :param iid: EC2 instance ID
+        :type iid: object
+
+        :param expected_state: instance expected state state
+        :type expected_state: str
+
+        :returns: Boolean
+        """
+        with self._span("wait %s" % expected_state, iid):
+            future = self._waiter.register(iid, expected_state,
+                                           time.time() + self._timeout)
+            reached = future.result()
+        if reached is False:
+            self.logger.error('Timeout exceded')
+            return False
+        self.logger.info("Instance %s now %s !" %
+                         (iid.instance_id, expected_state))
+        return True
+
+    def _check_batch_state(self, iids, expected_state, callback=None):
+        """
+        Wait until instances reach the expected state or until timeout
+
+        :param iids: EC2 instances
+        :type iids: list
+
+        :param expected_state: instance expected state
+        :type expected_state: str
+
+        :param callback: called with each instance reaching the state
+        :type callback: function
+
+        :returns: instances which did not reach the state
+        :rtype return: list
+        """
+        done = queue.Queue()
+        start = time.time()
+        deadline = start + self._timeout
+        for iid in iids:
+            future = self._waiter.register(iid, expected_state, deadline)
+            future.add_done_callback(done.put)
+
+        timed_out = []
+        for _ in iids:
+            future = done.get()
+            if self._tracer is not None:
+                self._tracer.add("wait %s" % expected_state, start,
+                                 time.time(), region=self._region,
+                                 instance=future.iid.instance_id)
+            if future.result() is False:
+                timed_out.append(future.iid)
+                continue
+            self.logger.info("Instance %s now %s !" %
+                             (future.iid.instance_id, expected_state))
+            if callback is not None:
+                callback(future.iid)
+        if len(timed_out) > 0:
+            self.logger.error("Timeout exceded for %s" %
+                              ', '.join(iid.instance_id for iid in timed_out))
+        return timed_out
+
+    def _create_inst_snap(self, iid):
+        """
+        Create instance snapshot
+
+        :param iid: EC2 instance ID
+        :type iid: str
+
+        :return rcode: 0 ok / 1 failed
+        :rtype: bool
+        """
+        rcode = 0
+
+        # Name cold and hot snapshots
+        if self._cold_snap is False:
+            stype = 'Hot'
+        else:
+            stype = 'Cold'
+
+        made = {}
+        if self._resumed is not None:
+            made = self._resumed['snapshots'].get(iid.instance_id, {})
+
+        if self._multi_volume is True and self._dry_run is False and \
+                len(made) == 0:
+            rcode = self._create_multi_volume_snap(iid, stype)
+            if rcode is not None:
+                return rcode
+            rcode = 0
+
+        for vol, device in self._snapshot_volumes(iid).items():
+            if vol in made:
+                self.logger.info("%s snapshot already made for %s(%s) - %s" %
+                                 (stype, vol, device, made[vol]))
+                continue
+            # Make snapshot
+            snap_name, snap_tags = self._snapshot_request(iid, vol, device,
+                                                          stype)
+            if self._dry_run is False:
+                try:
+                    with self._span('create snapshot', iid, volume=vol):
+                        snap_id = self._api.call(
+                            'create_snapshot', self._backend.create_snapshot,
+                            vol, snap_name, snap_tags)
+                except Exception as e:
+                    self.logger.critical("%s snapshot failed for %s(%s) [%s]" %
+                                         (stype, vol, device, e))
+                    rcode = 1
+                    continue
+                self._record('snapshot', instance=iid.instance_id,
+                             volume=vol, snapshot=snap_id.id)
+                self._index_snapshot(snap_id)
+                if self._tracker is not None:
+                    self._tracker.add(snap_id.id, vol, snap_id.volume_size)
+                self.logger.info("%s snapshot made for %s(%s) - %s" %
+                                 (stype, vol, device, snap_id.id))
+            else:
+                self.logger.info("%s snapshot made for %s(%s)" %
+                                 (stype, vol, device))
+        return rcode
+
+    def _snapshot_volumes(self, iid):
+        """
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :returns: devices of the volumes to snapshot by volume ID
+        :rtype return: dict
+        """
+        volumes = {}
+        for vol, device in iid.get_disks().items():
+            # Removing root device if required
+            if self._no_root_device is True and device == iid.root_dev:
+                self.logger.debug('Not snapshoting root device %s(%s)' %
+                                  (vol, device))
+                continue
+            volumes[vol] = device
+        return volumes
+
+    @staticmethod
+    def _snapshot_request(iid, vol, device, stype):
+        """
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :param vol: EC2 volume ID
+        :type vol: str
+
+        :param device: device of the volume
+        :type device: str
+
+        :param stype: snapshot type (Hot or Cold)
+        :type stype: str
+
+        :returns: description and tags of the snapshot of a volume
+        :rtype return: str, dict
+        """
+        description = ''.join([iid.instance_id, ' (', iid.name, ') - ',
+                               stype, ' ', device, ' (', vol, ')'])
+        return description, {'type': stype, 'volume': vol, 'device': device,
+                             'instance name': iid.name}
+
+    def _create_multi_volume_snap(self, iid, stype):
+        """
+        Snapshot every selected volume of an instance in a single call, all
+        the snapshots share the same point in time and get their tags at
+        creation
+
+        :param iid: EC2 instance ID
+        :type iid: Instance
+
+        :param stype: snapshot type (Hot or Cold)
+        :type stype: str
+
+        :return rcode: 0 ok / 1 failed / None to fall back on per volume
+                       snapshots
+        :rtype: int
+        """
+        disks = self._snapshot_volumes(iid)
+        if len(disks) == 0:
+            return 0
+
+        try:
+            with self._span('create snapshots', iid, volumes=len(disks)):
+                snapshots = self._api.call(
+                    'create_snapshots', self._backend.create_snapshots,
+                    iid.instance_id, self._no_root_device,
+                    ''.join([iid.instance_id, ' (', iid.name, ') - ', stype]),
+                    {'type': stype, 'instance name': iid.name})
+        except Exception as e:
+            if getattr(e, 'error_code', None) in UNSUPPORTED_CODES:
+                self.logger.warning("Multi-volume snapshots unavailable in "
+                                    "%s, using per volume snapshots [%s]" %
+                                    (self._region, e))
+                self._multi_volume = False
+            else:
+                self.logger.error("Multi-volume %s snapshot failed for %s, "
+                                  "using per volume snapshots [%s]" %
+                                  (stype, iid.instance_id, e))
+            return None
+
+        rcode = 0
+        created = set()
+        for snap_id in snapshots:
+            created.add(snap_id.volume_id)
+            device = disks.get(snap_id.volume_id, 'unknown')
+            self._record('snapshot', instance=iid.instance_id,
+                         volume=snap_id.volume_id, snapshot=snap_id.id)
+            self._index_snapshot(snap_id)
+            if self._tracker is not None:
+                self._tracker.add(snap_id.id, snap_id.volume_id,
+                                  snap_id.volume_size)
+            self.logger.info("%s snapshot made for %s(%s) - %s" %
+                             (stype, snap_id.volume_id, device, snap_id.id))
+        # Volumes attached after discovery are snapshoted too, volumes
+        # detached since are missing
+        for vol in set(disks) - created:
+            self.logger.critical("%s snapshot missing for %s(%s)" %
+                                 (stype, vol, disks[vol]))
+            rcode = 1
+        return rcode
+
+    def calulate_max_snap_age(self):
+        """
+        Calculate Snapshot age
+        """
+        self.logger.debug('Calculating max age')
+
+        # Check params
+        self._max_age[0] = int(self._max_age[0])
+        try:
+            self._max_age[0] == 0
+        except ValueError:
+            self.logger.error('Max age value cannot be 0')
+            sys.exit(1)
+        if self._max_age[0] == 0:
+            self.logger.error('Max age value cannot be 0')
+            sys.exit(1)
+
+        # Calculate the maximum allowed snapshot age
+        if self._max_age[1] in DURATION_UNITS:
+            self._max_age_sec = self._max_age[0] * \
+                DURATION_UNITS[self._max_age[1]]
+        else:
+            self.logger.error("Can't find the correct value (here %s),\
+                              please choose between s/m/h/d/w/M/y" %
+                              self._max_age[1])
+            sys.exit(1)
+
+    def mk_rm_snapshot(self):
+        """
+        Create and remove snapshot on selected Instances ids
+
+        :rtype: int, int
+        """
+        start = time.time()
+        self._run_policy = self._retention_policy()
+        instances = self._limited_instances()
+        if self._deadline is not None:
+            self._deadline_at = start + self._deadline
+            self._deferred = []
+
+        if self._apply_plan is not None and self._resumed is None and \
+                self._dry_run is False:
+            self._mark_plan_applied()
+        self._open_journal(instances)
+        self.open_pipeline()
+        self._pending_retention = []
+
+        if self._cold_snap is True and self._cold_batch > 0 and \
+                self._no_snap is False:
+            results = []
+            for offset in range(0, len(instances), self._cold_batch):
+                batch = instances[offset:offset + self._cold_batch]
+                results.extend(self._budgeted(self._cold_snap_batch, batch))
+        elif self._workers > 1:
+            results = self._run_workers(instances)
+        else:
+            results = [self._budgeted(self._process_instance, iid)
+                       for iid in instances]
+
+        if len(instances) < len(self._instances):
+            self.logger.info("The requested limit of snapshots has been reached: %s" % self._limit)
+        if len(self._deferred) > 0:
+            self.logger.warning("Deadline reached, %s instances deferred to "
+                                "the next run" % len(self._deferred))
+        if self._history is not None:
+            self._history.save()
+
+        pending, self._pending_retention = self._pending_retention, None
+        with self._span('retention', instances=len(pending)):
+            if self._apply_plan is not None:
+                self._apply_deletions()
+            else:
+                self._retention_pass(pending)
+
+        error_number = sum(r[0] for r in results)
+        with self._span('close pipeline'):
+            error_number += self.close_pipeline()
+        if len(self._copiers) > 0 and self._policy()[0].enabled():
+            with self._span('copy retention'):
+                self._copy_retention(instances)
+        old_snap_number = len(self._retention_failed |
+                              self._deleter.failed_owners)
+        if self._journal is not None:
+            self._record('end', snapshot_errors=error_number,
+                         deletion_errors=old_snap_number)
+            self._journal.close()
+            self._journal = None
+        self._run_seconds = time.time() - start
+        if self._tracer is not None:
+            self._tracer.add('run', start, time.time(), region=self._region,
+                             instances=len(instances))
+        return error_number, old_snap_number
+
+    def _new_copier(self, region):
+        """
+        Create the copy stage of a destination region
+
+        :param region: destination region
+        :type region: str
+
+        :rtype return: SnapshotCopier
+        """
+        backend = self._connect(region)
+        api = EC2Api(self._api_rate, concurrency=self._api_concurrency,
+                     logger=self.logger.name)
+        devices = dict((vol, (iid.name, device))
+                       for iid in self._instances
+                       for vol, device in iid.get_disks().items())
+
+        def copy(snapshot_id, volume_id):
+            name, device = devices.get(volume_id, ('', ''))
+            return api.call(
+                'copy_snapshot', backend.copy_snapshot, self._region,
+                snapshot_id, "Copy of %s (%s) from %s" % (
+                    snapshot_id, volume_id, self._region),
+                {'type': 'Copy', 'volume': volume_id, 'device': device,
+                 'instance name': name, 'source snapshot': snapshot_id,
+                 'source region': self._region})
+
+        def poll(snapshot_ids):
+            return dict((snapshot.id, (snapshot.status, snapshot.progress))
+                        for page in self._paginate(
+                            backend.describe_snapshots, api=api,
+                            snapshot_ids=snapshot_ids)
+                        for snapshot in page)
+
+        copier = SnapshotCopier(region, copy, poll, self._copy_concurrency,
+                                logger=self.logger.name)
+        copier.backend = backend
+        copier.api = api
+        return copier
+
+    def _copy_completed(self, snapshot_id, volume_id, size, status):
+        """
+        Queue a snapshot to every copy stage once completed
+
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+        """
+        for copier in self._copiers:
+            copier.submit(snapshot_id, volume_id, size, status)
+
+    def _copy_retention(self, instances):
+        """
+        Remove old copies in every destination region, with the retention
+        policy of the run
+
+        :param instances: EC2 instances
+        :type instances: list
+        """
+        volumes = [vol for iid in instances for vol in iid.get_disks()]
+        for copier in self._copiers:
+            deleter = SnapshotDeleter(
+                lambda snapshot_id, copier=copier: copier.api.call(
+                    'delete_snapshot', copier.backend.delete_snapshot,
+                    snapshot_id),
+                self._delete_workers, self._delete_rate,
+                logger=self.logger.name)
+            deleter.start()
+
+            def delete(snapshot, owner, vol, device, deleter=deleter,
+                       region=copier.region):
+                self.logger.info("Deleting copy %s in %s (%s|%s)" %
+                                 (snapshot.id, region, vol, device))
+                if self._dry_run is False:
+                    deleter.submit(snapshot, owner,
+                                   '|'.join([region, vol, device]))
+
+            copies = (CachedSnapshot(snapshot.id, snapshot.volume_id,
+                                     snapshot.start_time)
+                      for offset in range(0, len(volumes), FILTER_CHUNK)
+                      for page in self._paginate(
+                          copier.backend.describe_snapshot_copies,
+                          api=copier.api, source_region=self._region,
+                          volume_ids=volumes[offset:offset + FILTER_CHUNK])
+                      for snapshot in page)
+            self._retention_failed.update(self._select_old_snap(
+                instances, copies, delete, created=False))
+            deleter.close()
+            self._retention_failed.update(deleter.failed_owners)
+            if deleter.deleted > 0 or deleter.failed > 0:
+                self.logger.info("Deleted %s copies in %s, %s failed" %
+                                 (deleter.deleted, copier.region,
+                                  deleter.failed))
+
+    def _limited_instances(self):
+        """
+        :returns: selected instances within the requested limit
+        :rtype return: list of Instance
+        """
+        self.logger.debug("Limit: %s" % self._limit)
+        instances = self._instances
+        if self._deadline is not None:
+            instances = self._by_staleness(instances)
+        if self._limit != -1 and len(instances) > self._limit:
+            instances = instances[:self._limit]
+        return instances
+
+    def _by_staleness(self, instances):
+        """
+        Order instances from the one with the oldest snapshot, instances
+        without snapshot coming first and quicker instances first on ties
+
+        :param instances: EC2 instances
+        :type instances: list
+
+        :rtype return: list of Instance
+        """
+        def staleness(iid):
+            newest = self.last_snapshot_time(iid)
+            return (newest is not None, newest or 0,
+                    self._history.estimate(iid.instance_id,
+                                           self._mode(iid)) or 0)
+
+        return sorted(instances, key=staleness)
+
+    def _mode(self, iid):
+        """
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :returns: mode the instance is snapshotted with, 'cold' when it has
+                  to be stopped, otherwise 'hot'
+        :rtype return: str
+        """
+        if self._cold_snap is True and iid.initial_state == 'running':
+            return 'cold'
+        return 'hot'
+
+    def _admit(self, iid):
+        """
+        Tell if the work on an instance can start, that is if it is
+        estimated to end before the deadline or was left stopped by the
+        resumed run, instances which can not are deferred to the next run
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :rtype return: bool
+        """
+        # An instance left stopped by the resumed run must be started again
+        if self._deadline_at is None or \
+                self._resumed_step(iid, 'stopped'):
+            return True
+        estimate = self._history.estimate(iid.instance_id, self._mode(iid))
+        left = self._deadline_at - time.time()
+        if (estimate or 0) <= left:
+            return True
+        with self._index_lock:
+            self._deferred.append(iid.instance_id)
+        self.logger.warning("Deferring instance %s to the next run: %s "
+                            "estimated, %ss left" %
+                            (iid.instance_id,
+                             'unknown' if estimate is None else
+                             "%.0fs" % estimate, max(0, int(left))))
+        return False
+
+    def _account(self, iid, seconds):
+        """
+        Keep the time spent on an instance for the estimates of the next
+        runs
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :param seconds: time spent on the instance
+        :type seconds: float
+        """
+        if self._history is not None and self._dry_run is False and \
+                self._no_snap is False:
+            self._history.record(iid.instance_id, self._mode(iid), seconds)
+
+    def write_plan(self, path):
+        """
+        Write every action of a run to a plan file instead of making them
+
+        The plan is written as JSON lines: a header, then for each instance
+        its description and its stop, snapshot and start actions, then the
+        snapshots to delete. Deletions account for the snapshots the plan
+        makes. It is applied with the apply_plan argument.
+
+        :param path: plan file
+        :type path: str
+
+        :returns: number of instances whose retention could not be planned
+        :rtype return: int
+        """
+        self._run_policy = self._retention_policy()
+        instances = self._limited_instances()
+        stype = 'Cold' if self._cold_snap is True else 'Hot'
+        counts = collections.Counter()
+
+        with open(path + '.tmp', 'w') as plan:
+            def write(action, **fields):
+                fields['action'] = action
+                plan.write(json.dumps(fields, sort_keys=True) + '\n')
+                counts[action] += 1
+
+            write('plan', version=__version__, region=self._region,
+                  created=int(time.time()), cold_snap=self._cold_snap,
+                  no_snap=self._no_snap, multi_volume=self._multi_volume,
+                  no_root_device=self._no_root_device)
+            # Snapshots of the plan are newer than any listed one
+            planned = datetime.datetime.utcnow().strftime(SNAP_TIME_FORMAT)
+            for iid in instances:
+                write('instance', instance=iid.instance_id, name=iid.name,
+                      state=iid.initial_state, root_dev=iid.root_dev,
+                      tags=iid.tags)
+                if self._no_snap is True:
+                    continue
+                cold = self._cold_snap is True and \
+                    iid.initial_state == 'running'
+                if cold:
+                    write('stop', instance=iid.instance_id)
+                for vol, device in self._snapshot_volumes(iid).items():
+                    description, tags = self._snapshot_request(
+                        iid, vol, device, stype)
+                    write('snapshot', instance=iid.instance_id, volume=vol,
+                          device=device, description=description, tags=tags)
+                    with self._index_lock:
+                        self._created[vol] = CachedSnapshot(
+                            'planned-' + vol, vol, planned)
+                if cold:
+                    write('start', instance=iid.instance_id)
+
+            def delete(snapshot, owner, vol, device):
+                write('delete', snapshot=snapshot.id, volume=vol,
+                      device=device, instance=owner,
+                      start_time=snapshot.start_time)
+
+            failed = set()
+            if self._policy()[0].enabled():
+                failed = self._select_old_snap(
+                    instances, self._stream_snapshots(), delete)
+        os.rename(path + '.tmp', path)
+
+        self.logger.info("Plan written to %s: %s instances, %s stops, %s "
+                         "snapshots, %s deletions" %
+                         (path, counts['instance'], counts['stop'],
+                          counts['snapshot'], counts['delete']))
+        return len(failed)
+
+    def _load_plan_file(self, path):
+        """
+        Take the instances, their volumes to snapshot and the snapshot mode
+        from a plan file, without selecting and describing them
+
+        :param path: plan file written by write_plan
+        :type path: str
+        """
+        header = None
+        applied = None
+        instances = OrderedDict()
+        try:
+            with open(path) as plan:
+                for line in plan:
+                    step = json.loads(line)
+                    action = step['action']
+                    if action == 'plan':
+                        header = step
+                    elif action == 'applied':
+                        applied = step
+                    elif action == 'instance':
+                        instances[step['instance']] = Instance(
+                            step['instance'], step['name'], step['state'],
+                            step['root_dev'], step['tags'])
+                    elif action == 'snapshot':
+                        instances[step['instance']].add_disk(step['volume'],
+                                                             step['device'])
+        except (IOError, ValueError, KeyError) as e:
+            self.logger.critical("Can't read plan %s: %s" % (path, e))
+            sys.exit(1)
+        if header is None or header.get('region') != self._region:
+            self.logger.critical("Plan %s is not a plan of region %s" %
+                                 (path, self._region))
+            sys.exit(1)
+        # An interrupted apply is resumed from its journal, not applied again
+        if applied is not None:
+            self.logger.critical("Plan %s was already applied on %s" %
+                                 (path, time.strftime(
+                                     '%Y-%m-%d %H:%M:%S',
+                                     time.localtime(applied['time']))))
+            sys.exit(1)
+        age = time.time() - header['created']
+        if self._plan_max_age is not None and age > self._plan_max_age:
+            self.logger.critical("Plan %s was written %ss ago, more than the "
+                                 "%ss allowed" % (path, int(age),
+                                                  int(self._plan_max_age)))
+            sys.exit(1)
+
+        self._cold_snap = header['cold_snap']
+        self._no_snap = header['no_snap']
+        self._multi_volume = header['multi_volume']
+        self._no_root_device = header['no_root_device']
+        # Instances without snapshot left in the plan are not touched
+        self._instances = [iid for iid in instances.values()
+                           if len(iid.get_disks()) > 0]
+        self.logger.info("Applying plan %s of %s instances" %
+                         (path, len(self._instances)))
+
+    def _mark_plan_applied(self):
+        """
+        Record in the applied plan file that it was applied, before making
+        its first action
+        """
+        with open(self._apply_plan, 'a') as plan:
+            plan.write(json.dumps({'action': 'applied',
+                                   'time': int(time.time())},
+                                  sort_keys=True) + '\n')
+
+    def _apply_deletions(self):
+        """
+        Queue the deletions of the applied plan, read back from the file
+
+        Snapshots deleted by the resumed run are skipped, and volumes whose
+        planned snapshot was not made keep their snapshots.
+        """
+        deleted = set()
+        made = set(self._created)
+        if self._resumed is not None:
+            deleted = self._resumed['deleted']
+            for snapshots in self._resumed['snapshots'].values():
+                made.update(snapshots)
+        kept = set()
+        if self._dry_run is False and self._no_snap is False:
+            kept = set(vol for iid in self._instances
+                       for vol in self._snapshot_volumes(iid)
+                       if vol not in made)
+        for vol in sorted(kept):
+            self.logger.warning("Keeping the snapshots of %s, its planned "
+                                "snapshot was not made" % vol)
+        with open(self._apply_plan) as plan:
+            for line in plan:
+                step = json.loads(line)
+                if step['action'] != 'delete' or \
+                        step['snapshot'] in deleted or \
+                        step['volume'] in kept:
+                    continue
+                self._queue_deletion(
+                    CachedSnapshot(step['snapshot'], step['volume'],
+                                   step['start_time']),
+                    step['instance'], step['volume'], step['device'])
+
+    def _open_journal(self, instances):
+        """
+        Start the journal of the run with its plan, or continue the journal
+        of the resumed run
+
+        :param instances: instances of the run
+        :type instances: list
+        """
+        if self._journal_path is None:
+            return
+        if self._resumed is not None:
+            self._journal = RunJournal(self._journal_path, append=True,
+                                       logger=self.logger.name)
+            self._record('resume')
+            return
+        self._journal = RunJournal(self._journal_path,
+                                   logger=self.logger.name)
+        self._record('plan', region=self._region,
+                     cold_snap=self._cold_snap, no_snap=self._no_snap,
+                     instances=[{'id': iid.instance_id,
+                                 'name': iid.name,
+                                 'state': iid.initial_state,
+                                 'root_dev': iid.root_dev,
+                                 'tags': iid.tags,
+                                 'disks': iid.get_disks()}
+                                for iid in instances])
+
+    def _load_resumed(self, resumed):
+        """
+        Take the instances of the resumed run from its plan, without
+        selecting and describing them again
+
+        :param resumed: unfinished run, as returned by RunJournal.replay
+        :type resumed: dict
+        """
+        # Instances left stopped are only started again by the same mode
+        self._cold_snap = resumed['cold_snap']
+        self._no_snap = resumed['no_snap']
+        for planned in resumed['plan']:
+            iid = Instance(planned['id'], planned['name'], planned['state'],
+                           planned['root_dev'], planned['tags'])
+            for vol, device in planned['disks'].items():
+                iid.add_disk(vol, device)
+            self._instances.append(iid)
+        self.logger.info("Resuming a run of %s instances: %s done, %s left "
+                         "stopped, %s snapshots made, %s deleted" %
+                         (len(self._instances), len(resumed['done']),
+                          len(resumed['stopped']),
+                          sum(len(snapshots) for snapshots in
+                              resumed['snapshots'].values()),
+                          len(resumed['deleted'])))
+
+    def _record(self, event, **fields):
+        """
+        Record a step in the journal of the run, if any
+
+        :param event: step name
+        :type event: str
+        """
+        if self._journal is not None:
+            self._journal.record(event, **fields)
+
+    def _resumed_step(self, iid, step):
+        """
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :param step: 'stopped' or 'done'
+        :type step: str
+
+        :returns: True if the resumed run left the instance at this step
+        :rtype return: bool
+        """
+        return self._resumed is not None and \
+            iid.instance_id in self._resumed[step]
+
+    def open_pipeline(self):
+        """
+        Start the snapshot deleter and the snapshot tracker, done by
+        mk_rm_snapshot or once by a scheduler calling snapshot_instance
+        """
+        self._deleter = SnapshotDeleter(self._delete_snapshot,
+                                        self._delete_workers,
+                                        self._delete_rate,
+                                        on_deleted=self._forget_snapshot,
+                                        logger=self.logger.name)
+        self._deleter.start()
+        self._copiers = [self._new_copier(region)
+                         for region in self._copy_regions]
+        for copier in self._copiers:
+            copier.start()
+        if self._tracker is not None:
+            self._tracker.start()
+
+    def close_pipeline(self):
+        """
+        Wait for queued deletions and for created snapshots to complete
+
+        :returns: number of snapshots which ended in error state
+        :rtype return: int
+        """
+        elapsed = self._deleter.close()
+        if self._deleter.deleted > 0 or self._deleter.failed > 0:
+            self.logger.info("Deleted %s snapshots in %.1fs (%.1f/s), %s failed"
+                             % (self._deleter.deleted, elapsed,
+                                self._deleter.deleted / max(elapsed, 0.001),
+                                self._deleter.failed))
+
+        if self._tracker is None:
+            return 0
+        # Snapshots and their copies share a single '-W' wait
+        deadline = time.time() + self._wait_snapshots
+        self._tracking = self._tracker.finish(self._wait_snapshots)
+        aggregate = self._tracking['aggregate']
+        self.logger.info("Snapshots completed: %s/%s, %s failed%s" %
+                         (aggregate['completed'], aggregate['snapshots'],
+                          aggregate['errors'],
+                          " (%s GiB in %ss, %s GiB/s)" %
+                          (aggregate['size_gib'], aggregate['seconds'],
+                           aggregate['gib_per_second'])
+                          if 'seconds' in aggregate else ''))
+        # Copies of completed snapshots get what is left of the wait
+        copy_errors = 0
+        if len(self._copiers) > 0:
+            self._copy_tracking = {}
+            for copier in self._copiers:
+                tracking = copier.finish(max(0, deadline - time.time()))
+                self._copy_tracking[copier.region] = tracking
+                copy_errors += tracking['aggregate']['errors'] + \
+                    copier.failed
+        # Snapshots which ended in error state failed
+        return aggregate['errors'] + copy_errors
+
+    @property
+    def instances(self):
+        """
+        :returns: selected instances
+        :rtype return: list of Instance
+        """
+        return list(self._instances)
+
+    def refresh_inventory(self):
+        """
+        Select and describe instances again and drop the newest snapshot
+        times, so a long running process follows changes made out of it
+
+        :returns: selected instances
+        :rtype return: list of Instance
+        """
+        instances = self._instances
+        self._instances = []
+        try:
+            self._set_instance_info(self._filter_instances())
+        except SystemExit:
+            # Keep the previous inventory, the next refresh will retry
+            self._instances = instances
+            raise RuntimeError('Could not select instances')
+        with self._index_lock:
+            self._newest = None
+        return self.instances
+
+    def last_snapshot_time(self, iid):
+        """
+        Time of the newest snapshot of an instance
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :returns: Unix time of the oldest of the newest snapshot of each
+                  volume, None if a volume has no snapshot
+        :rtype return: float
+        """
+        index = self._newest_snapshots()
+        newest = []
+        for vol in iid.get_disks():
+            if vol not in index:
+                return None
+            newest.append(calendar.timegm(index[vol].timetuple()))
+        if len(newest) == 0:
+            return None
+        return min(newest)
+
+    def snapshot_instance(self, iid):
+        """
+        Create and remove snapshots of one instance outside of
+        mk_rm_snapshot, open_pipeline must have been called
+
+        Retention is evaluated against the time of the call.
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :returns: number of snapshot errors, number of deletion errors
+        :rtype return: int, int
+        """
+        self._retention_failed.discard(iid.instance_id)
+        return self._budgeted(self._process_instance, iid,
+                              self._retention_policy())
+
+    def write_report(self, prefix, error_number, old_snap_number):
+        """
+        Write the run profile as JSON and as a Prometheus textfile collector
+        file, in prefix.json and prefix.prom
+
+        :param prefix: path of the report files without extension
+        :type prefix: str
+
+        :param error_number: number of snapshot errors
+        :type error_number: int
+
+        :param old_snap_number: number of snapshot deletion errors
+        :type old_snap_number: int
+        """
+        operations = self._api.metrics.report()
+        report = {'version': __version__,
+                  'region': self._region,
+                  'timestamp': int(time.time()),
+                  'seconds': round(self._run_seconds, 3),
+                  'instances': len(self._instances),
+                  'snapshot_errors': error_number,
+                  'deletion_errors': old_snap_number,
+                  'operations': operations}
+        if self._shard is not None:
+            report['shard'] = "%s/%s" % self._shard
+        if self._deleter is not None:
+            report['deleted_snapshots'] = self._deleter.deleted
+        if self._tracking is not None:
+            report['snapshot_progress'] = self._tracking
+        if self._copy_tracking is not None:
+            report['copies'] = self._copy_tracking
+        if self._deadline is not None:
+            report['deadline'] = self._deadline
+            report['deferred'] = list(self._deferred)
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP simplec2snap_%s %s" % (name, help))
+            lines.append("# TYPE simplec2snap_%s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("simplec2snap_%s%s{%s} %s" % (
+                    name, suffix,
+                    ','.join('%s="%s"' % label for label in labels), value))
+
+        # Runs of several targets or jobs in one region write apart
+        target = ('target', self._name or self._region)
+        region = ('region', self._region)
+        metric('run_seconds', 'gauge', 'Duration of the last run',
+               [('', [target, region], report['seconds'])])
+        metric('last_run_timestamp_seconds', 'gauge', 'End of the last run',
+               [('', [target, region], report['timestamp'])])
+        metric('snapshot_errors', 'gauge', 'Snapshot errors of the last run',
+               [('', [target, region], error_number)])
+        metric('deletion_errors', 'gauge',
+               'Snapshot deletion errors of the last run',
+               [('', [target, region], old_snap_number)])
+        if self._deadline is not None:
+            metric('deferred_instances', 'gauge',
+                   'Instances deferred by the deadline of the last run',
+                   [('', [target, region], len(self._deferred))])
+        for name, help in (('calls', 'EC2 calls, retries included'),
+                           ('retries', 'EC2 calls retried'),
+                           ('throttled', 'EC2 calls throttled'),
+                           ('errors', 'EC2 calls failed after retries')):
+            metric("api_%s_total" % name, 'counter', help,
+                   [('', [target, region, ('operation', op)], operations[op][name])
+                    for op in sorted(operations)])
+        samples = []
+        for op in sorted(operations):
+            labels = [target, region, ('operation', op)]
+            for bound in LATENCY_BUCKETS:
+                le = bucket_label(bound)
+                samples.append(('_bucket', labels + [('le', le)],
+                                operations[op]['latency_buckets'][le]))
+            samples.append(('_sum', labels, operations[op]['seconds']))
+            samples.append(('_count', labels, operations[op]['calls']))
+        metric('api_call_duration_seconds', 'histogram',
+               'Duration of EC2 calls', samples)
+        if self._copy_tracking is not None:
+            copies = [(dest, tracking['aggregate']) for dest, tracking in
+                      sorted(self._copy_tracking.items())]
+            for name, key, help in (
+                    ('copies_completed', 'completed',
+                     'Snapshot copies completed in the last run'),
+                    ('copy_errors', 'errors',
+                     'Snapshot copies in error in the last run'),
+                    ('copy_max_queue_depth', 'max_queue_depth',
+                     'Largest number of snapshots waiting for a copy slot'),
+                    ('copy_gib_per_second', 'gib_per_second',
+                     'Copy throughput of the last run')):
+                metric(name, 'gauge', help,
+                       [('', [target, region, ('destination', dest)],
+                         aggregate.get(key, 0))
+                        for dest, aggregate in copies])
+
+        # Write then rename so collectors never read a partial file
+        for extension, content in (('json', json.dumps(report, indent=2,
+                                                       sort_keys=True)),
+                                   ('prom', '\n'.join(lines))):
+            path = '.'.join([prefix, extension])
+            with open(path + '.tmp', 'w') as report_file:
+                report_file.write(content + '\n')
+            os.rename(path + '.tmp', path)
+        self.logger.info("Run profile written to %s.json and %s.prom" %
+                         (prefix, prefix))
+
+    def _budgeted(self, function, *args):
+        """
+        Call a function holding a slot of the shared budget, if any
+
+        :param function: function to call
+        :type function: function
+
+        :returns: result of the function
+        """
+        if self._budget is None:
+            return function(*args)
+        with self._budget:
+            return function(*args)
+
+    def _run_workers(self, instances):
+        """
+        Process instances concurrently with a bounded pool of threads
+
+        Each worker thread is named after the instance it works on so log
+        lines can be attributed with %(threadName)s.
+
+        :param instances: instances to process
+        :type instances: list
+
+        :returns: (error, old snapshot error) per instance
+        :rtype return: list
+        """
+        jobs = queue.Queue()
+        for iid in instances:
+            jobs.put(iid)
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    iid = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                threading.current_thread().name = '/'.join(
+                    filter(None, [self._name, iid.instance_id]))
+                try:
+                    result = self._budgeted(self._process_instance, iid)
+                except Exception as e:
+                    self.logger.critical("Unexpected error on instance %s: %s"
+                                         % (iid.instance_id, e))
+                    result = (1, 0)
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self._workers, len(instances)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _process_instance(self, iid, policy=None):
+        """
+        Create and remove snapshots of one instance
+
+        :param iid: EC2 instance
+        :type iid: object
+
+        :param policy: retention policy and reference time, the ones of the
+                       run by default
+        :type policy: tuple
+
+        :returns: number of snapshot errors, number of deletion errors
+        :rtype return: int, int
+        """
+        if self._admit(iid) is False:
+            return 0, 0
+        start = time.time()
+        with self._span('instance', iid):
+            result = self._instance_steps(iid, policy)
+        self._account(iid, time.time() - start)
+        return result
+
+    def _instance_steps(self, iid, policy=None):
+        """
+        Stop, snapshot and start an instance, then remove its old
+        snapshots
+
+        :param iid: EC2 instance
+        :type iid: object
+
+        :param policy: retention policy and reference time, the ones of the
+                       run by default
+        :type policy: tuple
+
+        :returns: number of snapshot errors, number of deletion errors
+        :rtype return: int, int
+        """
+        error_number = 0
+        old_snap_number = 0
+
+        self.logger.info("Working on instance %s (%s)" %
+                         (iid.instance_id, iid.name))
+
+        done = self._resumed_step(iid, 'done')
+        if done is True:
+            self.logger.info('Instance was done by the resumed run')
+
+        if self._no_snap is False and done is False:
+            # Pausing VM and skip if failed
+            self.logger.debug("Initial_state: %s, No hot snap: %s, Dry run: %s" %
+                              (iid.initial_state, self._cold_snap, self._dry_run))
+            if iid.initial_state == 'running':
+                if self._cold_snap is True:
+                    self.logger.info('Instance is going to be shutdown')
+                if self._cold_snap is True and self._dry_run is False:
+                    if self._resumed_step(iid, 'stopped'):
+                        self.logger.info('Instance was left stopped by the '
+                                         'resumed run')
+                    else:
+                        try:
+                            with self._span('stop', iid):
+                                self._api.call('stop_instances',
+                                               self._backend.stop_instances,
+                                               instance_ids=[iid.instance_id])
+                        except Exception as e:
+                            self.logger.critical("Instance failed to stop: "
+                                                 "%s" % e)
+                            return 1, 0
+                        self._record('stopped', instance=iid.instance_id)
+                    if self._check_inst_state(iid, 'stopped') is False:
+                        return 0, 0
+
+            # Creating Snapshots
+            with self._span('snapshot', iid):
+                rcode = self._create_inst_snap(iid)
+            if rcode != 0:
+                error_number += 1
+
+            # Starting VM if was running
+            if iid.initial_state == 'running':
+                if self._cold_snap is True:
+                    self.logger.info('Instance is going to be started')
+                if self._cold_snap is True and self._dry_run is False:
+                    try:
+                        with self._span('start', iid):
+                            self._api.call('start_instances',
+                                           self._backend.start_instances,
+                                           instance_ids=[iid.instance_id])
+                    except Exception as e:
+                        self.logger.critical("Instance failed to start: %s"
+                                             % e)
+                        # Only increment errors if snapshot succeed
+                        if rcode == 0:
+                            error_number += 1
+                    else:
+                        self._record('started', instance=iid.instance_id)
+                    self._check_inst_state(iid, 'running')
+
+            if error_number == 0:
+                self._record('done', instance=iid.instance_id)
+
+        old_snap_number += self._retention(iid, policy)
+        return error_number, old_snap_number
+
+    def _retention(self, iid, policy=None):
+        """
+        Delete old snapshots of an instance if retention is requested
+
+        :param iid: EC2 instance
+        :type iid: object
+
+        :param policy: retention policy and reference time, the ones of the
+                       run by default
+        :type policy: tuple
+
+        :returns: 1 if deletion failed, 0 otherwise
+        :rtype return: int
+        """
+        if self._policy(policy)[0].enabled():
+            if self._pending_retention is not None:
+                # Done by mk_rm_snapshot for all the instances at once
+                with self._index_lock:
+                    self._pending_retention.append(iid)
+                return 0
+            if self._remove_old_snap(iid, policy) != 0:
+                self._retention_failed.add(iid.instance_id)
+                return 1
+        return 0
+
+    def _cold_snap_batch(self, batch):
+        """
+        Cold snapshot a batch of instances
+
+        Running instances are stopped with a single call and polled together.
+        Each instance is snapshotted as soon as it is stopped, then all of
+        them are started again with a single call.
+
+        :param batch: instances to process
+        :type batch: list
+
+        :returns: (error, old snapshot error) per instance
+        :rtype return: list
+        """
+        batch = [iid for iid in batch if self._admit(iid)]
+        start = time.time()
+        errors = dict((iid.instance_id, 0) for iid in batch)
+        to_stop = []
+        for iid in batch:
+            self.logger.info("Working on instance %s (%s)" %
+                             (iid.instance_id, iid.name))
+            if self._resumed_step(iid, 'done'):
+                self.logger.info('Instance %s was done by the resumed run' %
+                                 iid.instance_id)
+            elif iid.initial_state == 'running':
+                self.logger.info('Instance %s is going to be shutdown' %
+                                 iid.instance_id)
+                to_stop.append(iid)
+
+        def snapshot(iid):
+            if self._resumed_step(iid, 'done'):
+                return
+            with self._span('snapshot', iid):
+                if self._create_inst_snap(iid) != 0:
+                    errors[iid.instance_id] += 1
+
+        # Instances which are not running can be snapshotted right away
+        for iid in batch:
+            if iid not in to_stop or self._dry_run is True:
+                snapshot(iid)
+
+        stopped = []
+        if len(to_stop) > 0 and self._dry_run is False:
+            # Instances left stopped by the resumed run are not stopped again
+            waiting = [iid for iid in to_stop
+                       if self._resumed_step(iid, 'stopped')]
+            to_call = [iid for iid in to_stop if iid not in waiting]
+            if len(to_call) > 0:
+                try:
+                    with self._span('stop', instances=len(to_call)):
+                        self._api.call(
+                            'stop_instances', self._backend.stop_instances,
+                            instance_ids=[iid.instance_id for iid in to_call])
+                except Exception as e:
+                    self.logger.critical("Instances failed to stop: %s" % e)
+                    for iid in to_call:
+                        errors[iid.instance_id] += 1
+                else:
+                    for iid in to_call:
+                        self._record('stopped', instance=iid.instance_id)
+                    waiting.extend(to_call)
+
+            def on_stopped(iid):
+                stopped.append(iid)
+                snapshot(iid)
+
+            if len(waiting) > 0:
+                self._check_batch_state(waiting, 'stopped', on_stopped)
+
+        # Starting VMs which were running
+        for iid in to_stop:
+            self.logger.info('Instance %s is going to be started' %
+                             iid.instance_id)
+        if len(stopped) > 0:
+            try:
+                with self._span('start', instances=len(stopped)):
+                    self._api.call(
+                        'start_instances', self._backend.start_instances,
+                        instance_ids=[iid.instance_id for iid in stopped])
+            except Exception as e:
+                self.logger.critical("Instances failed to start: %s" % e)
+                # Only increment errors if snapshot succeed
+                for iid in stopped:
+                    if errors[iid.instance_id] == 0:
+                        errors[iid.instance_id] += 1
+            else:
+                for iid in stopped:
+                    self._record('started', instance=iid.instance_id)
+            self._check_batch_state(stopped, 'running')
+
+        results = []
+        for iid in batch:
+            # Instances which never stopped are skipped as in the serial mode
+            if iid in to_stop and iid not in stopped and self._dry_run is False:
+                results.append((errors[iid.instance_id], 0))
+            else:
+                if errors[iid.instance_id] == 0 and \
+                        not self._resumed_step(iid, 'done'):
+                    self._record('done', instance=iid.instance_id)
+                results.append((errors[iid.instance_id], self._retention(iid)))
+        # The instances of a batch are stopped and started together
+        for iid in batch:
+            if not self._resumed_step(iid, 'done'):
+                self._account(iid, time.time() - start)
+        return results
+
+    def _stream_snapshots(self, volume_ids=None):
+        """
+        Iterate over the snapshots owned by the account page by page,
+        without holding the listing in memory
+
+        A full listing refreshes the cache as it goes and marks it complete
+        at the end, a cached listing is read back in pages.
+
+        :param volume_ids: EC2 volume IDs, None for every snapshot
+        :type volume_ids: list
+
+        :returns: generator of snapshots with id, volume_id and start_time
+        :rtype return: generator
+        """
+        if self._cache is not None and self._cache.is_fresh('snapshots'):
+            self.logger.debug('Using cached snapshots')
+            for snapshot in self._cache.iter_snapshots(volume_ids):
+                yield snapshot
+            return
+
+        if volume_ids is not None:
+            volume_ids = list(volume_ids)
+            self.logger.debug("Listing snapshots of %s volumes" %
+                              len(volume_ids))
+            for offset in range(0, len(volume_ids), FILTER_CHUNK):
+                chunk = volume_ids[offset:offset + FILTER_CHUNK]
+                for page in self._paginate(self._backend.describe_snapshots,
+                                           filters={'volume-id': chunk}):
+                    for snapshot in page:
+                        yield CachedSnapshot(snapshot.id, snapshot.volume_id,
+                                             snapshot.start_time)
+            return
+
+        self.logger.debug('Listing owned snapshots')
+        if self._cache is not None:
+            # Not complete until the last page is stored
+            self._cache.set_meta('snapshots', None)
+        count = 0
+        for page in self._paginate(self._backend.describe_snapshots):
+            page = [CachedSnapshot(snapshot.id, snapshot.volume_id,
+                                   snapshot.start_time) for snapshot in page]
+            if self._cache is not None:
+                self._cache.store_snapshots(page, replace=count == 0)
+            count += len(page)
+            for snapshot in page:
+                yield snapshot
+        if self._cache is not None:
+            self._cache.set_meta('snapshots', count)
+
+    def _newest_snapshots(self):
+        """
+        Time of the newest snapshot of each volume, listed once
+
+        :returns: naive UTC datetime by volume ID
+        :rtype return: dict
+        """
+        with self._index_lock:
+            if self._newest is None:
+                newest = {}
+                for snapshot in self._stream_snapshots():
+                    try:
+                        timestamp = parse_start_time(snapshot.start_time)
+                    except ValueError:
+                        continue
+                    newest[snapshot.volume_id] = max(
+                        timestamp, newest.get(snapshot.volume_id, timestamp))
+                self._newest = newest
+            return self._newest
+
+    def _index_snapshot(self, snapshot):
+        """
+        Account a snapshot created during the run
+
+        :param snapshot: EC2 snapshot
+        :type snapshot: object
+        """
+        snapshot = CachedSnapshot(snapshot.id, snapshot.volume_id,
+                                  snapshot.start_time)
+        with self._index_lock:
+            self._created[snapshot.volume_id] = snapshot
+            if self._newest is not None:
+                timestamp = parse_start_time(snapshot.start_time)
+                self._newest[snapshot.volume_id] = max(
+                    timestamp, self._newest.get(snapshot.volume_id, timestamp))
+        if self._cache is not None:
+            self._cache.store_snapshots([snapshot])
+
+    def _delete_snapshot(self, snapshot_id):
+        """
+        Delete a snapshot from its ID
+
+        :param snapshot_id: EC2 snapshot ID
+        :type snapshot_id: str
+        """
+        try:
+            self._api.call('delete_snapshot', self._backend.delete_snapshot,
+                           snapshot_id)
+        except Exception as e:
+            # Deleted since it was listed, by a previous run or by hand
+            if getattr(e, 'error_code', None) not in MISSING_SNAPSHOT_CODES:
+                raise
+            self.logger.info("Snapshot %s was already deleted" % snapshot_id)
+
+    def _forget_snapshot(self, snapshot):
+        """
+        Remove a deleted snapshot from the cache
+
+        :param snapshot: EC2 snapshot
+        :type snapshot: object
+        """
+        self._record('deleted', snapshot=snapshot.id,
+                     volume=snapshot.volume_id)
+        if self._cache is not None:
+            self._cache.remove_snapshot(snapshot.id)
+
+    def _retention_policy(self):
+        """
+        Retention policy, with the current time as reference time
+
+        :returns: policy and reference time
+        :rtype return: RetentionPolicy, datetime
+        """
+        return (RetentionPolicy(self._max_age_sec, self._keep_last_snapshots,
+                                self._gfs),
+                datetime.datetime.utcnow())
+
+    def _policy(self, policy=None):
+        """
+        Retention policy to apply, computed once by run and never reset
+        from the worker threads
+
+        :param policy: retention policy and reference time of a single
+                       instance, the ones of the run by default
+        :type policy: tuple
+
+        :returns: policy and reference time
+        :rtype return: RetentionPolicy, datetime
+        """
+        if policy is not None:
+            return policy
+        if self._run_policy is not None:
+            return self._run_policy
+        # Out of a run, the time of the call
+        return self._retention_policy()
+
+    def _remove_old_snap(self, iid, policy=None):
+        """
+        Remove old snapshots, deletions are queued to the snapshot deleter
+
+        :param iid: EC2 instance ID
+        :type iid: object
+
+        :param policy: retention policy and reference time, the ones of the
+                       run by default
+        :type policy: tuple
+
+        :rtype: bool
+        """
+        with self._span('retention', iid):
+            failed = self._select_old_snap(
+                [iid], self._stream_snapshots(iid.get_disks()),
+                policy=policy)
+        return 1 if len(failed) > 0 else 0
+
+    def _retention_pass(self, instances):
+        """
+        Remove old snapshots of instances with a single streamed listing of
+        the snapshots owned by the account, or of the snapshots of their
+        volumes for a job of a shared inventory
+
+        :param instances: EC2 instances
+        :type instances: list
+        """
+        if len(instances) == 0:
+            return
+        # Jobs would otherwise list every snapshot of the account each
+        volume_ids = None
+        if self._inventory is not None:
+            volume_ids = [vol for iid in instances for vol in iid.get_disks()]
+        self._retention_failed.update(
+            self._select_old_snap(instances,
+                                  self._stream_snapshots(volume_ids)))
+
+    def _queue_deletion(self, snapshot, owner, vol, device):
+        """
+        Queue a snapshot selected by retention to the snapshot deleter
+
+        :param snapshot: EC2 snapshot
+        :type snapshot: object
+
+        :param owner: instance ID the snapshot is deleted for
+        :type owner: str
+
+        :param vol: EC2 volume ID
+        :type vol: str
+
+        :param device: device of the volume
+        :type device: str
+        """
+        self.logger.info("Deleting snapshot %s (%s|%s)" %
+                         (snapshot.id, vol, device))
+        if self._dry_run is False:
+            self._deleter.submit(snapshot, owner, '|'.join([vol, device]))
+
+    def _select_old_snap(self, instances, snapshots, delete=None,
+                         created=True, policy=None):
+        """
+        Offer snapshots to a retention selector per volume, deletions are
+        queued to the snapshot deleter as soon as they are decided
+
+        Memory is bounded by the retention policy and the number of
+        volumes, not by the number of snapshots.
+
+        :param instances: EC2 instances
+        :type instances: list
+
+        :param snapshots: snapshots with id, volume_id and start_time
+        :type snapshots: iterable
+
+        :param delete: called with each snapshot to delete, its instance
+                       ID, volume and device, _queue_deletion by default
+        :type delete: function
+
+        :param created: also offer the snapshots created during the run,
+                        which the listing may lack
+        :type created: bool
+
+        :param policy: retention policy and reference time, the ones of the
+                       run by default
+        :type policy: tuple
+
+        :returns: IDs of the instances whose retention failed
+        :rtype return: set
+        """
+        if delete is None:
+            delete = self._queue_deletion
+        policy, now = self._policy(policy)
+        volumes = {}
+        for iid in instances:
+            for vol, device in iid.get_disks().items():
+                volumes[vol] = (iid.instance_id, device,
+                                policy.selector(now))
+        failed = set()
+
+        def offer(snapshot):
+            if snapshot.volume_id not in volumes:
+                return
+            owner, device, selector = volumes[snapshot.volume_id]
+            self.logger.debug("Volume %s(%s) has snapshot %s on %s" %
+                              (snapshot.volume_id, device, snapshot.id,
+                               snapshot.start_time))
+            try:
+                to_delete = selector.offer(snapshot)
+            except ValueError as e:
+                self.logger.error("Could not read snapshot dates of %s: %s" %
+                                  (snapshot.volume_id, e))
+                failed.add(owner)
+                del volumes[snapshot.volume_id]
+                return
+            for old in to_delete:
+                delete(old, owner, snapshot.volume_id, device)
+
+        try:
+            for snapshot in snapshots:
+                offer(snapshot)
+        except Exception as e:
+            self.logger.critical("Could not list snapshots: %s" % e)
+            return set(iid.instance_id for iid in instances)
+        if created is True:
+            with self._index_lock:
+                created = [self._created.pop(vol) for vol in list(volumes)
+                           if vol in self._created]
+            for snapshot in created:
+                offer(snapshot)
+        return failed
+
+
+class SnapshotScheduler:
+    """
+    Long running scheduler of snapshot and retention jobs
+
+    The manager keeps its connections, its inventory and the time of the
+    newest snapshot of each volume between jobs. Each instance gets a job
+    every interval, given by its snap:interval tag or the default interval,
+    and never two jobs at the same time: a job coming due while the
+    previous one is still queued or running is skipped.
+    """
+
+    def __init__(self, manager, interval, workers=1, refresh=900,
+                 listen=None, logger=__name__):
+        """
+        :param manager: manager with instances selected
+        :type manager: ManageSnapshot
+
+        :param interval: default seconds between jobs of an instance
+        :type interval: int
+
+        :param workers: number of jobs run concurrently
+        :type workers: int
+
+        :param refresh: seconds between inventory refreshes
+        :type refresh: int
+
+        :param listen: host and port of the status endpoint, None to disable
+        :type listen: tuple
+
+        :param logger: logger name
+        :type logger: str
+        """
+        self._manager = manager
+        self._interval = interval
+        self._workers = max(workers, 1)
+        self._refresh = refresh
+        self._listen = listen
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._jobs = queue.Queue()
+        self._instances = {}
+        self._intervals = {}
+        self._due = {}
+        self._queued = set()
+        self._running = set()
+        self._last_runs = {}
+        self._skipped = 0
+        self._started = time.time()
+        self._refreshed = None
+        self._server = None
+        self.logger = logging.getLogger(logger)
+
+    def interval(self, iid):
+        """
+        Seconds between jobs of an instance
+
+        :param iid: EC2 instance
+        :type iid: Instance
+
+        :rtype return: int
+        """
+        value = iid.tags.get(INTERVAL_TAG)
+        if value is None:
+            return self._interval
+        try:
+            return parse_duration(value)
+        except ValueError as e:
+            self.logger.warning("%s of %s: %s, using the default interval" %
+                                (INTERVAL_TAG, iid.instance_id, e))
+            return self._interval
+
+    def update(self, instances):
+        """
+        Schedule new instances and forget the ones no longer selected
+
+        A new instance is due one interval after its newest snapshot, right
+        away if it has none, so restarting the daemon does not snapshot
+        the whole fleet again.
+
+        :param instances: selected instances
+        :type instances: list of Instance
+        """
+        now = time.time()
+        intervals = dict((iid.instance_id, self.interval(iid))
+                         for iid in instances)
+        due = {}
+        for iid in instances:
+            if iid.instance_id in self._due:
+                continue
+            try:
+                last = self._manager.last_snapshot_time(iid)
+            except Exception as e:
+                self.logger.error("Could not list snapshots: %s" % e)
+                last = None
+            due[iid.instance_id] = now if last is None else \
+                max(now, last + intervals[iid.instance_id])
+
+        with self._lock:
+            self._instances = dict((iid.instance_id, iid)
+                                   for iid in instances)
+            self._intervals = intervals
+            for instance_id in list(self._due):
+                if instance_id not in self._instances:
+                    del self._due[instance_id]
+            self._due.update(due)
+            self._refreshed = now
+        self.logger.info("%s instances scheduled, %s new" %
+                         (len(instances), len(due)))
+
+    def dispatch(self, now):
+        """
+        Queue the jobs which are due
+
+        :param now: current Unix time
+        :type now: float
+
+        :returns: number of jobs queued
+        :rtype return: int
+        """
+        queued = 0
+        with self._lock:
+            for instance_id, when in self._due.items():
+                if when > now:
+                    continue
+                iid = self._instances[instance_id]
+                self._due[instance_id] = now + self._intervals[instance_id]
+                if instance_id in self._queued or \
+                        instance_id in self._running:
+                    self._skipped += 1
+                    self.logger.warning("Previous job of %s still running, "
+                                        "skipping this one" % instance_id)
+                    continue
+                self._queued.add(instance_id)
+                self._jobs.put(iid)
+                queued += 1
+        return queued
+
+    def _worker(self):
+        """
+        Run queued jobs until a None job is received
+        """
+        while True:
+            iid = self._jobs.get()
+            if iid is None:
+                return
+            with self._lock:
+                self._queued.discard(iid.instance_id)
+                self._running.add(iid.instance_id)
+            threading.current_thread().name = iid.instance_id
+            start = time.time()
+            try:
+                result = self._manager.snapshot_instance(iid)
+            except Exception as e:
+                self.logger.critical("Unexpected error on instance %s: %s" %
+                                     (iid.instance_id, e))
+                result = (1, 0)
+            with self._lock:
+                self._running.discard(iid.instance_id)
+                self._last_runs[iid.instance_id] = {
+                    'start': int(start),
+                    'seconds': round(time.time() - start, 3),
+                    'snapshot_errors': result[0],
+                    'deletion_errors': result[1]}
+
+    def status(self):
+        """
+        State of the scheduler, served by the status endpoint
+
+        :rtype return: dict
+        """
+        with self._lock:
+            jobs = {}
+            for instance_id, when in self._due.items():
+                job = {'next_run': int(when),
+                       'interval': self._intervals[instance_id]}
+                if instance_id in self._last_runs:
+                    job['last_run'] = self._last_runs[instance_id]
+                jobs[instance_id] = job
+            return {'version': __version__,
+                    'uptime': int(time.time() - self._started),
+                    'last_refresh': int(self._refreshed or 0),
+                    'instances': len(self._instances),
+                    'queue_depth': len(self._queued),
+                    'running': sorted(self._running),
+                    'skipped_overlaps': self._skipped,
+                    'jobs': jobs}
+
+    def _serve_status(self):
+        """
+        Serve the status as JSON over HTTP from a background thread
+        """
+        scheduler = self
+
+        class StatusHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(scheduler.status(), indent=2,
+                                  sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, format, *args):
+                scheduler.logger.debug("Status request: " + format % args)
+
+        self._server = http.server.HTTPServer(self._listen, StatusHandler)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='status')
+        thread.daemon = True
+        thread.start()
+        self.logger.info("Status served on http://%s:%s/" % self._listen)
+
+    def stop(self):
+        """
+        Ask the scheduler to stop once running jobs are done
+        """
+        self._stop.set()
+
+    def run(self):
+        """
+        Schedule jobs until stop is called
+
+        :returns: number of jobs which had errors
+        :rtype return: int
+        """
+        self._manager.open_pipeline()
+        if self._listen is not None:
+            self._serve_status()
+        threads = []
+        for number in range(self._workers):
+            thread = threading.Thread(target=self._worker,
+                                      name="worker-%s" % number)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        self.update(self._manager.instances)
+        next_refresh = time.time() + self._refresh
+        while not self._stop.is_set():
+            now = time.time()
+            if now >= next_refresh:
+                next_refresh = now + self._refresh
+                try:
+                    self.update(self._manager.refresh_inventory())
+                except Exception as e:
+                    self.logger.error("Inventory refresh failed: %s" % e)
+            self.dispatch(now)
+            self._stop.wait(1)
+
+        self.logger.info('Stopping, waiting for running jobs')
+        with self._lock:
+            self._due.clear()
+            # Drop jobs which did not start
+            while True:
+                try:
+                    self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+            self._queued.clear()
+        for thread in threads:
+            self._jobs.put(None)
+        for thread in threads:
+            thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+        self._manager.close_pipeline()
+        return len([run for run in self._last_runs.values()
+                    if run['snapshot_errors'] or run['deletion_errors']])
+
+
+def new_manager(arg, region, key_id, access_key, **options):
+    """
+    Create the manager of a region from the command line arguments, which
+    selects the instances
+
+    :param arg: command line arguments
+    :type arg: Namespace
+
+    :param region: EC2 region
+    :type region: str
+
+    :param key_id: EC2 key identifier
+    :type key_id: str
+
+    :param access_key: EC2 access key
+    :type access_key: str
+
+    :param options: other ManageSnapshot arguments
+    :type options: dict
+
+    :returns: the manager
+    :rtype return: ManageSnapshot
+    """
+    # Create action
+    selected_instances = ManageSnapshot(region, key_id, access_key,
+                                        list(arg.instance), arg.tags,
+                                        arg.dry_run, arg.timeout,
+                                        arg.cold_snap, arg.limit,
+                                        arg.no_root_device, list(arg.max_age),
+                                        arg.no_snap,
+                                        arg.keep_last_snapshots,
+                                        **options)
+    # Calculate max snapshot age
+    if len(arg.max_age) > 0:
+        selected_instances.calulate_max_snap_age()
+    return selected_instances
+
+
+def run_daemon(arg, options):
+    """
+    Keep running and snapshot each selected instance at its interval
+
+    :param arg: command line arguments
+    :type arg: Namespace
+
+    :param options: other ManageSnapshot arguments
+    :type options: dict
+
+    :returns: exit status
+    :rtype return: int
+    """
+    try:
+        interval = parse_duration(arg.interval)
+    except ValueError as e:
+        print(e)
+        return 1
+    listen = None
+    if arg.status is not None:
+        host, _, port = arg.status.rpartition(':')
+        try:
+            listen = (host or '127.0.0.1', int(port))
+        except ValueError:
+            print("Invalid status address %s, expected [HOST:]PORT" %
+                  arg.status)
+            return 1
+
+    manager = new_manager(arg, arg.region, arg.key_id, arg.access_key,
+                          **options)
+    scheduler = SnapshotScheduler(manager, interval, workers=arg.workers,
+                                  refresh=arg.refresh, listen=listen)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+    if scheduler.run() > 0:
+        return 2
+    return 0
+
+
+def run_snapshot(arg, region, key_id, access_key, report=None, plan=None,
+                 **options):
+    """
+    Select instances, snapshot them and remove old snapshots, or only write
+    the plan of it
+
+    :param arg: command line arguments
+    :type arg: Namespace
+
+    :param region: EC2 region
+    :type region: str
+
+    :param key_id: EC2 key identifier
+    :type key_id: str
+
+    :param access_key: EC2 access key
+    :type access_key: str
+
+    :param report: prefix of the run profile files
+    :type report: str
+
+    :param plan: write the actions to this plan file instead of making them
+    :type plan: str
+
+    :param options: other ManageSnapshot arguments
+    :type options: dict
+
+    :returns: number of snapshot errors, number of deletion errors
+    :rtype return: int, int
+    """
+    selected_instances = new_manager(arg, region, key_id, access_key,
+                                     **options)
+    if plan is not None:
+        return 0, selected_instances.write_plan(plan)
+    # Launch snapshot
+    num_mk_err, num_rm_err = selected_instances.mk_rm_snapshot()
+    if report is not None:
+        selected_instances.write_report(report, num_mk_err, num_rm_err)
+    return num_mk_err, num_rm_err
+
+
+def run_targets(arg, config, options):
+    """
+    Run the snapshot pipeline of several profile/region pairs concurrently
+
+    :param arg: command line arguments
+    :type arg: Namespace
+
+    :param config: credentials file
+    :type config: configparser.ConfigParser
+
+    :param options: ManageSnapshot arguments common to every target
+    :type options: dict
+
+    :returns: exit status, 0 if every target succeeded, 2 on snapshot
+              errors and 1 if a target could not run
+    :rtype return: int
+    """
+    logger = logging.getLogger(__name__)
+    pool = BackendPool(arg.max_pool_connections or
+                       max(10, arg.workers + arg.delete_workers + 2))
+    budget = None
+    if arg.max_concurrency > 0:
+        budget = threading.BoundedSemaphore(arg.max_concurrency)
+
+    targets = []
+    for target in arg.target:
+        profile, _, region = target.partition(':')
+        try:
+            if not region:
+                region = config.get(profile, 'aws_region')
+            key_id = config.get(profile, 'aws_access_key_id')
+            access_key = config.get(profile, 'aws_secret_access_key')
+        except (AttributeError, configparser.Error) as e:
+            print("Can't read credentials of profile %s: %s" % (profile, e))
+            return 1
+        targets.append(('/'.join([profile, region]), region, key_id,
+                        access_key))
+
+    results = {}
+
+    def run(name, region, key_id, access_key):
+        cache = None
+        if arg.cache is not None:
+            root, extension = os.path.splitext(arg.cache)
+            cache = InventoryCache('%s-%s%s' % (root, name.replace('/', '-'),
+                                                extension), arg.cache_ttl)
+        report = None
+        if arg.report is not None:
+            report = '-'.join([arg.report, name.replace('/', '-')])
+        try:
+            results[name] = run_snapshot(arg, region, key_id, access_key,
+                                         cache=cache, report=report,
+                                         pool=pool, budget=budget, name=name,
+                                         **options)
+        except (Exception, SystemExit) as e:
+            logger.critical("Run of %s failed: %s" % (name, e))
+            results[name] = None
+
+    threads = []
+    for name, region, key_id, access_key in targets:
+        thread = threading.Thread(target=run, name=name,
+                                  args=(name, region, key_id, access_key))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    status = 0
+    print("%-40s %16s %16s" % ('Target', 'Snapshot errors', 'Deletion errors'))
+    for name, _, _, _ in targets:
+        if results.get(name) is None:
+            print("%-40s %16s %16s" % (name, 'failed', 'failed'))
+            status = 1
+            continue
+        num_mk_err, num_rm_err = results[name]
+        print("%-40s %16s %16s" % (name, num_mk_err, num_rm_err))
+        if status == 0 and (num_mk_err != 0 or num_rm_err != 0):
+            status = 2
+    return status
+
+
+def run_jobs(arg, jobs, options):
+    """
+    Run several jobs of a region one after the other, all of them
+    selecting their instances from a single inventory of the region
+
+    :param arg: command line arguments, the defaults of every job
+    :type arg: Namespace
+
+    :param jobs: job names and their options, from read_jobs
+    :type jobs: list of (str, dict)
+
+    :param options: ManageSnapshot arguments common to every job
+    :type options: dict
+
+    :returns: exit status, 0 if every job succeeded, 2 on snapshot errors
+              and 1 if a job could not run
+    :rtype return: int
+    """
+    logger = logging.getLogger(__name__)
+    pool = BackendPool(arg.max_pool_connections or
+                       max(10, arg.workers + arg.delete_workers + 2))
+    inventory = Inventory()
+    cache = None
+    if arg.cache is not None:
+        cache = InventoryCache(arg.cache, arg.cache_ttl)
+
+    results = {}
+    for name, job in jobs:
+        # Jobs only select the instances they list
+        job_arg = argparse.Namespace(**dict(vars(arg), instance=[], tags=[]))
+        job_options = dict(options)
+        # Options taken by ManageSnapshot itself, not read from arguments
+        for key, value in job.items():
+            if key in ('gfs', 'multi_volume'):
+                job_options[key] = value
+            else:
+                setattr(job_arg, key, value)
+        report = None
+        if arg.report is not None:
+            report = '-'.join([arg.report, name])
+        logger.info("Running job %s" % name)
+        try:
+            results[name] = run_snapshot(job_arg, arg.region, arg.key_id,
+                                         arg.access_key, cache=cache,
+                                         report=report, pool=pool,
+                                         inventory=inventory, name=name,
+                                         **job_options)
+        except (Exception, SystemExit) as e:
+            logger.critical("Job %s failed: %s" % (name, e))
+            results[name] = None
+
+    status = 0
+    print("%-40s %16s %16s" % ('Job', 'Snapshot errors', 'Deletion errors'))
+    for name, _ in jobs:
+        if results.get(name) is None:
+            print("%-40s %16s %16s" % (name, 'failed', 'failed'))
+            status = 1
+            continue
+        num_mk_err, num_rm_err = results[name]
+        print("%-40s %16s %16s" % (name, num_mk_err, num_rm_err))
+        if status == 0 and (num_mk_err != 0 or num_rm_err != 0):
+            status = 2
+    return status
+
+
+def main():
+    """
+    Main - manage args
+    """
+    # Main informations
+    parser = argparse.ArgumentParser(
+        description='Simple EC2 Snapshot utility',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # Command args
@@ -570,6 +5311,17 @@ def main():
                         help='Credentials profile file defined in \
                               credentials file')
 
+    parser.add_argument('-x', '--target', action='append',
+                        default=[], metavar='PROFILE[:REGION]',
+                        help='Run on this credentials profile and region, \
+                              can be repeated to run several accounts and \
+                              regions concurrently (region defaults to the \
+                              one of the profile)')
+    parser.add_argument('-X', '--max_concurrency', action='store',
+                        type=int, default=0, metavar='MAX_CONCURRENCY',
+                        help='Maximum number of instances processed at the \
+                              same time across all targets (0 for no limit)')
+
     parser.add_argument('-i', '--instance', action='append',
                         default=[], metavar='INSTANCE_ID',
                         help=' '.join(['Instance ID (ex: i-00000000 or all)']))
@@ -584,6 +5336,12 @@ def main():
                         action='store', default=-1, type=int,
                         help=' '.join(['Limit the number of snapshot (can be',
                                        'usefull with auto-scaling groups)']))
+    parser.add_argument('-e', '--shard',
+                        action='store', default=None, metavar='I/N',
+                        help='Only manage the instances of shard I out of N, \
+                              by a stable hash of their ID, to share the \
+                              fleet between N runners (limit applies per \
+                              shard)')
     parser.add_argument('-H', '--cold_snap',
                         action='store_true', default=False,
                         help='Make cold snapshot for a better consistency \
@@ -592,9 +5350,20 @@ def main():
                         type=int, default=600, metavar='COLDSNAP_TIMEOUT',
                         help='Instance timeout (in seconds) for stop and start \
                               during a cold snapshot')
+    parser.add_argument('-b', '--cold_batch', action='store',
+                        type=int, default=0, metavar='BATCH_SIZE',
+                        help='Stop and start this number of instances \
+                              together during a cold snapshot (0 to disable)')
+    parser.add_argument('-w', '--workers', action='store',
+                        type=int, default=1, metavar='WORKERS',
+                        help='Number of instances processed concurrently')
     parser.add_argument('-o', '--no_root_device',
                         action='store_true', default=False,
                         help='Do not snapshot root device')
+    parser.add_argument('-M', '--multi_volume',
+                        action='store_true', default=False,
+                        help='Snapshot all the volumes of an instance in a \
+                              single crash-consistent call')
 
     parser.add_argument('-g', '--max_age',
                         type=str, default=[],
@@ -604,11 +5373,136 @@ def main():
     parser.add_argument('-d', '--keep_last_snapshots',
                         action='store', default=0, type=int,
                         help='Keep the x last snapshots')
+    parser.add_argument('-D', '--delete_workers', action='store',
+                        type=int, default=4, metavar='DELETE_WORKERS',
+                        help='Number of threads deleting old snapshots')
+    parser.add_argument('-R', '--delete_rate', action='store',
+                        type=float, default=10, metavar='DELETE_RATE',
+                        help='Maximum snapshot deletions per second \
+                              (0 for no limit)')
+    parser.add_argument('-A', '--api_rate', action='store',
+                        type=float, default=20, metavar='API_RATE',
+                        help='Maximum EC2 calls per second, lowered \
+                              automatically when throttled (0 for no limit)')
+    parser.add_argument('-P', '--api_concurrency', action='append',
+                        type=str, default=[], metavar='OPERATION=N',
+                        help='Maximum concurrent calls of an EC2 operation \
+                              (ex: create_snapshot=5)')
+    parser.add_argument('-N', '--max_pool_connections', action='store',
+                        type=int, default=0, metavar='CONNECTIONS',
+                        help='Maximum HTTP connections to EC2 (0 for one per \
+                              thread of the run)')
+    parser.add_argument('-G', '--gfs', action='store',
+                        type=str, default=None, metavar='PERIOD=N,...',
+                        help='Keep the newest snapshot of each of the last N \
+                              periods (hourly/daily/weekly/monthly/yearly), \
+                              ex: hourly=24,daily=14,weekly=8,monthly=12')
     parser.add_argument('-n', '--no_snap',
                         action='store_true', default=False,
                         help='Do not make snapshot \
                         (useful when combien to -g option)')
 
+    parser.add_argument('-C', '--cache', metavar='CACHE_FILE',
+                        nargs='?', default=None, type=str,
+                        const=os.path.join(os.path.expanduser('~'), '.cache',
+                                           'simplec2snap', 'inventory.db'),
+                        help='Keep an inventory cache in this SQLite file \
+                              (~/.cache/simplec2snap/inventory.db if no file \
+                              is given)')
+    parser.add_argument('-T', '--cache_ttl', metavar='CACHE_TTL',
+                        default=86400, type=int, action='store',
+                        help='Seconds after which cached entries are \
+                              refreshed from AWS')
+
+    parser.add_argument('-j', '--report', metavar='REPORT_PREFIX',
+                        default=None, action='store', type=str,
+                        help='Write a run profile to REPORT_PREFIX.json and \
+                              REPORT_PREFIX.prom (Prometheus textfile)')
+    parser.add_argument('-q', '--trace', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Write the phases of the run by instance and \
+                              volume to a Chrome trace file \
+                              (chrome://tracing, Perfetto)')
+    parser.add_argument('-Q', '--cprofile', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Write a cProfile dump of every thread of the \
+                              run, to be read with pstats')
+    parser.add_argument('-O', '--journal', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Write the steps of the run to a journal, to \
+                              resume it with -E if it dies halfway')
+    parser.add_argument('-E', '--resume', action='store_true',
+                        default=False,
+                        help='Resume the unfinished run of the journal: \
+                              start the instances it left stopped and only \
+                              do the remaining work')
+    parser.add_argument('-B', '--deadline', action='store',
+                        type=str, default=None, metavar='DURATION',
+                        help='Time budget of the run: instances are taken \
+                              from the one with the oldest snapshot, and \
+                              those estimated not to finish in time are \
+                              deferred. The deletions queued by retention \
+                              and the -W wait finish after the budget and \
+                              are not counted in it \
+                              (<int><s/m/h/d/w/M/y>, ex: 2h)')
+    parser.add_argument('-U', '--history', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Keep the time spent on each instance in this \
+                              file, to estimate the next runs for -B')
+    parser.add_argument('-J', '--jobs', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Run every job of this INI file, each with its \
+                              own tags and retention, from a single \
+                              inventory of the region')
+    parser.add_argument('-y', '--plan', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Only write the stops, snapshots, starts and \
+                              deletions of the run to a plan file')
+    parser.add_argument('-Y', '--apply', metavar='FILE',
+                        default=None, action='store', type=str,
+                        help='Make the actions of a plan file written by -y, \
+                              without selecting instances again. A plan is \
+                              only applied once')
+    parser.add_argument('--plan_max_age', action='store',
+                        type=str, default='1d', metavar='DURATION',
+                        help='Refuse to apply a plan written longer ago \
+                              than this (<int><s/m/h/d/w/M/y>, ex: 12h)')
+    parser.add_argument('-S', '--daemon', action='store_true',
+                        default=False,
+                        help='Keep running and snapshot each instance at its \
+                              interval, keeping connections and inventory \
+                              between jobs')
+    parser.add_argument('-I', '--interval', action='store',
+                        type=str, default='1d', metavar='INTERVAL',
+                        help='Default interval between jobs of an instance \
+                              in daemon mode, overridden by the %s instance \
+                              tag (<int><s/m/h/d/w/M/y>, ex: 6h)' % INTERVAL_TAG)
+    parser.add_argument('-F', '--refresh', action='store',
+                        type=int, default=900, metavar='SECONDS',
+                        help='Seconds between inventory refreshes in daemon \
+                              mode')
+    parser.add_argument('-L', '--status', action='store',
+                        type=str, default=None, metavar='[HOST:]PORT',
+                        help='Serve the daemon status as JSON over HTTP on \
+                              this address (default host: 127.0.0.1)')
+    parser.add_argument('-K', '--track_snapshots', action='store_true',
+                        default=False,
+                        help='Follow the progress of created snapshots and \
+                              report completion times and throughput')
+    parser.add_argument('-W', '--wait_snapshots', action='store',
+                        type=int, default=0, metavar='SECONDS',
+                        help='Wait at most this number of seconds for \
+                              created snapshots and their copies to complete \
+                              (implies -K)')
+    parser.add_argument('-z', '--copy_to_region', action='append',
+                        default=[], metavar='REGION',
+                        help='Copy created snapshots to this region once \
+                              completed, with retention applied to the \
+                              copies (repeatable, needs -W)')
+    parser.add_argument('-Z', '--copy_concurrency', action='store',
+                        type=int, default=5, metavar='N',
+                        help='Maximum copies in progress by destination \
+                              region')
     parser.add_argument('-f', '--file_output', metavar='FILE',
                         default=None, action='store', type=str,
                         help='Set an output file')
@@ -629,49 +5523,177 @@ def main():
         sys.exit(0)
     arg = parser.parse_args()
 
-    # Setup loger
-    setup_log(console=arg.stdout, log=arg.file_output, level=arg.verbosity)
+    # Setup loger, attributing lines to instances when running concurrently
+    if arg.workers > 1 or len(arg.target) > 0 or arg.daemon is True:
+        setup_log(console=arg.stdout, log=arg.file_output, level=arg.verbosity,
+                  form='%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s')
+    else:
+        setup_log(console=arg.stdout, log=arg.file_output, level=arg.verbosity)
 
     # Read credential file and override by command args
+    config = None
     if os.path.isfile(arg.credentials):
         if os.access(arg.credentials,  os.R_OK):
-            config = ConfigParser.ConfigParser()
+            config = configparser.ConfigParser()
             config.read([str(arg.credentials)])
-            if arg.region is None:
-                arg.region = config.get(arg.profile, 'aws_region')
-            if arg.access_key is None:
-                arg.access_key = config.get(arg.profile, 'aws_secret_access_key')
-            if arg.key_id is None:
-                arg.key_id = config.get(arg.profile, 'aws_access_key_id')
+            if len(arg.target) == 0:
+                if arg.region is None:
+                    arg.region = config.get(arg.profile, 'aws_region')
+                if arg.access_key is None:
+                    arg.access_key = config.get(arg.profile, 'aws_secret_access_key')
+                if arg.key_id is None:
+                    arg.key_id = config.get(arg.profile, 'aws_access_key_id')
         else:
             print("Don't have permission to read credentials file")
             sys.exit(1)
 
     # Exit if no instance or tag has been set
-    if arg.instance is None and arg.tags is None:
+    if arg.instance is None and arg.tags is None and arg.apply is None and \
+            arg.jobs is None:
         print('Please set at least instance ID or tag with value')
         sys.exit(1)
     else:
-        # Create action
-        selected_instances = ManageSnapshot(arg.region, arg.key_id,
-                                            arg.access_key, arg.instance,
-                                            arg.tags, arg.dry_run, arg.timeout,
-                                            arg.cold_snap, arg.limit,
-                                            arg.no_root_device, arg.max_age,
-                                            arg.no_snap,
-                                            arg.keep_last_snapshots)
-        # Calculate max snapshot age
-        if len(arg.max_age) > 0:
-            selected_instances.calulate_max_snap_age()
-        # Launch snapshot
-        num_mk_err, num_rm_err = selected_instances.mk_rm_snapshot()
-
-        if num_mk_err == 0 and num_rm_err == 0:
-            sys.exit(0)
-        else:
-            print("Number of snapshots errors: %s" % num_mk_err)
-            print("Number of snapshots deletion errors: %s" % num_rm_err)
-            sys.exit(2)
+        api_concurrency = {}
+        for cap in arg.api_concurrency:
+            try:
+                operation, number = cap.split('=')
+                api_concurrency[operation] = int(number)
+            except ValueError:
+                print("Invalid API concurrency %s, expected OPERATION=N" % cap)
+                sys.exit(1)
+
+        shard = None
+        if arg.shard is not None:
+            try:
+                shard = parse_shard(arg.shard)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+        deadline = None
+        if arg.deadline is not None:
+            try:
+                deadline = parse_duration(arg.deadline)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+        plan_max_age = None
+        if arg.apply is not None:
+            try:
+                plan_max_age = parse_duration(arg.plan_max_age)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+        gfs = None
+        if arg.gfs is not None:
+            try:
+                gfs = RetentionPolicy.parse_periods(arg.gfs)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+        options = dict(workers=arg.workers,
+                       gfs=gfs,
+                       multi_volume=arg.multi_volume,
+                       track=arg.track_snapshots,
+                       wait_snapshots=arg.wait_snapshots,
+                       cold_batch=arg.cold_batch,
+                       delete_workers=arg.delete_workers,
+                       delete_rate=arg.delete_rate,
+                       api_rate=arg.api_rate,
+                       api_concurrency=api_concurrency,
+                       max_pool_connections=arg.max_pool_connections or None,
+                       shard=shard,
+                       copy_regions=arg.copy_to_region,
+                       copy_concurrency=arg.copy_concurrency,
+                       deadline=deadline)
+        if arg.history is not None:
+            options['history'] = RunHistory(arg.history)
+
+        if arg.resume is True and arg.journal is None:
+            print('Resuming a run needs its journal (-O)')
+            sys.exit(1)
+        if arg.journal is not None and \
+                (arg.daemon is True or len(arg.target) > 0):
+            print('The journal is only written by a single run')
+            sys.exit(1)
+        if (arg.plan is not None or arg.apply is not None) and \
+                (arg.daemon is True or len(arg.target) > 0 or
+                 None not in (arg.plan, arg.apply)):
+            print('A plan is written or applied by a single run')
+            sys.exit(1)
+
+        jobs = None
+        if arg.jobs is not None:
+            if arg.daemon is True or len(arg.target) > 0 or \
+                    any(value is not None for value in
+                        (arg.journal, arg.plan, arg.apply)):
+                print('Jobs are run by a single run of one region')
+                sys.exit(1)
+            try:
+                jobs = read_jobs(arg.jobs)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+        if (deadline is not None or arg.history is not None) and \
+                (arg.daemon is True or arg.plan is not None or
+                 arg.apply is not None):
+            print('The deadline and history are for single runs')
+            sys.exit(1)
+
+        if len(arg.copy_to_region) > 0 and \
+                (arg.daemon is True or arg.wait_snapshots <= 0):
+            print('Copies are made by a single run waiting for snapshots (-W)')
+            sys.exit(1)
+
+        tracer = None
+        if arg.trace is not None:
+            if arg.daemon is True:
+                print('A trace is written by a single run')
+                sys.exit(1)
+            tracer = options['tracer'] = SpanTracer()
+        profiler = None
+        if arg.cprofile is not None:
+            profiler = RunProfiler()
+            profiler.start()
+
+        try:
+            if len(arg.target) > 0:
+                if arg.daemon is True:
+                    print('Daemon mode runs on a single profile and region')
+                    sys.exit(1)
+                sys.exit(run_targets(arg, config, options))
+            if jobs is not None:
+                sys.exit(run_jobs(arg, jobs, options))
+
+            cache = None
+            if arg.cache is not None:
+                cache = InventoryCache(arg.cache, arg.cache_ttl)
+
+            if arg.daemon is True:
+                sys.exit(run_daemon(arg, dict(options, cache=cache)))
+
+            num_mk_err, num_rm_err = run_snapshot(
+                arg, arg.region, arg.key_id, arg.access_key, cache=cache,
+                report=arg.report, journal=arg.journal, resume=arg.resume,
+                plan=arg.plan, apply_plan=arg.apply,
+                plan_max_age=plan_max_age, **options)
+
+            if num_mk_err == 0 and num_rm_err == 0:
+                sys.exit(0)
+            else:
+                print("Number of snapshots errors: %s" % num_mk_err)
+                print("Number of snapshots deletion errors: %s" % num_rm_err)
+                sys.exit(2)
+        finally:
+            if tracer is not None:
+                tracer.write(arg.trace)
+            if profiler is not None:
+                profiler.stop(arg.cprofile)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Run against the script of the checkout, not an installed copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
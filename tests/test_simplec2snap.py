@@ -0,0 +1,1229 @@
+# encoding: utf-8
+#
+# Unit tests of simplec2snap, driven by the simulated EC2 backend of the
+# benchmark so that no AWS account is needed.
+#
+#  Run with: python -m pytest tests
+
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+import bench_simplec2snap
+import simplec2snap
+
+NOW = datetime.datetime(2024, 6, 1, 12)
+
+Snapshot = collections.namedtuple('Snapshot', ['id', 'start_time'])
+
+
+def snapshot(number, age):
+    """
+    Snapshot taken age before NOW
+    """
+    return Snapshot('snap-%d' % number, (NOW - age).strftime(
+        simplec2snap.SNAP_TIME_FORMAT))
+
+
+def manager(ec2, **kwargs):
+    """
+    Manager on a fake backend, deleting without rate limit
+    """
+    options = dict(delete_rate=0, api_rate=0)
+    options.update(kwargs)
+    return bench_simplec2snap.fake_manager(ec2, **options)
+
+
+def snapshot_count(ec2):
+    """
+    Number of snapshots by volume
+    """
+    return collections.Counter(snapshot.volume_id
+                               for snapshot in ec2.snapshots.values())
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    """
+    Fake backends by region for runs started from the command line, a
+    region without one gets 4 instances of 2 volumes
+    """
+    backends = {}
+
+    def backend(region, key_id, access_key, max_pool_connections=10):
+        if region not in backends:
+            backends[region] = bench_simplec2snap.FakeEC2(4, 2, 0)
+        return backends[region]
+
+    monkeypatch.setattr(simplec2snap, 'Boto3Backend', backend)
+    return backends
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    """
+    Poll created snapshots and their copies every 50ms instead of every 10s
+    """
+    init = simplec2snap.SnapshotTracker.__init__
+    copier_init = simplec2snap.SnapshotCopier.__init__
+
+    def fast_init(tracker, poll, interval=10, **kwargs):
+        init(tracker, poll, 0.05, **kwargs)
+
+    def fast_copier_init(copier, region, copy, poll, concurrency=5,
+                         interval=10, **kwargs):
+        copier_init(copier, region, copy, poll, concurrency, 0.05, **kwargs)
+
+    monkeypatch.setattr(simplec2snap.SnapshotTracker, '__init__', fast_init)
+    monkeypatch.setattr(simplec2snap.SnapshotCopier, '__init__',
+                        fast_copier_init)
+
+
+def run_main(monkeypatch, *args):
+    """
+    Run the command line without credentials file
+
+    :returns: exit status
+    """
+    monkeypatch.setattr(sys, 'argv', ['simplec2snap.py', '-c', '/nonexistent',
+                                      '-R', '0', '-A', '0'] + list(args))
+    logger = logging.getLogger('simplec2snap')
+    handlers = list(logger.handlers)
+    try:
+        simplec2snap.main()
+    except SystemExit as e:
+        return e.code
+    finally:
+        logger.handlers = handlers
+    return 0
+
+
+def reference_select(snapshots, now, max_age=0, keep_last=0, periods=None):
+    """
+    Straightforward retention, on the whole list of snapshots
+    """
+    periods = dict((period, count) for period, count in
+                   (periods or {}).items() if count > 0)
+    # Newest first, the first listed winning between equal dates
+    ordered = sorted(enumerate(snapshots), key=lambda item: (
+        simplec2snap.parse_start_time(item[1].start_time), -item[0]),
+        reverse=True)
+    ordered = [snap for _, snap in ordered]
+
+    def expired(snap):
+        return max_age > 0 and now - simplec2snap.parse_start_time(
+            snap.start_time) > datetime.timedelta(seconds=max_age)
+
+    if len(periods) == 0:
+        if max_age > 0:
+            return [snap for snap in ordered if expired(snap)]
+        if keep_last == 0:
+            return []
+    kept = set(snap.id for snap in ordered[:keep_last])
+    for period, count in periods.items():
+        key = simplec2snap.RetentionPolicy.PERIODS[period]
+        buckets = collections.OrderedDict()
+        for snap in ordered:
+            buckets.setdefault(
+                key(simplec2snap.parse_start_time(snap.start_time)), snap)
+        newest = sorted(buckets, reverse=True)[:count]
+        kept.update(buckets[bucket].id for bucket in newest)
+    return [snap for snap in ordered if snap.id not in kept and
+            (len(periods) == 0 or max_age == 0 or expired(snap))]
+
+
+class TestParsing:
+
+    def test_duration(self):
+        assert simplec2snap.parse_duration('30m') == 1800
+        assert simplec2snap.parse_duration('2d') == 2 * 86400
+
+    @pytest.mark.parametrize('value', ['', 'h', '10', '0h', '-1d', '3x'])
+    def test_invalid_duration(self, value):
+        with pytest.raises(ValueError):
+            simplec2snap.parse_duration(value)
+
+    def test_shard(self):
+        assert simplec2snap.parse_shard('2/3') == (2, 3)
+        for value in ('0/3', '4/3', '1/0', '1', 'a/b'):
+            with pytest.raises(ValueError):
+                simplec2snap.parse_shard(value)
+
+    def test_shard_of_is_stable_and_covers_every_shard(self):
+        ids = ["i-%08x" % number for number in range(300)]
+        shards = [simplec2snap.shard_of(iid, 3) for iid in ids]
+        assert shards == [simplec2snap.shard_of(iid, 3) for iid in ids]
+        assert set(shards) == {1, 2, 3}
+        # Value of the SHA-1 hash, the same on every host
+        assert simplec2snap.shard_of('i-00000000', 4) == \
+            int(hashlib.sha1(b'i-00000000').hexdigest(), 16) % 4 + 1
+
+    def test_periods(self):
+        assert simplec2snap.RetentionPolicy.parse_periods(
+            'daily=7, weekly=4') == {'daily': 7, 'weekly': 4}
+        for spec in ('daily', 'daily=x', 'fortnightly=2'):
+            with pytest.raises(ValueError):
+                simplec2snap.RetentionPolicy.parse_periods(spec)
+
+
+class TestRetention:
+
+    def test_keep_last(self):
+        snapshots = [snapshot(number, datetime.timedelta(days=number))
+                     for number in range(6)]
+        policy = simplec2snap.RetentionPolicy(keep_last=2)
+        assert [snap.id for snap in policy.select(snapshots, NOW)] == \
+            ['snap-2', 'snap-3', 'snap-4', 'snap-5']
+
+    def test_max_age_takes_precedence(self):
+        snapshots = [snapshot(number, datetime.timedelta(days=number))
+                     for number in range(6)]
+        policy = simplec2snap.RetentionPolicy(max_age=3 * 86400 + 1,
+                                              keep_last=1)
+        assert [snap.id for snap in policy.select(snapshots, NOW)] == \
+            ['snap-4', 'snap-5']
+
+    def test_gfs(self):
+        # One snapshot every 6 hours for 60 days
+        snapshots = [snapshot(number, datetime.timedelta(hours=6 * number))
+                     for number in range(240)]
+        policy = simplec2snap.RetentionPolicy(
+            keep_last=2, periods={'daily': 7, 'weekly': 4})
+        deleted = set(snap.id for snap in policy.select(snapshots, NOW))
+        kept = [snap for snap in snapshots if snap.id not in deleted]
+        assert len(kept) == len(set(snap.id for snap in kept))
+        assert [snap.id for snap in kept[:2]] == ['snap-0', 'snap-1']
+        days = set(simplec2snap.parse_start_time(snap.start_time).date()
+                   for snap in kept)
+        assert len(days) >= 7
+        assert len(kept) <= 2 + 7 + 4
+
+    def test_disabled_policy_keeps_everything(self):
+        snapshots = [snapshot(number, datetime.timedelta(days=number))
+                     for number in range(5)]
+        policy = simplec2snap.RetentionPolicy()
+        assert policy.enabled() is False
+        assert policy.select(snapshots, NOW) == []
+
+    def test_selector_matches_reference(self):
+        rnd = random.Random(1)
+        for _ in range(500):
+            periods = dict((period, rnd.randint(0, 4)) for period in
+                           simplec2snap.RetentionPolicy.PERIODS
+                           if rnd.random() < 0.4)
+            keep_last = rnd.randint(0, 4)
+            max_age = rnd.choice([0, 0, 86400 * rnd.randint(1, 60)])
+            snapshots = [snapshot(number, datetime.timedelta(
+                seconds=rnd.randint(0, 86400 * 400)))
+                for number in range(rnd.randint(0, 40))]
+            policy = simplec2snap.RetentionPolicy(max_age, keep_last,
+                                                  periods)
+            expected = reference_select(snapshots, NOW, max_age, keep_last,
+                                        periods)
+            assert sorted(snap.id for snap in
+                          policy.select(snapshots, NOW)) == \
+                sorted(snap.id for snap in expected)
+
+    def test_selector_ignores_doubles(self):
+        selector = simplec2snap.RetentionPolicy(keep_last=1).selector(NOW)
+        old = snapshot(1, datetime.timedelta(days=2))
+        new = snapshot(2, datetime.timedelta(days=1))
+        assert selector.offer(new) == []
+        assert selector.offer(new) == []
+        assert selector.offer(old) == [old]
+
+    def test_run_keeps_last_snapshots(self):
+        ec2 = bench_simplec2snap.FakeEC2(3, 2, 5)
+        errors = manager(ec2, keep_last_snapshots=2).mk_rm_snapshot()
+        assert errors == (0, 0)
+        # The snapshot of the run is counted once
+        assert set(snapshot_count(ec2).values()) == {2}
+
+
+class TestDiscovery:
+
+    def test_tags_select_instances(self):
+        ec2 = bench_simplec2snap.FakeEC2(5, 2, 0)
+        selected = manager(ec2).instances
+        assert [iid.instance_id for iid in selected] == list(ec2.instances)
+        assert all(len(iid.get_disks()) == 2 for iid in selected)
+
+    def test_missing_instance_only_drops_itself(self):
+        ec2 = bench_simplec2snap.FakeEC2(5, 2, 0)
+        selected = manager(ec2, instance_list=['i-0000dead', 'i-00000001'])
+        assert sorted(iid.instance_id for iid in selected.instances) == \
+            sorted(ec2.instances)
+
+    def test_chunks(self, monkeypatch):
+        monkeypatch.setattr(simplec2snap, 'FILTER_CHUNK', 2)
+        ec2 = bench_simplec2snap.FakeEC2(5, 1, 0)
+        selected = manager(ec2, instance_list=['i-0000dead'])
+        assert len(selected.instances) == 5
+        assert ec2.calls['describe_volumes'] == 3
+
+
+class TestInventory:
+
+    def test_unnamed_instance(self):
+        ec2 = bench_simplec2snap.FakeEC2(3, 1, 0)
+        del ec2.instances['i-00000001'].tags['Name']
+        selected = manager(ec2, inventory=simplec2snap.Inventory())
+        assert [iid.instance_id for iid in selected.instances] == \
+            list(ec2.instances)
+        assert selected.instances[1].name == ''
+
+    def test_repeated_tag_matches_any_value(self):
+        ec2 = bench_simplec2snap.FakeEC2(4, 1, 0)
+        ec2.instances['i-00000000'].tags['env'] = 'prod'
+        ec2.instances['i-00000001'].tags['env'] = 'staging'
+        tags = [['env', 'prod'], ['env', 'stag*'], ['Name', 'instance-?']]
+        filtered = manager(ec2, tags=tags)
+        inventory = manager(ec2, tags=tags,
+                            inventory=simplec2snap.Inventory())
+        assert [iid.instance_id for iid in filtered.instances] == \
+            [iid.instance_id for iid in inventory.instances] == \
+            ['i-00000000', 'i-00000001']
+
+
+class TestWorkers:
+
+    def test_workers_bound_concurrency(self):
+        ec2 = bench_simplec2snap.FakeEC2(6, 1, 0)
+        lock = threading.Lock()
+        active = []
+        peak = [0]
+        names = set()
+        create = ec2.create_snapshot
+
+        def slow_create(volume_id, description, tags):
+            with lock:
+                active.append(volume_id)
+                peak[0] = max(peak[0], len(active))
+                names.add(threading.current_thread().name)
+            time.sleep(0.1)
+            with lock:
+                active.remove(volume_id)
+            return create(volume_id, description, tags)
+
+        ec2.create_snapshot = slow_create
+        assert manager(ec2, workers=3).mk_rm_snapshot() == (0, 0)
+        assert peak[0] == 3
+        # Threads are named after the instance they work on
+        assert names == set(ec2.instances)
+        assert set(snapshot_count(ec2).values()) == {1}
+
+    def test_unexpected_error_only_fails_its_instance(self):
+        ec2 = bench_simplec2snap.FakeEC2(4, 1, 0)
+        run = manager(ec2, workers=2)
+        process = run._process_instance
+
+        def failing(iid, policy=None):
+            if iid.instance_id == 'i-00000002':
+                raise RuntimeError('unexpected')
+            return process(iid, policy)
+
+        run._process_instance = failing
+        assert run.mk_rm_snapshot() == (1, 0)
+        assert sorted(snapshot_count(ec2)) == \
+            ['vol-00000000', 'vol-00000001', 'vol-00000003']
+
+
+class TestColdBatches:
+
+    def test_batches_stop_and_start_together(self):
+        ec2 = bench_simplec2snap.FakeEC2(5, 1, 0)
+        ec2.instances['i-00000001'].state = 'stopped'
+        run = manager(ec2, cold_snap=True, cold_batch=2)
+        assert run.mk_rm_snapshot() == (0, 0)
+        # One stop and one start call per batch, the stopped instance is
+        # snapshotted right away and left stopped
+        assert ec2.calls['stop_instances'] == 3
+        assert ec2.calls['start_instances'] == 3
+        assert set(snapshot_count(ec2).values()) == {1}
+        assert [instance.state for instance in ec2.instances.values()] == \
+            ['running', 'stopped', 'running', 'running', 'running']
+
+    def test_instance_which_never_stops_is_skipped(self):
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+        stop = ec2.stop_instances
+
+        def stuck_stop(instance_ids):
+            stop(instance_ids)
+            ec2.instances['i-00000001'].target = None
+
+        ec2.stop_instances = stuck_stop
+        run = manager(ec2, cold_snap=True, cold_batch=2, timeout=0.5)
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert list(snapshot_count(ec2)) == ['vol-00000000']
+        assert ec2.instances['i-00000000'].state == 'running'
+        assert ec2.instances['i-00000001'].state == 'stopping'
+
+
+class TestStateWaiter:
+
+    @staticmethod
+    def instance(number):
+        return simplec2snap.Instance("i-%08x" % number, '', 'running',
+                                     '/dev/sda')
+
+    def test_one_poll_for_every_pending_instance(self):
+        registered = threading.Event()
+        polls = []
+
+        def poll(instance_ids):
+            registered.wait()
+            polls.append(sorted(instance_ids))
+            state = 'stopped' if len(polls) > 1 else 'stopping'
+            return dict((iid, state) for iid in instance_ids)
+
+        waiter = simplec2snap.StateWaiter(poll, min_interval=0.01)
+        deadline = time.time() + 5
+        futures = [waiter.register(self.instance(number), 'stopped',
+                                   deadline) for number in (0, 1, 1, 2)]
+        registered.set()
+        assert [future.result() for future in futures] == [True] * 4
+        assert len(polls) == 2
+        assert polls[-1] == ['i-00000000', 'i-00000001', 'i-00000002']
+
+    def test_backoff_and_timeout(self):
+        polls = []
+
+        def poll(instance_ids):
+            polls.append(time.time())
+            # A failed poll does not end the wait
+            if len(polls) == 1:
+                raise simplec2snap.EC2Error(500, 'InternalError', 'error')
+            return {}
+
+        waiter = simplec2snap.StateWaiter(poll, min_interval=0.01,
+                                          max_interval=0.08)
+        start = time.time()
+        future = waiter.register(self.instance(0), 'stopped', start + 0.5)
+        assert future.result() is False
+        assert 0.5 <= time.time() - start < 0.6
+        # Polls are spaced by a jittered interval doubling up to its
+        # maximum, the last one being cut by the deadline
+        gaps = [end - begin for begin, end in zip(polls, polls[1:])]
+        assert gaps[0] < 0.03
+        assert all(0.035 < gap < 0.1 for gap in gaps[3:-1])
+        assert len(gaps) > 5
+
+
+class TestDeleter:
+
+    def test_pool_and_rate(self):
+        lock = threading.Lock()
+        threads = set()
+        deleted = []
+
+        def delete(snapshot_id):
+            with lock:
+                threads.add(threading.current_thread().name)
+            if snapshot_id == 'snap-7':
+                raise simplec2snap.EC2Error(500, 'InternalError', 'error')
+
+        deleter = simplec2snap.SnapshotDeleter(delete, workers=3, rate=20,
+                                               on_deleted=deleted.append)
+        deleter.start()
+        start = time.time()
+        for number in range(30):
+            deleter.submit(snapshot(number, datetime.timedelta()),
+                           "i-%s" % (number % 2), 'vol')
+        deleter.close()
+        # A burst of 20 deletions, then 10 more at 20 per second
+        assert time.time() - start >= 0.45
+        assert threads <= {'deleter-0', 'deleter-1', 'deleter-2'}
+        assert (deleter.deleted, deleter.failed) == (29, 1)
+        assert deleter.failed_owners == {'i-1'}
+        assert sorted(snap.id for snap in deleted) == \
+            sorted("snap-%d" % number for number in range(30) if number != 7)
+
+    def test_failed_deletion_counts_for_its_instance(self):
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 3)
+        delete = ec2.delete_snapshot
+
+        def failing_delete(snapshot_id):
+            if ec2.snapshots[snapshot_id].volume_id == 'vol-00000000':
+                raise simplec2snap.EC2Error(400, 'InvalidSnapshot.InUse',
+                                            'in use')
+            delete(snapshot_id)
+
+        ec2.delete_snapshot = failing_delete
+        run = manager(ec2, keep_last_snapshots=1, delete_workers=2)
+        assert run.mk_rm_snapshot() == (0, 1)
+        assert snapshot_count(ec2) == {'vol-00000000': 4, 'vol-00000001': 1}
+
+
+class TestCache:
+
+    def test_runs_refresh_the_cache_incrementally(self, tmp_path):
+        path = str(tmp_path / 'inventory.db')
+        ec2 = bench_simplec2snap.FakeEC2(3, 2, 3)
+        described = []
+        describe = ec2.describe_instances
+
+        def record(instance_ids=None, filters=None, next_token=None):
+            described.append(instance_ids)
+            return describe(instance_ids, filters, next_token)
+
+        ec2.describe_instances = record
+        for _ in range(2):
+            run = manager(ec2, keep_last_snapshots=2,
+                          cache=simplec2snap.InventoryCache(path, 3600))
+            assert run.mk_rm_snapshot() == (0, 0)
+            ec2.instances['i-00000001'].state = 'stopped'
+        # The second run only described the instance whose state changed
+        # and did not list snapshots again
+        assert described == [None, list(ec2.instances), None,
+                             ['i-00000001']]
+        assert ec2.calls['describe_volumes'] == 2
+        assert ec2.calls['describe_snapshots'] == 1
+        cache = simplec2snap.InventoryCache(path, 3600)
+        assert sorted(snap.id for snap in cache.iter_snapshots()) == \
+            sorted(ec2.snapshots)
+
+        # A dry run with a fresh cache makes no call
+        ec2.calls.clear()
+        run = manager(ec2, keep_last_snapshots=1, dry_run=True, cache=cache)
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert ec2.calls == {}
+
+    def test_ttl(self, tmp_path):
+        path = str(tmp_path / 'inventory.db')
+        cache = simplec2snap.InventoryCache(path, 0.2)
+        cache.store_instance(simplec2snap.Instance('i-1', '', 'running',
+                                                   '/dev/sda'), {})
+        cache.store_snapshots([simplec2snap.CachedSnapshot(
+            'snap-1', 'vol-1', NOW.strftime(simplec2snap.SNAP_TIME_FORMAT))])
+        cache.set_meta('snapshots', 1)
+        assert list(cache.get_instances(['i-1'])) == ['i-1']
+        assert cache.is_fresh('snapshots') is True
+        time.sleep(0.3)
+        assert cache.is_fresh('snapshots') is False
+        cache = simplec2snap.InventoryCache(path, 0.2)
+        assert cache.get_instances(['i-1']) == {}
+        assert list(cache.iter_snapshots()) == []
+
+
+class TestApi:
+
+    @pytest.fixture
+    def delays(self, monkeypatch):
+        delays = []
+        monkeypatch.setattr(simplec2snap.time, 'sleep', delays.append)
+        return delays
+
+    @staticmethod
+    def failing(*errors):
+        """
+        Function raising errors in turn, then returning 'done'
+        """
+        errors = list(errors)
+
+        def function():
+            if len(errors) > 0:
+                raise errors.pop(0)
+            return 'done'
+
+        return function
+
+    @pytest.mark.parametrize('error, kind', [
+        (simplec2snap.EC2Error(503, 'RequestLimitExceeded', ''), 'throttle'),
+        (simplec2snap.EC2Error(400, 'Throttling', ''), 'throttle'),
+        (simplec2snap.EC2Error(400, 'InternalError', ''), 'transient'),
+        (simplec2snap.EC2Error(502, 'BadGateway', ''), 'transient'),
+        (IOError('connection reset'), 'transient'),
+        (simplec2snap.EC2Error(400, 'InvalidParameterValue', ''), None),
+        (ValueError('bug'), None),
+    ])
+    def test_classify_error(self, error, kind):
+        assert simplec2snap.classify_error(error) == kind
+
+    def test_transient_errors_are_retried(self, delays):
+        api = simplec2snap.EC2Api(rate=20)
+        error = simplec2snap.EC2Error(500, 'InternalError', 'error')
+        assert api.call('describe', self.failing(error, error)) == 'done'
+        metrics = api.metrics.report()['describe']
+        assert (metrics['calls'], metrics['retries'], metrics['errors']) == \
+            (3, 2, 0)
+        # Exponential backoff from 0.2s, the rate is not lowered
+        assert 0.2 <= delays[0] <= 0.4 and 0.4 <= delays[1] <= 0.8
+        assert api.limiter.rate == 20
+
+    def test_throttling_slows_down(self, delays):
+        api = simplec2snap.EC2Api(rate=20)
+        error = simplec2snap.EC2Error(503, 'RequestLimitExceeded', 'error')
+        assert api.call('describe', self.failing(error)) == 'done'
+        assert api.metrics.report()['describe']['throttled'] == 1
+        assert 1 <= delays[0] <= 2
+        # Halved once, then raised back a little by the success
+        assert api.limiter.rate == pytest.approx(10.5)
+
+    def test_other_errors_are_not_retried(self, delays):
+        api = simplec2snap.EC2Api(rate=0)
+        error = simplec2snap.EC2Error(400, 'InvalidParameterValue', 'error')
+        with pytest.raises(simplec2snap.EC2Error):
+            api.call('describe', self.failing(error))
+        assert delays == []
+        assert api.metrics.report()['describe']['errors'] == 1
+
+    def test_retries_are_bounded(self, delays):
+        api = simplec2snap.EC2Api(rate=0, retries=2)
+        error = simplec2snap.EC2Error(500, 'InternalError', 'error')
+        with pytest.raises(simplec2snap.EC2Error):
+            api.call('describe', self.failing(error, error, error))
+        assert len(delays) == 2
+        metrics = api.metrics.report()['describe']
+        assert (metrics['calls'], metrics['errors']) == (3, 1)
+
+
+class TestTargets:
+
+    CREDENTIALS = """[prod]
+aws_access_key_id = key
+aws_secret_access_key = secret
+aws_region = eu-west-1
+
+[test]
+aws_access_key_id = key
+aws_secret_access_key = secret
+aws_region = us-east-1
+"""
+
+    @pytest.fixture
+    def credentials(self, tmp_path):
+        path = tmp_path / 'credentials'
+        path.write_text(self.CREDENTIALS)
+        return str(path)
+
+    def run(self, monkeypatch, credentials, *targets):
+        args = ['-c', credentials, '-t', 'env', 'bench', '-u', '-d', '1']
+        for target in targets:
+            args.extend(['-x', target])
+        return run_main(monkeypatch, *args)
+
+    def test_every_target_runs(self, monkeypatch, fakes, credentials,
+                               capsys):
+        assert self.run(monkeypatch, credentials, 'prod', 'test',
+                        'prod:us-west-2') == 0
+        assert sorted(fakes) == ['eu-west-1', 'us-east-1', 'us-west-2']
+        for ec2 in fakes.values():
+            assert list(snapshot_count(ec2).values()) == [1] * 8
+        out = capsys.readouterr().out
+        for name in ('prod/eu-west-1', 'test/us-east-1', 'prod/us-west-2'):
+            assert name in out
+
+    def test_exit_status(self, monkeypatch, fakes, credentials, capsys):
+        # Deletions fail in one region, the other one cannot list instances
+        fakes['us-east-1'] = bench_simplec2snap.FakeEC2(2, 1, 2)
+        fakes['us-west-2'] = bench_simplec2snap.FakeEC2(2, 1, 0)
+
+        def denied(*args, **kwargs):
+            raise simplec2snap.EC2Error(403, 'UnauthorizedOperation',
+                                        'denied')
+
+        fakes['us-east-1'].delete_snapshot = denied
+        assert self.run(monkeypatch, credentials, 'prod', 'test') == 2
+        fakes['us-west-2'].describe_instances = denied
+        assert self.run(monkeypatch, credentials, 'prod',
+                        'prod:us-west-2', 'test') == 1
+        # The other targets still ran
+        assert list(snapshot_count(fakes['eu-west-1']).values()) == [1] * 8
+        assert snapshot_count(fakes['us-east-1']) == \
+            {'vol-00000000': 4, 'vol-00000001': 4}
+        out = capsys.readouterr().out
+        assert "%-40s %16s %16s" % ('prod/us-west-2', 'failed', 'failed') \
+            in out
+
+    def test_unknown_profile(self, monkeypatch, fakes, credentials, capsys):
+        assert self.run(monkeypatch, credentials, 'prod', 'staging') == 1
+        assert "Can't read credentials of profile staging" in \
+            capsys.readouterr().out
+        assert fakes == {}
+
+
+class TestTracker:
+
+    def test_poll_and_summary(self):
+        states = {'snap-1': ('completed', '100%'), 'snap-2': ('error', '10%'),
+                  'snap-3': ('pending', '50%')}
+        polls = []
+        done = []
+
+        def poll(snapshot_ids):
+            polls.append(sorted(snapshot_ids))
+            return dict((sid, states[sid]) for sid in snapshot_ids)
+
+        tracker = simplec2snap.SnapshotTracker(
+            poll, 0.05, on_done=lambda *args: done.append(args))
+        for number in range(1, 4):
+            tracker.add("snap-%d" % number, "vol-%d" % number, 8)
+        tracker.start()
+        start = time.time()
+        summary = tracker.finish(0.3)
+        assert 0.3 <= time.time() - start < 0.5
+        # Only pending snapshots are polled again
+        assert polls[0] == ['snap-1', 'snap-2', 'snap-3']
+        assert set(map(tuple, polls[1:])) == {('snap-3',)}
+        assert done == [('snap-1', 'vol-1', 8, 'completed'),
+                        ('snap-2', 'vol-2', 8, 'error')]
+        aggregate = summary['aggregate']
+        assert (aggregate['snapshots'], aggregate['completed'],
+                aggregate['errors'], aggregate['pending']) == (3, 1, 1, 1)
+        assert aggregate['size_gib'] == 8
+        assert summary['snapshots']['snap-3']['progress'] == '50%'
+
+    @pytest.mark.usefixtures('fast_polls')
+    def test_snapshot_in_error_fails_the_run(self):
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+        create = ec2.create_snapshot
+
+        def failing_create(volume_id, description, tags):
+            snap = create(volume_id, description, tags)
+            if volume_id == 'vol-00000001':
+                ec2.snapshots[snap.id] = snap._replace(status='error')
+            return snap
+
+        ec2.create_snapshot = failing_create
+        run = manager(ec2, wait_snapshots=5)
+        assert run.mk_rm_snapshot() == (1, 0)
+        aggregate = run._tracking['aggregate']
+        assert (aggregate['completed'], aggregate['errors']) == (1, 1)
+
+
+class TestMultiVolume:
+
+    def test_one_call_per_instance(self):
+        ec2 = bench_simplec2snap.FakeEC2(3, 3, 0)
+        run = manager(ec2, multi_volume=True, no_root_device=True)
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert ec2.calls['create_snapshots'] == 3
+        assert 'create_snapshot' not in ec2.calls
+        # The root device is left out
+        assert sorted(snapshot_count(ec2)) == \
+            ["vol-%08x" % vol for vol in range(9) if vol % 3 != 0]
+        assert all(tags['type'] == 'Hot'
+                   for tags in ec2.snapshot_tags.values())
+
+    def test_unsupported_region_falls_back_once(self):
+        ec2 = bench_simplec2snap.FakeEC2(3, 2, 0)
+
+        def unsupported(*args, **kwargs):
+            ec2.call('create_snapshots')
+            raise simplec2snap.EC2Error(400, 'InvalidAction', 'unsupported')
+
+        ec2.create_snapshots = unsupported
+        assert manager(ec2, multi_volume=True).mk_rm_snapshot() == (0, 0)
+        assert ec2.calls['create_snapshots'] == 1
+        assert ec2.calls['create_snapshot'] == 6
+
+    def test_failed_instance_falls_back_alone(self):
+        ec2 = bench_simplec2snap.FakeEC2(3, 2, 0)
+        create = ec2.create_snapshots
+
+        def failing(instance_id, exclude_boot, description, tags):
+            if instance_id == 'i-00000001':
+                ec2.call('create_snapshots')
+                raise simplec2snap.EC2Error(400, 'InvalidParameterValue',
+                                            'error')
+            return create(instance_id, exclude_boot, description, tags)
+
+        ec2.create_snapshots = failing
+        assert manager(ec2, multi_volume=True).mk_rm_snapshot() == (0, 0)
+        assert ec2.calls['create_snapshots'] == 3
+        assert ec2.calls['create_snapshot'] == 2
+        assert set(snapshot_count(ec2).values()) == {1}
+
+    def test_missing_volume_fails_the_instance(self):
+        ec2 = bench_simplec2snap.FakeEC2(2, 2, 0)
+        create = ec2.create_snapshots
+
+        def partial(instance_id, exclude_boot, description, tags):
+            return create(instance_id, exclude_boot, description, tags)[:1]
+
+        ec2.create_snapshots = partial
+        assert manager(ec2, multi_volume=True).mk_rm_snapshot() == (2, 0)
+
+
+class TestDaemon:
+
+    @staticmethod
+    def fleet():
+        """
+        Instances snapshotted an hour ago but the last one, the first one
+        every 30 minutes and the second one with an invalid interval
+        """
+        ec2 = bench_simplec2snap.FakeEC2(4, 1, 1)
+        ec2.instances['i-00000000'].tags[simplec2snap.INTERVAL_TAG] = '30m'
+        ec2.instances['i-00000001'].tags[simplec2snap.INTERVAL_TAG] = 'soon'
+        for sid, snap in list(ec2.snapshots.items()):
+            if snap.volume_id == 'vol-00000003':
+                ec2.delete_snapshot(sid)
+        return ec2
+
+    def test_schedule(self):
+        run = manager(self.fleet())
+        scheduler = simplec2snap.SnapshotScheduler(run, 7200)
+        scheduler.update(run.instances)
+        now = time.time()
+        assert scheduler.dispatch(now) == 2
+        status = scheduler.status()
+        assert dict((iid, job['interval']) for iid, job in
+                    status['jobs'].items()) == {
+            'i-00000000': 1800, 'i-00000001': 7200, 'i-00000002': 7200,
+            'i-00000003': 7200}
+        # Due an interval after the newest snapshot
+        assert status['jobs']['i-00000002']['next_run'] == \
+            pytest.approx(now + 3600, abs=2)
+        assert status['queue_depth'] == 2
+        # A job still queued is skipped when due again
+        assert scheduler.dispatch(now + 1800) == 0
+        assert scheduler.status()['skipped_overlaps'] == 1
+
+    def test_run_and_status_endpoint(self):
+        ec2 = self.fleet()
+        scheduler = simplec2snap.SnapshotScheduler(
+            manager(ec2), 7200, workers=2, listen=('127.0.0.1', 0))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            scheduler.run()))
+        thread.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                if scheduler._server is not None:
+                    url = "http://127.0.0.1:%s/" % \
+                        scheduler._server.server_address[1]
+                    status = json.loads(urllib.request.urlopen(url).read())
+                    if len([job for job in status['jobs'].values()
+                            if 'last_run' in job]) == 2:
+                        break
+                time.sleep(0.05)
+        finally:
+            scheduler.stop()
+            thread.join()
+        assert result == [0]
+        assert status['version'] == simplec2snap.__version__
+        assert sorted(iid for iid, job in status['jobs'].items()
+                      if 'last_run' in job) == ['i-00000000', 'i-00000003']
+        assert status['jobs']['i-00000000']['last_run'][
+            'snapshot_errors'] == 0
+        assert snapshot_count(ec2) == {'vol-00000000': 2, 'vol-00000001': 1,
+                                       'vol-00000002': 1, 'vol-00000003': 1}
+
+
+class TestJobs:
+
+    JOBS = '\n'.join([
+        '[DEFAULT]',
+        'keep_last_snapshots = 2',
+        '',
+        '[web]',
+        'tags = Name=instance-0',
+        '       env=bench',
+        'multi_volume = true',
+        'gfs = daily=7',
+        '',
+        '[db]',
+        'instance = i-00000001',
+        'keep_last_snapshots = 1',
+        'cold_snap = true',
+        'max_age = 7 d',
+    ])
+
+    def test_read_jobs(self, tmp_path):
+        path = tmp_path / 'jobs.ini'
+        path.write_text(self.JOBS)
+        jobs = simplec2snap.read_jobs(str(path))
+        assert [name for name, _ in jobs] == ['web', 'db']
+        web, db = jobs[0][1], jobs[1][1]
+        assert web == {'tags': [['Name', 'instance-0'], ['env', 'bench']],
+                       'multi_volume': True, 'gfs': {'daily': 7},
+                       'keep_last_snapshots': 2}
+        assert db == {'instance': ['i-00000001'], 'keep_last_snapshots': 1,
+                      'cold_snap': True, 'max_age': ['7', 'd']}
+
+    @pytest.mark.parametrize('content', [
+        '',
+        '[web]\ntags = env=prod\ncolour = blue\n',
+        '[web]\ntags = env\n',
+        '[web]\ninstance = i-1\nmax_age = 7\n',
+        '[web]\ninstance = i-1\nkeep_last_snapshots = many\n',
+        '[DEFAULT]\nkeep_last_snapshots = 2\n[web]\ncold_snap = true\n',
+    ])
+    def test_invalid_jobs(self, tmp_path, content):
+        path = tmp_path / 'jobs.ini'
+        path.write_text(content)
+        with pytest.raises(ValueError):
+            simplec2snap.read_jobs(str(path))
+        with pytest.raises(ValueError):
+            simplec2snap.read_jobs(str(tmp_path / 'missing.ini'))
+
+    def test_run_jobs(self, tmp_path, monkeypatch, fakes):
+        ec2 = fakes['bench'] = bench_simplec2snap.FakeEC2(3, 2, 3)
+        path = tmp_path / 'jobs.ini'
+        path.write_text(self.JOBS)
+        listed = []
+        describe = ec2.describe_snapshots
+
+        def listing(snapshot_ids=None, filters=None, next_token=None):
+            listed.append((filters or {}).get('volume-id'))
+            return describe(snapshot_ids, filters, next_token)
+
+        ec2.describe_snapshots = listing
+        assert run_main(monkeypatch, '-r', 'bench', '-k', 'key', '-a',
+                        'secret', '-u', '-J', str(path)) == 0
+        # One multi-volume call for web, a call by volume for db
+        assert ec2.calls['create_snapshots'] == 1
+        assert ec2.calls['create_snapshot'] == 2
+        assert ec2.calls['stop_instances'] == 1
+        # The max_age of db takes precedence over its keep_last
+        counts = snapshot_count(ec2)
+        assert [counts["vol-%08x" % vol] for vol in range(6)] == \
+            [2, 2, 4, 4, 3, 3]
+        # Every instance was described once for both jobs, which only
+        # listed the snapshots of their own volumes
+        assert ec2.calls['describe_volumes'] == 1
+        assert listed == [['vol-00000000', 'vol-00000001'],
+                          ['vol-00000002', 'vol-00000003']]
+
+
+class TestReport:
+
+    def test_samples_carry_target(self, tmp_path):
+        prefixes = []
+        for name in ('prod/eu-west-1', 'staging/eu-west-1', None):
+            ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+            run = manager(ec2, name=name, region='eu-west-1')
+            errors = run.mk_rm_snapshot()
+            prefixes.append(str(tmp_path / str(len(prefixes))))
+            run.write_report(prefixes[-1], *errors)
+        targets = []
+        for prefix in prefixes:
+            samples = [line for line in open(prefix + '.prom')
+                       if not line.startswith('#')]
+            assert all('region="eu-west-1"' in line for line in samples)
+            found = set(line.split('target="')[1].split('"')[0]
+                        for line in samples if 'target="' in line)
+            assert len(found) == 1 and len(samples) > 0
+            assert all('target="' in line for line in samples)
+            targets.extend(found)
+        assert targets == ['prod/eu-west-1', 'staging/eu-west-1',
+                           'eu-west-1']
+
+
+@pytest.mark.usefixtures('fast_polls')
+class TestCopies:
+
+    def test_copies_go_to_their_region(self):
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+        regions = {}
+        run = manager(ec2, regions=regions, wait_snapshots=30,
+                      copy_regions=['us-east-1', 'eu-central-1'])
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert sorted(regions) == ['eu-central-1', 'us-east-1']
+        assert 'copy_snapshot' not in ec2.calls
+        for fake in regions.values():
+            assert fake.calls['copy_snapshot'] == 2
+            assert len(fake.snapshots) == 2
+
+    def test_copies_share_the_wait(self, monkeypatch):
+        waits = []
+        track = simplec2snap.SnapshotTracker.finish
+        copy = simplec2snap.SnapshotCopier.finish
+
+        def slow_track(tracker, wait=0):
+            time.sleep(0.5)
+            return track(tracker)
+
+        def record_copy(copier, wait=0):
+            waits.append(wait)
+            return copy(copier)
+
+        monkeypatch.setattr(simplec2snap.SnapshotTracker, 'finish',
+                            slow_track)
+        monkeypatch.setattr(simplec2snap.SnapshotCopier, 'finish',
+                            record_copy)
+        ec2 = bench_simplec2snap.FakeEC2(1, 1, 0)
+        run = manager(ec2, wait_snapshots=1,
+                      copy_regions=['us-east-1', 'eu-central-1'])
+        run.mk_rm_snapshot()
+        assert len(waits) == 2
+        assert all(0 <= wait <= 0.5 for wait in waits)
+
+
+class TestJournal:
+
+    def test_replay(self, tmp_path):
+        path = str(tmp_path / 'run.journal')
+        journal = simplec2snap.RunJournal(path)
+        journal.record('plan', instances=[], cold_snap=True, no_snap=False)
+        journal.record('stopped', instance='i-1')
+        journal.record('snapshot', instance='i-1', volume='vol-1',
+                       snapshot='snap-1')
+        journal.record('stopped', instance='i-2')
+        journal.record('started', instance='i-2')
+        journal.record('done', instance='i-2')
+        journal.close()
+        with open(path, 'a') as cut:
+            cut.write('{"event": "del')
+        state = simplec2snap.RunJournal.replay(path)
+        assert state['cold_snap'] is True
+        assert state['stopped'] == {'i-1'}
+        assert state['done'] == {'i-2'}
+        assert state['snapshots'] == {'i-1': {'vol-1': 'snap-1'}}
+
+    def test_append_after_cut_line(self, tmp_path):
+        path = str(tmp_path / 'run.journal')
+        journal = simplec2snap.RunJournal(path)
+        journal.record('plan', instances=[])
+        journal.close()
+        with open(path, 'a') as cut:
+            cut.write('{"event": "del')
+        journal = simplec2snap.RunJournal(path, append=True)
+        journal.record('end')
+        journal.close()
+        assert simplec2snap.RunJournal.replay(path) is None
+
+    def test_finished_run(self, tmp_path):
+        path = str(tmp_path / 'run.journal')
+        assert simplec2snap.RunJournal.replay(path) is None
+        journal = simplec2snap.RunJournal(path)
+        journal.record('plan', instances=[])
+        journal.record('end')
+        journal.close()
+        assert simplec2snap.RunJournal.replay(path) is None
+
+    def test_resume_after_crash(self, tmp_path):
+        path = str(tmp_path / 'run.journal')
+        ec2 = bench_simplec2snap.FakeEC2(2, 2, 0)
+        create = ec2.create_snapshot
+        created = []
+
+        def crashing(*args):
+            if len(created) == 3:
+                raise KeyboardInterrupt('crash')
+            created.append(args[0])
+            return create(*args)
+
+        ec2.create_snapshot = crashing
+        with pytest.raises(KeyboardInterrupt):
+            manager(ec2, cold_snap=True, journal=path).mk_rm_snapshot()
+        assert ec2.instances['i-00000001'].state == 'stopped'
+
+        ec2.create_snapshot = create
+        # Starting over would forget the instance left stopped
+        unfinished = open(path).read()
+        with pytest.raises(SystemExit):
+            manager(ec2, cold_snap=True, journal=path)
+        assert open(path).read() == unfinished
+        # The mode of the interrupted run is used
+        resumed = manager(ec2, journal=path, resume=True)
+        assert resumed.mk_rm_snapshot() == (0, 0)
+        assert ec2.instances['i-00000001'].state == 'running'
+        assert set(snapshot_count(ec2).values()) == {1}
+        assert ec2.calls['stop_instances'] == 2
+        assert simplec2snap.RunJournal.replay(path) is None
+
+    def test_resume_within_deadline(self, tmp_path):
+        path = str(tmp_path / 'run.journal')
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+        create = ec2.create_snapshot
+
+        def crashing(*args):
+            raise KeyboardInterrupt('crash')
+
+        ec2.create_snapshot = crashing
+        with pytest.raises(KeyboardInterrupt):
+            manager(ec2, cold_snap=True, journal=path).mk_rm_snapshot()
+        assert ec2.instances['i-00000000'].state == 'stopped'
+
+        ec2.create_snapshot = create
+        # Every instance is estimated beyond the deadline
+        history = simplec2snap.RunHistory()
+        for iid in ec2.instances:
+            history.record(iid, 'cold', 3600)
+        resumed = manager(ec2, journal=path, resume=True, deadline=60,
+                          history=history)
+        assert resumed.mk_rm_snapshot() == (0, 0)
+        assert ec2.instances['i-00000000'].state == 'running'
+        assert resumed._deferred == ['i-00000001']
+
+
+class TestPlan:
+
+    def test_write_and_apply(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        ec2 = bench_simplec2snap.FakeEC2(3, 2, 4)
+        planner = manager(ec2, keep_last_snapshots=3, no_root_device=True)
+        assert planner.write_plan(path) == 0
+        actions = collections.Counter(json.loads(line)['action']
+                                      for line in open(path))
+        assert actions == {'plan': 1, 'instance': 3, 'snapshot': 3,
+                           'delete': 9}
+        # Planning makes no change
+        assert 'create_snapshot' not in ec2.calls
+        assert 'delete_snapshot' not in ec2.calls
+
+        assert manager(ec2, apply_plan=path).mk_rm_snapshot() == (0, 0)
+        # Root volumes are not snapshotted, every volume keeps 3
+        assert set(snapshot_count(ec2).values()) == {3}
+        assert ec2.calls['create_snapshot'] == 3
+
+    def test_plan_is_applied_once(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 2)
+        manager(ec2, keep_last_snapshots=2).write_plan(path)
+        # A dry run makes nothing and does not count
+        manager(ec2, apply_plan=path, dry_run=True).mk_rm_snapshot()
+        manager(ec2, apply_plan=path).mk_rm_snapshot()
+        assert ec2.calls['create_snapshot'] == 2
+        with pytest.raises(SystemExit):
+            manager(ec2, apply_plan=path)
+        assert ec2.calls['create_snapshot'] == 2
+
+    def test_interrupted_apply_resumes(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        journal = str(tmp_path / 'run.journal')
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 0)
+        manager(ec2, cold_snap=True).write_plan(path)
+        create = ec2.create_snapshot
+
+        def crashing(*args):
+            raise KeyboardInterrupt('crash')
+
+        ec2.create_snapshot = crashing
+        with pytest.raises(KeyboardInterrupt):
+            manager(ec2, apply_plan=path, journal=journal).mk_rm_snapshot()
+        ec2.create_snapshot = create
+        with pytest.raises(SystemExit):
+            manager(ec2, apply_plan=path, journal=journal)
+        resumed = manager(ec2, apply_plan=path, journal=journal, resume=True)
+        assert resumed.mk_rm_snapshot() == (0, 0)
+        assert set(snapshot_count(ec2).values()) == {1}
+        assert set(instance.state for instance in ec2.instances.values()) \
+            == {'running'}
+
+    def test_old_plan_is_refused(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        ec2 = bench_simplec2snap.FakeEC2(1, 1, 0)
+        manager(ec2).write_plan(path)
+        lines = open(path).read().splitlines()
+        header = json.loads(lines[0])
+        header['created'] -= 7200
+        lines[0] = json.dumps(header, sort_keys=True)
+        open(path, 'w').write('\n'.join(lines) + '\n')
+        with pytest.raises(SystemExit):
+            manager(ec2, apply_plan=path, plan_max_age=3600)
+        assert manager(ec2, apply_plan=path,
+                       plan_max_age=3 * 3600).mk_rm_snapshot() == (0, 0)
+
+    def test_resumed_apply_skips_deleted_snapshots(self, tmp_path,
+                                                   monkeypatch):
+        path = str(tmp_path / 'run.plan')
+        journal = str(tmp_path / 'run.journal')
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 4)
+        manager(ec2, keep_last_snapshots=2).write_plan(path)
+        close = simplec2snap.ManageSnapshot.close_pipeline
+
+        def crashing(run):
+            close(run)
+            raise KeyboardInterrupt('crash')
+
+        # The run dies once its deletions are done
+        monkeypatch.setattr(simplec2snap.ManageSnapshot, 'close_pipeline',
+                            crashing)
+        with pytest.raises(KeyboardInterrupt):
+            manager(ec2, apply_plan=path, journal=journal).mk_rm_snapshot()
+        monkeypatch.setattr(simplec2snap.ManageSnapshot, 'close_pipeline',
+                            close)
+        assert simplec2snap.RunJournal.replay(journal)['deleted'] == \
+            set(json.loads(line)['snapshot'] for line in open(path)
+                if json.loads(line)['action'] == 'delete')
+
+        resumed = manager(ec2, apply_plan=path, journal=journal, resume=True)
+        assert resumed.mk_rm_snapshot() == (0, 0)
+        assert ec2.calls['delete_snapshot'] == 6
+        assert set(snapshot_count(ec2).values()) == {2}
+
+    def test_missing_snapshot_counts_as_deleted(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        ec2 = bench_simplec2snap.FakeEC2(1, 1, 3)
+        manager(ec2, keep_last_snapshots=1).write_plan(path)
+        # Deleted by hand between the plan and its apply
+        ec2.delete_snapshot(sorted(ec2.snapshots)[0])
+        assert manager(ec2, apply_plan=path).mk_rm_snapshot() == (0, 0)
+        assert set(snapshot_count(ec2).values()) == {1}
+
+    def test_failed_snapshot_keeps_volume_snapshots(self, tmp_path):
+        path = str(tmp_path / 'run.plan')
+        ec2 = bench_simplec2snap.FakeEC2(2, 1, 4)
+        manager(ec2, keep_last_snapshots=2).write_plan(path)
+        create = ec2.create_snapshot
+
+        def failing(volume_id, *args):
+            if volume_id == 'vol-00000000':
+                raise simplec2snap.EC2Error(400, 'IncorrectState',
+                                            'Volume is busy')
+            return create(volume_id, *args)
+
+        ec2.create_snapshot = failing
+        assert manager(ec2, apply_plan=path).mk_rm_snapshot()[1] == 0
+        counts = snapshot_count(ec2)
+        assert (counts['vol-00000000'], counts['vol-00000001']) == (4, 2)
+
+
+class TestBudget:
+
+    def test_stalest_instances_first(self):
+        ec2 = bench_simplec2snap.FakeEC2(4, 1, 3)
+        # No snapshot of the second instance, only the oldest one of the
+        # third
+        third = sorted(sid for sid, snap in ec2.snapshots.items()
+                       if snap.volume_id == 'vol-00000002')
+        for sid, snap in list(ec2.snapshots.items()):
+            if snap.volume_id == 'vol-00000001' or sid in third[1:]:
+                ec2.delete_snapshot(sid)
+        order = []
+        create = ec2.create_snapshot
+
+        def record(volume_id, description, tags):
+            order.append(volume_id)
+            return create(volume_id, description, tags)
+
+        ec2.create_snapshot = record
+        # Quicker instances first between snapshots of the same age
+        history = simplec2snap.RunHistory()
+        history.record('i-00000000', 'hot', 5)
+        history.record('i-00000003', 'hot', 1)
+        run = manager(ec2, deadline=3600, history=history)
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert order == ['vol-00000001', 'vol-00000002', 'vol-00000003',
+                         'vol-00000000']
+
+    def test_deferral(self, tmp_path):
+        path = str(tmp_path / 'history.json')
+        history = simplec2snap.RunHistory(path)
+        history.record('i-00000000', 'hot', 100)
+        for number in range(1, 4):
+            history.record("i-%08x" % number, 'hot', 1)
+        ec2 = bench_simplec2snap.FakeEC2(4, 1, 0)
+        run = manager(ec2, deadline=10, history=history)
+        # Deferred instances are not errors
+        assert run.mk_rm_snapshot() == (0, 0)
+        assert run._deferred == ['i-00000000']
+        assert sorted(snapshot_count(ec2)) == \
+            ['vol-00000001', 'vol-00000002', 'vol-00000003']
+        # The durations of the run are kept for the next one
+        saved = simplec2snap.RunHistory(path)
+        assert saved.estimate('i-00000000', 'hot') == 100
+        assert saved.estimate('i-00000001', 'hot') < 1